@@ -0,0 +1,79 @@
+"""
+Latency of shared data access package: connection per query against shared pool,
+and queries with server side prepared statements against without them.
+
+Usage: python benchmarks/memes_db_benchmark.py [repeat]
+Database environment variables have to be set.
+"""
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import psycopg
+from sqlalchemy.dialects.postgresql.psycopg import PGDialect_psycopg
+
+from memes_db import engine as db_engine
+from memes_db import repository
+from memes_db.config import CONNINFO, PREPARE_THRESHOLD
+from memes_db.search_query import build_search_query
+
+QUERIES = ["cat", "funny dog", "when you"]
+USER_ID = 1
+
+
+def report(label: str, elapsed: float, repeat: int) -> None:
+    print(f"{label:40} {elapsed / repeat * 1000:8.3f} ms")
+
+
+async def measure_connection_per_query(repeat: int) -> None:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        async with await psycopg.AsyncConnection.connect(CONNINFO) as conn:
+            await conn.execute("SELECT 1")
+    report("new connection per query", time.perf_counter() - start, repeat)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        async with db_engine.engine.connect() as conn:
+            await conn.exec_driver_sql("SELECT 1")
+    report("shared pool", time.perf_counter() - start, repeat)
+
+
+async def measure_prepared(repeat: int) -> None:
+    dialect = PGDialect_psycopg()
+    for query in QUERIES:
+        compiled = build_search_query(query, USER_ID, limit=40).compile(dialect=dialect)
+        for label, threshold in (("unprepared", None), ("prepared", PREPARE_THRESHOLD)):
+            async with await psycopg.AsyncConnection.connect(CONNINFO, prepare_threshold=threshold) as conn:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    await (await conn.execute(str(compiled), compiled.params)).fetchall()
+                report(f"search {query!r} {label}", time.perf_counter() - start, repeat)
+
+
+async def measure_repository(repeat: int) -> None:
+    for query in QUERIES:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await repository.search_memes(query, USER_ID, 20)
+        report(f"repository.search_memes {query!r}", time.perf_counter() - start, repeat)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await repository.get_user_memes_page(USER_ID, 50)
+    report("repository.get_user_memes_page", time.perf_counter() - start, repeat)
+
+
+async def main(repeat: int) -> None:
+    db_engine.connect()
+    await measure_connection_per_query(repeat)
+    await measure_prepared(repeat)
+    await measure_repository(repeat)
+    await db_engine.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
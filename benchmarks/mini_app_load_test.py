@@ -0,0 +1,108 @@
+"""
+Requests per second of mini app memes API while scrolling a big library.
+
+Usage: python benchmarks/mini_app_load_test.py [base_url]
+Seeds memes for a test user if it has less than LIBRARY_SIZE of them, then several clients scroll
+the whole library page by page. Second pass sends ETags of first pass and gets only 304 responses.
+Without base_url the app is called in process, database environment variables have to be set.
+Requests are authenticated with initData signed by BOT_KEY, so server has to have the same key.
+"""
+import asyncio
+import sys
+import time
+from urllib.parse import urlencode
+from pathlib import Path
+
+import httpx
+from sqlalchemy import text
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "mini_app" / "backend"))
+
+import auth
+import database
+import main
+from memes_db import engine as db_engine
+
+TEST_USER_ID = 1
+LIBRARY_SIZE = 10_000
+CLIENTS = 8
+PAGE_SIZE = 50
+
+
+async def seed() -> None:
+    async with db_engine.engine.begin() as conn:
+        await conn.execute(text("INSERT INTO users (telegram_id) VALUES (:user_id) ON CONFLICT DO NOTHING"),
+                           {"user_id": TEST_USER_ID})
+        existing = await conn.scalar(text("SELECT count(*) FROM memes WHERE creator_telegram_id = :user_id"),
+                                     {"user_id": TEST_USER_ID})
+        if existing >= LIBRARY_SIZE:
+            return
+        await conn.execute(text("""
+            INSERT INTO memes (creator_telegram_id, duration, telegram_media_id, title, tags, media_type, is_public)
+            SELECT :user_id, 0, 'file' || n, 'load test meme ' || n, ARRAY['load', 'tag' || n % 50],
+                   (ARRAY['audio', 'gif', 'photo', 'video', 'voice'])[n % 5 + 1]::media_type, n % 2 = 0
+            FROM generate_series(1, :amount) AS n
+        """), {"user_id": TEST_USER_ID, "amount": LIBRARY_SIZE - existing})
+    print(f"seeded {LIBRARY_SIZE - existing} memes")
+
+
+def init_data() -> str:
+    fields = {"auth_date": str(int(time.time())), "user": f'{{"id": {TEST_USER_ID}}}'}
+    return urlencode({**fields, "hash": auth.sign(fields, main.init_data_key)})
+
+
+async def scroll(client: httpx.AsyncClient, etags: dict) -> tuple[int, int]:
+    """Scroll whole library. Returns amount of requests and of 304 responses"""
+    requests = not_modified = 0
+    url = f"/api/memes?limit={PAGE_SIZE}"
+    while url:
+        headers = {"Accept-Encoding": "br, gzip"}
+        if url in etags:
+            headers["If-None-Match"] = etags[url]
+        response = await client.get(url, headers=headers)
+        requests += 1
+        if response.status_code == 304:
+            not_modified += 1
+            # Cursors of unchanged pages are known from first pass
+            url = etags.get(("next", url))
+            continue
+        response.raise_for_status()
+        next_cursor = response.json()["next"]
+        next_url = f"/api/memes?limit={PAGE_SIZE}&cursor={next_cursor}" if next_cursor else None
+        etags[url] = response.headers["etag"]
+        etags[("next", url)] = next_url
+        url = next_url
+    return requests, not_modified
+
+
+async def measure(label: str, client: httpx.AsyncClient, etags: list[dict]) -> None:
+    start = time.perf_counter()
+    results = await asyncio.gather(*(scroll(client, client_etags) for client_etags in etags))
+    elapsed = time.perf_counter() - start
+    requests = sum(result[0] for result in results)
+    not_modified = sum(result[1] for result in results)
+    print(f"{label:12} {requests} requests, {not_modified} not modified, "
+          f"{elapsed:.2f} s, {requests / elapsed:.0f} requests/s")
+
+
+async def run(base_url: str) -> None:
+    headers = {"Authorization": f"tma {init_data()}"}
+    if base_url:
+        client = httpx.AsyncClient(base_url=base_url, headers=headers)
+    else:
+        await database.init_database()
+        await seed()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://mini-app",
+                                   headers=headers)
+
+    etags = [{} for _ in range(CLIENTS)]
+    async with client:
+        await measure("cold scroll", client, etags)
+        await measure("revalidate", client, etags)
+
+    if not base_url:
+        await database.close_all_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(sys.argv[1] if len(sys.argv) > 1 else ""))
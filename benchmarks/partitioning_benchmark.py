@@ -0,0 +1,156 @@
+"""
+Search and insert latency of plain and partitioned memes table.
+Both layouts are built in their own schema of the database, with the same random memes.
+
+Usage: python benchmarks/partitioning_benchmark.py [memes_amount] [repeat]
+Database environment variables have to be set, database has to be migrated. Use a scratch database,
+seeding 10M memes with pgroonga indexes takes a while and a lot of disk.
+"""
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import create_engine, text, Engine
+
+from memes_db import partitioning
+from memes_db.config import DATABASE_URL
+from memes_db.search_query import build_search_query
+
+USERS_AMOUNT = 100_000
+PUBLIC_SHARE = 0.3
+SEED_BATCH = 1_000_000
+WORDS = ("cat dog кот собака meme мем funny смешно when you лицо face reaction реакция monday понедельник "
+         "work работа school школа bruh sad грустно happy радость dance танец music музыка lol").split()
+QUERIES = ["cat", "funny dog", "when you", "понедельник работа", "bruh"]
+
+LAYOUTS = {
+    "plain": """
+        CREATE TABLE memes (
+            id BIGSERIAL PRIMARY KEY,
+            creator_telegram_id BIGINT NOT NULL,
+            duration INTEGER NOT NULL,
+            telegram_media_id TEXT NOT NULL,
+            telegram_file_unique_id TEXT,
+            title TEXT NOT NULL,
+            tags TEXT[] DEFAULT '{}' NOT NULL,
+            media_type media_type NOT NULL,
+            is_public BOOLEAN NOT NULL
+        )
+    """,
+    "partitioned": f"""
+        CREATE SEQUENCE memes_id_seq;
+        CREATE TABLE memes (
+            id BIGINT NOT NULL DEFAULT nextval('memes_id_seq'),
+            creator_telegram_id BIGINT NOT NULL,
+            duration INTEGER NOT NULL,
+            telegram_media_id TEXT NOT NULL,
+            telegram_file_unique_id TEXT,
+            title TEXT NOT NULL,
+            tags TEXT[] DEFAULT '{{}}' NOT NULL,
+            media_type media_type NOT NULL,
+            is_public BOOLEAN NOT NULL,
+            PRIMARY KEY (id, is_public)
+        ) PARTITION BY LIST (is_public);
+        CREATE TABLE memes_public PARTITION OF memes FOR VALUES IN (TRUE);
+        CREATE TABLE memes_private PARTITION OF memes FOR VALUES IN (FALSE) PARTITION BY HASH (creator_telegram_id);
+        {"".join(f'''
+        CREATE TABLE memes_private_{remainder} PARTITION OF memes_private
+        FOR VALUES WITH (MODULUS {partitioning.PRIVATE_HASH_PARTITIONS}, REMAINDER {remainder});'''
+                 for remainder in range(partitioning.PRIVATE_HASH_PARTITIONS))}
+    """,
+}
+
+SEED = f"""
+    INSERT INTO memes (creator_telegram_id, duration, telegram_media_id, telegram_file_unique_id,
+                       title, tags, media_type, is_public)
+    SELECT 1 + (random() * ({USERS_AMOUNT} - 1))::bigint, 0, 'media' || i, 'file' || i,
+           w[1 + (random() * (n - 1))::int] || ' ' || w[1 + (random() * (n - 1))::int] || ' '
+               || w[1 + (random() * (n - 1))::int],
+           ARRAY[w[1 + (random() * (n - 1))::int]],
+           (ARRAY['audio', 'gif', 'photo', 'video', 'voice'])[1 + (random() * 4)::int]::media_type,
+           random() < {PUBLIC_SHARE}
+    FROM generate_series(:first, :last) AS i,
+         (SELECT CAST(:words AS text[]) AS w, cardinality(CAST(:words AS text[])) AS n) AS words
+"""
+
+INSERT = """
+    INSERT INTO memes (creator_telegram_id, duration, telegram_media_id, telegram_file_unique_id,
+                       title, tags, media_type, is_public)
+    VALUES (:user_id, 0, :file, :file, :title, ARRAY['benchmark'], 'photo', :is_public)
+"""
+
+
+def engine_for(layout: str) -> Engine:
+    return create_engine(DATABASE_URL, connect_args={"options": f"-c search_path=bench_{layout},public"})
+
+
+def seed(layout: str, memes_amount: int) -> None:
+    engine = engine_for(layout)
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS bench_{layout} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA bench_{layout}"))
+        conn.execute(text("CREATE TABLE users (telegram_id BIGINT PRIMARY KEY, is_banned BOOLEAN NOT NULL)"))
+        conn.execute(text(f"INSERT INTO users SELECT i, FALSE FROM generate_series(1, {USERS_AMOUNT}) AS i"))
+        conn.execute(text(LAYOUTS[layout]))
+
+    started = time.perf_counter()
+    for first in range(1, memes_amount + 1, SEED_BATCH):
+        with engine.begin() as conn:
+            conn.execute(text(SEED), {"first": first, "last": min(first + SEED_BATCH - 1, memes_amount),
+                                      "words": WORDS})
+    print(f"{layout:12} seeded in {time.perf_counter() - started:8.1f} s")
+
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        for name in partitioning.INDEXES:
+            conn.execute(text(partitioning.create_index_statement(name, "memes")))
+        conn.execute(text("CREATE INDEX users_banned_index ON users (telegram_id) WHERE is_banned"))
+        conn.execute(text("ANALYZE"))
+    print(f"{layout:12} indexed in {time.perf_counter() - started:8.1f} s")
+
+
+def report(label: str, timings: list[float]) -> None:
+    timings.sort()
+    print(f"{label:45} median {statistics.median(timings) * 1000:8.2f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95)] * 1000:8.2f} ms")
+
+
+def measure(layout: str, repeat: int) -> None:
+    engine = engine_for(layout)
+    with engine.connect() as conn:
+        for query in QUERIES:
+            timings = []
+            for _ in range(repeat):
+                user_id = random.randint(1, USERS_AMOUNT)
+                started = time.perf_counter()
+                conn.execute(build_search_query(query, user_id, limit=40)).fetchall()
+                timings.append(time.perf_counter() - started)
+            report(f"{layout} search {query!r}", timings)
+
+        for is_public in (True, False):
+            timings = []
+            for i in range(repeat):
+                started = time.perf_counter()
+                conn.execute(text(INSERT), {"user_id": random.randint(1, USERS_AMOUNT),
+                                            "file": f"bench-{is_public}-{i}-{time.time_ns()}",
+                                            "title": " ".join(random.choices(WORDS, k=3)),
+                                            "is_public": is_public})
+                conn.commit()
+                timings.append(time.perf_counter() - started)
+            report(f"{layout} insert {'public' if is_public else 'private'}", timings)
+
+
+def main(memes_amount: int, repeat: int) -> None:
+    for layout in LAYOUTS:
+        seed(layout, memes_amount)
+    for layout in LAYOUTS:
+        measure(layout, repeat)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 100)
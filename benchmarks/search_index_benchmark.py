@@ -0,0 +1,94 @@
+"""
+Memory and latency of in-process search index.
+
+Usage: python benchmarks/search_index_benchmark.py [memes_amount]
+If database environment variables are set, same queries are also run through pgroonga search.
+"""
+import asyncio
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+from os import getenv
+from pathlib import Path
+
+sys.path[:0] = [str(Path(__file__).parent.parent), str(Path(__file__).parent.parent / "bot_backend"),
+                str(Path(__file__).parent.parent / "bot_backend" / "src")]
+
+import database
+import search_index
+
+WORDS = ("cat dog кот собака meme мем funny смешно when you лицо face reaction реакция monday понедельник "
+         "work работа school школа bruh sad грустно happy радость dance танец music музыка lol").split()
+SYLLABLES = "ka ri to ma ne so lu pe vi da mo ку ра то ми не ло са ве ду".split()
+VOCABULARY_SIZE = 20000
+
+# Most common words go first
+VOCABULARY: list[str] = []
+CUMULATIVE_WEIGHTS: list[float] = []
+QUERIES: list[str] = []
+
+
+def random_word() -> str:
+    return "".join(random.choice(SYLLABLES) for _ in range(random.randint(2, 4)))
+
+
+def random_text(words_amount: int) -> str:
+    """Words follow zipf-like distribution, like in real titles"""
+    return " ".join(random.choices(VOCABULARY, cum_weights=CUMULATIVE_WEIGHTS, k=words_amount))
+
+
+def build(memes_amount: int) -> search_index.SearchIndex:
+    index = search_index.SearchIndex()
+    for meme_id in range(memes_amount):
+        index.add(meme_id, random_text(random.randint(2, 6)), [random_text(1) for _ in range(random.randint(0, 4))],
+                  "AgACAgIAAxkBAAIBY2Z" + str(meme_id), "AQADY2Z" + str(meme_id), random.choice(search_index.MEDIA_TYPES))
+    return index
+
+
+def measure(label: str, search, repeat: int = 20) -> None:
+    for query in QUERIES:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            search(query)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f"{label:10} {query!r:25} {elapsed * 1000:8.2f} ms")
+
+
+async def measure_database() -> None:
+    await database.init_database()
+    for query in QUERIES:
+        start = time.perf_counter()
+        for _ in range(20):
+            await database.search_for_meme_inline_by_query(query, 0)
+        print(f"{'pgroonga':10} {query!r:25} {(time.perf_counter() - start) / 20 * 1000:8.2f} ms")
+    await database.close_all_connections()
+
+
+def main():
+    memes_amount = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    random.seed(0)
+    VOCABULARY[:] = WORDS + [random_word() for _ in range(VOCABULARY_SIZE)]
+    CUMULATIVE_WEIGHTS[:] = itertools.accumulate(1 / rank for rank in range(1, len(VOCABULARY) + 1))
+    typo = VOCABULARY[7][:2] + VOCABULARY[7][3:]
+    QUERIES[:] = [VOCABULARY[0], f"{VOCABULARY[1]} {VOCABULARY[5]}", VOCABULARY[50], f"{VOCABULARY[2]} {VOCABULARY[700]}",
+                  typo, VOCABULARY[5000], "when you bruh"]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = build(memes_amount)
+    build_time = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"memes: {memes_amount}, build: {build_time:.2f} s, memory: {memory / 2 ** 20:.1f} MiB "
+          f"({memory / 2 ** 20 / memes_amount * 100_000:.1f} MiB per 100k memes)")
+    measure("index", lambda query: index.search(query, database.MEMES_IN_INLINE_LIST))
+
+    if getenv("POSTGRES_DB"):
+        asyncio.run(measure_database())
+
+
+if __name__ == "__main__":
+    main()
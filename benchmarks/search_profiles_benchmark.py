@@ -0,0 +1,174 @@
+"""
+Index size, build time, query latency and recall of every search profile of memes_db/search_profiles.py.
+
+Usage: python benchmarks/search_profiles_benchmark.py [memes_amount] [labels.json]
+Database environment variables have to be set. Every profile gets its own table in bench_search_profiles schema.
+Without labels, titles are generated from mixed russian and english words with known forms,
+and labeled queries are made from them: other forms of a word, first letters of a word as they are typed,
+words written together. labels.json is a list of {"query": ..., "relevant": [meme ids]}, then public memes
+of the database are searched instead, up to memes_amount of them.
+"""
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import create_engine, text, Connection
+
+from memes_db.config import DATABASE_URL
+from memes_db.index_maintenance import pgroonga_disk_usage
+from memes_db.search_profiles import PROFILES, create_index_statement
+
+SCHEMA = "bench_search_profiles"
+LIMIT = 20
+REPEAT = 20
+INSERT_BATCH = 50_000
+# Same conditions as title part of memes_db.search_query.SEARCH_CONDITION.
+# Tables here aren't partitioned, naming the index makes sure the profile's own index is used
+SEARCH = """
+    SELECT id FROM {table}
+    WHERE title &@ pgroonga_condition(:query, index_name => '{index}', fuzzy_max_distance_ratio => 0.34)
+       OR title &@~ pgroonga_condition(:or_query, index_name => '{index}', fuzzy_max_distance_ratio => 0.34)
+"""
+RANKED = SEARCH + " ORDER BY pgroonga_score(tableoid, ctid) DESC, id DESC LIMIT :limit"
+
+# Word -> its forms
+LEXICON = {
+    "кот": ["кот", "кота", "коту", "котом", "коты", "котов"],
+    "собака": ["собака", "собаки", "собаку", "собакой", "собак"],
+    "работа": ["работа", "работы", "работу", "работой"],
+    "понедельник": ["понедельник", "понедельника", "понедельники"],
+    "смешной": ["смешной", "смешная", "смешные", "смешного"],
+    "грустный": ["грустный", "грустная", "грустные"],
+    "школа": ["школа", "школы", "школу", "школе"],
+    "танец": ["танец", "танца", "танцы", "танцем"],
+    "cat": ["cat", "cats"],
+    "dog": ["dog", "dogs"],
+    "dance": ["dance", "dances", "dancing", "danced"],
+    "work": ["work", "works", "working", "worked"],
+    "meme": ["meme", "memes"],
+    "face": ["face", "faces"],
+    "reaction": ["reaction", "reactions"],
+    "monday": ["monday", "mondays"],
+}
+# Pairs that are sometimes written together or with a symbol between them
+PHRASES = [("when", "you"), ("bruh", "moment"), ("доброе", "утро")]
+WORD_OF_FORM = {form: word for word, forms in LEXICON.items() for form in forms}
+
+
+def generate_titles(amount: int) -> list[tuple[int, str, set[str], str]]:
+    """Rows of (id, title, words in title, joined phrase or "")"""
+    rows = []
+    forms = list(WORD_OF_FORM)
+    for meme_id in range(1, amount + 1):
+        title_forms = random.sample(forms, random.randint(1, 3))
+        parts = list(title_forms)
+        phrase = ""
+        if random.random() < 0.1:
+            first, second = random.choice(PHRASES)
+            phrase = f"{first} {second}"
+            parts.insert(random.randint(0, len(parts)), random.choice(["{} {}", "{}{}", "{}_{}", "{}-{}"])
+                         .format(first, second))
+        rows.append((meme_id, " ".join(parts), {WORD_OF_FORM[form] for form in title_forms}, phrase))
+    return rows
+
+
+def generate_labels(rows: list[tuple[int, str, set[str], str]]) -> list[dict]:
+    """Labeled queries of every kind, relevant memes are known from generated titles"""
+    labels = []
+    for word, forms in LEXICON.items():
+        relevant = [meme_id for meme_id, _, words, _ in rows if word in words]
+        for form in forms[1:3]:
+            labels.append({"kind": "other form", "query": form, "relevant": relevant})
+        prefix = word[:4]
+        labels.append({"kind": "prefix", "query": prefix,
+                       "relevant": [meme_id for meme_id, title, _, _ in rows
+                                    if any(part.startswith(prefix) for part in title.split())]})
+    for first, second in PHRASES:
+        phrase = f"{first} {second}"
+        labels.append({"kind": "written together", "query": f"{first}{second}",
+                       "relevant": [meme_id for meme_id, _, _, title_phrase in rows if title_phrase == phrase]})
+    return labels
+
+
+def create_tables(conn: Connection, memes_amount: int, labels_path: str) -> list[dict]:
+    conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+    conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    conn.execute(text(f"CREATE TABLE {SCHEMA}.titles (id BIGINT PRIMARY KEY, title TEXT NOT NULL)"))
+    if labels_path:
+        conn.execute(text(f"""
+            INSERT INTO {SCHEMA}.titles SELECT id, title FROM memes WHERE is_public ORDER BY id DESC LIMIT :limit
+        """), {"limit": memes_amount})
+        labels = json.loads(Path(labels_path).read_text())
+        for label in labels:
+            label.setdefault("kind", "labeled")
+    else:
+        rows = generate_titles(memes_amount)
+        for start in range(0, len(rows), INSERT_BATCH):
+            conn.execute(text(f"INSERT INTO {SCHEMA}.titles VALUES (:id, :title)"),
+                         [{"id": meme_id, "title": title} for meme_id, title, _, _ in rows[start:start + INSERT_BATCH]])
+        labels = generate_labels(rows)
+    for profile_name in PROFILES:
+        conn.execute(text(f"CREATE TABLE {SCHEMA}.memes_{profile_name} AS TABLE {SCHEMA}.titles"))
+    return labels
+
+
+def measure(conn: Connection, profile_name: str, labels: list[dict]) -> None:
+    table, index = f"{SCHEMA}.memes_{profile_name}", f"titles_{profile_name}_index"
+    started = time.perf_counter()
+    try:
+        conn.execute(text(create_index_statement(index, table, "title", PROFILES[profile_name])))
+    except Exception as e:
+        conn.rollback()
+        print(f"{profile_name:16} can't be built: {e.__class__.__name__}: {str(e).splitlines()[0]}")
+        return
+    build_time = time.perf_counter() - started
+    conn.execute(text(f"ANALYZE {table}"))
+    conn.commit()
+
+    timings = []
+    by_kind: dict[str, list[tuple[float, float]]] = {}
+    search, ranked = SEARCH.format(table=table, index=index), RANKED.format(table=table, index=index)
+    for label in labels:
+        params = {"query": label["query"], "or_query": " OR ".join(label["query"].split()), "limit": LIMIT}
+        for _ in range(REPEAT):
+            started = time.perf_counter()
+            conn.execute(text(ranked), params).fetchall()
+            timings.append(time.perf_counter() - started)
+        found = set(conn.scalars(text(search), params).all())
+        relevant = set(label["relevant"])
+        recall = len(found & relevant) / len(relevant) if relevant else 1.0
+        precision = len(found & relevant) / len(found) if found else float(not relevant)
+        by_kind.setdefault(label["kind"], []).append((recall, precision))
+
+    timings.sort()
+    size, _ = pgroonga_disk_usage(conn, f"{SCHEMA}.{index}")
+    print(f"{profile_name:16} index {size / 2 ** 20:8.1f} MiB, built in {build_time:7.2f} s, "
+          f"search median {statistics.median(timings) * 1000:6.2f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95)] * 1000:6.2f} ms")
+    for kind, scores in by_kind.items():
+        print(f"{'':16} {kind:18} recall {statistics.mean(score[0] for score in scores):6.1%}, "
+              f"precision {statistics.mean(score[1] for score in scores):6.1%}")
+
+
+def main(memes_amount: int, labels_path: str) -> None:
+    engine = create_engine(DATABASE_URL)
+    with engine.connect() as conn:
+        labels = create_tables(conn, memes_amount, labels_path)
+        # pgroonga_condition finds index_name through search path
+        conn.execute(text(f"SET search_path TO {SCHEMA}, public"))
+        conn.commit()
+        print(f"{memes_amount} memes, {len(labels)} labeled queries")
+        for profile_name in PROFILES:
+            measure(conn, profile_name, labels)
+        conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+        conn.commit()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000,
+         sys.argv[2] if len(sys.argv) > 2 else "")
@@ -0,0 +1,405 @@
+"""
+Scale and soak test of the bot's data access against a local pgroonga database.
+
+Thousands of simulated users upload, rename and delete memes, search inline and page through
+their memes menu for hours, with a day/night curve of traffic. Every interval the test records
+latency of every operation, pool usage, size and dead rows of memes table and its indexes,
+and memory of the bot process. Report is written as json, so runs of different commits can be compared.
+
+Usage:
+    python benchmarks/soak_test.py                      run with settings from SOAK_* environment variables
+    python benchmarks/soak_test.py compare OLD NEW      compare two reports
+Database environment variables have to be set, database has to be migrated. Use a scratch database,
+simulated users get ids from SOAK_USER_BASE and their memes are seeded up to SOAK_MEMES.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from os import getenv
+from pathlib import Path
+
+sys.path[:0] = [str(Path(__file__).parent.parent), str(Path(__file__).parent.parent / "bot_backend"),
+                str(Path(__file__).parent.parent / "bot_backend" / "src")]
+
+from sqlalchemy import text
+
+import change_feed
+import database
+import search_index
+from inline_query_parser import parse_inline_query
+from memes_db import engine as db_engine
+from memes_db.config import POOL_SIZE, POOL_MAX_OVERFLOW
+from memes_db.models import MediaType
+from src.tg_utilities import generators
+
+# Whole run and one reporting interval, seconds
+DURATION = float(getenv("SOAK_DURATION", "3600"))
+INTERVAL = float(getenv("SOAK_INTERVAL", "60"))
+# Length of simulated day, traffic is lowest at its start and end and highest in the middle
+DAY = float(getenv("SOAK_DAY", str(DURATION)))
+USERS = int(getenv("SOAK_USERS", "5000"))
+MEMES = int(getenv("SOAK_MEMES", "2000000"))
+# Operations per second at peak of the day, at night traffic is NIGHT_SHARE of it
+PEAK_RATE = float(getenv("SOAK_PEAK_RATE", "300"))
+NIGHT_SHARE = 0.2
+# Relative weights of operations
+MIX = {
+    name: float(weight) for name, weight in
+    (part.split(":") for part in getenv("SOAK_MIX", "search:75,page:12,upload:8,rename:3,delete:2").split(","))
+}
+# Search public memes in process, like bot does with IN_MEMORY_SEARCH
+IN_MEMORY_SEARCH = getenv("SOAK_SEARCH_INDEX", "") == "1"
+# Memory is read from this process, unless pid of a running bot is given
+BOT_PID = int(getenv("SOAK_BOT_PID", str(os.getpid())))
+USER_BASE = int(getenv("SOAK_USER_BASE", "9000000000000"))
+REPORTS_DIR = Path(getenv("SOAK_REPORTS_DIR", str(Path(__file__).parent / "results")))
+
+PUBLIC_SHARE = 0.3
+# Share of uploads that repeat a file uploaded earlier, so deduplication is exercised too
+DUPLICATE_SHARE = 0.05
+SEED_BATCH = 500_000
+WORDS = ("cat dog кот собака meme мем funny смешно when you лицо face reaction реакция monday понедельник "
+         "work работа school школа bruh sad грустно happy радость dance танец music музыка lol").split()
+MEDIA_TYPES = list(MediaType)
+
+# Latency histogram buckets, 0.1 ms to about 100 s, each 10% wider than previous
+BUCKETS = [0.0001 * 1.1 ** i for i in range(146)]
+
+SEED = f"""
+    INSERT INTO memes (creator_telegram_id, duration, telegram_media_id, telegram_file_unique_id,
+                       title, tags, media_type, is_public)
+    SELECT :user_base + (random() * (:users - 1))::bigint, 0, 'soak-media' || i, 'soak-file' || i,
+           w[1 + (random() * (n - 1))::int] || ' ' || w[1 + (random() * (n - 1))::int] || ' '
+               || w[1 + (random() * (n - 1))::int],
+           ARRAY[w[1 + (random() * (n - 1))::int]],
+           (ARRAY['audio', 'gif', 'photo', 'video', 'voice'])[1 + (random() * 4)::int]::media_type,
+           random() < {PUBLIC_SHARE}
+    FROM generate_series(:first, :last) AS i,
+         (SELECT CAST(:words AS text[]) AS w, cardinality(CAST(:words AS text[])) AS n) AS words
+    ON CONFLICT DO NOTHING
+"""
+
+# Memes table and all its partitions, works for both plain and partitioned layout
+TABLE_STATS = """
+    SELECT sum(pg_relation_size(tree.relid)) AS table_bytes,
+           sum(pg_indexes_size(tree.relid)) AS index_bytes,
+           sum(stats.n_live_tup) AS live_rows,
+           sum(stats.n_dead_tup) AS dead_rows
+    FROM pg_partition_tree('memes') AS tree
+    LEFT JOIN pg_stat_user_tables AS stats ON stats.relid = tree.relid
+"""
+
+
+class Histogram:
+    """Latency histogram of fixed size, so hours of samples don't grow memory of the test"""
+    __slots__ = ("counts", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.errors = 0
+
+    def add(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def merge(self, other: "Histogram") -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.errors += other.errors
+
+    def percentile(self, share: float) -> float:
+        total = sum(self.counts)
+        if not total:
+            return 0.0
+        wanted = share * total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return BUCKETS[min(i, len(BUCKETS) - 1)]
+        return BUCKETS[-1]
+
+    def summary(self) -> dict:
+        return {"count": sum(self.counts), "errors": self.errors,
+                "p50_ms": round(self.percentile(0.5) * 1000, 2),
+                "p95_ms": round(self.percentile(0.95) * 1000, 2),
+                "p99_ms": round(self.percentile(0.99) * 1000, 2)}
+
+
+@dataclass
+class SimulatedUser:
+    telegram_id: int
+    # Ids of own memes seen in menu, rename and delete pick from them
+    meme_ids: list[int] = field(default_factory=list)
+    page: int = 0
+
+
+@dataclass
+class Interval:
+    latencies: dict[str, Histogram] = field(default_factory=lambda: {name: Histogram() for name in MIX})
+    max_checked_out: int = 0
+    saturated_seconds: int = 0
+
+
+interval = Interval()
+totals = {name: Histogram() for name in MIX}
+recent_public_files: list[str] = []
+
+
+def random_title() -> str:
+    return " ".join(random.choices(WORDS, k=random.randint(1, 4)))
+
+
+def rate_at(elapsed: float) -> float:
+    """Operations per second at this moment of simulated day"""
+    daylight = (1 - math.cos(2 * math.pi * elapsed / DAY)) / 2
+    return PEAK_RATE * (NIGHT_SHARE + (1 - NIGHT_SHARE) * daylight)
+
+
+async def search(user: SimulatedUser) -> bool:
+    parsed_query = parse_inline_query(random_title())
+    if IN_MEMORY_SEARCH and search_index.is_ready():
+        rows = await search_index.search(parsed_query.text, user.telegram_id, database.MEMES_IN_INLINE_LIST,
+                                         parsed_query.media_type)
+    else:
+        rows = await database.search_for_meme_inline_by_query(parsed_query.text, user.telegram_id,
+                                                              parsed_query.tags, parsed_query.media_type)
+    await generators.generate_inline_list(rows)
+    return True
+
+
+async def page(user: SimulatedUser) -> bool:
+    memes = await database.get_all_user_memes(user.telegram_id)
+    user.meme_ids = [meme.id for meme in memes]
+    pages = max(1, math.ceil(len(memes) / generators.MEMES_PER_PAGE))
+    user.page = (user.page + 1) % pages
+    await generators.generate_inline_keyboard_page(memes, user.page, user.telegram_id)
+    return True
+
+
+async def upload(user: SimulatedUser) -> bool:
+    is_public = random.random() < PUBLIC_SHARE
+    if recent_public_files and random.random() < DUPLICATE_SHARE:
+        file_unique_id = random.choice(recent_public_files)
+    else:
+        file_unique_id = f"soak-{time.time_ns()}-{random.getrandbits(32)}"
+        if is_public:
+            recent_public_files.append(file_unique_id)
+            del recent_public_files[:-1000]
+    result = await database.add_meme(user.telegram_id, f"media-{file_unique_id}", random_title(),
+                                     random.sample(WORDS, random.randint(0, 3)), random.choice(MEDIA_TYPES),
+                                     0, is_public, file_unique_id)
+    return result != database.AddMemeResult.FAILED
+
+
+async def rename(user: SimulatedUser) -> bool:
+    if not user.meme_ids:
+        return await page(user)
+    return await database.rename_meme_and_check_user(random.choice(user.meme_ids), user.telegram_id,
+                                                     random_title())
+
+
+async def delete(user: SimulatedUser) -> bool:
+    if not user.meme_ids:
+        return await page(user)
+    meme_id = user.meme_ids.pop(random.randrange(len(user.meme_ids)))
+    return await database.delete_meme_check_and_check_user(meme_id, user.telegram_id)
+
+
+OPERATIONS = {"search": search, "page": page, "upload": upload, "rename": rename, "delete": delete}
+
+
+async def simulate_user(user: SimulatedUser, started: float) -> None:
+    names = list(MIX)
+    weights = [MIX[name] for name in names]
+    while (elapsed := time.perf_counter() - started) < DURATION:
+        # Every user acts on its own, together they make rate_at() operations per second
+        await asyncio.sleep(random.expovariate(rate_at(elapsed) / USERS))
+        name = random.choices(names, weights)[0]
+        operation_started = time.perf_counter()
+        try:
+            succeeded = await OPERATIONS[name](user)
+        except Exception:
+            succeeded = False
+        histogram = interval.latencies[name]
+        histogram.add(time.perf_counter() - operation_started)
+        if not succeeded:
+            histogram.errors += 1
+
+
+async def watch_pool() -> None:
+    capacity = POOL_SIZE + POOL_MAX_OVERFLOW
+    while True:
+        checked_out = db_engine.engine.pool.checkedout()
+        interval.max_checked_out = max(interval.max_checked_out, checked_out)
+        if checked_out >= capacity:
+            interval.saturated_seconds += 1
+        await asyncio.sleep(1)
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def table_stats() -> dict:
+    async with db_engine.engine.connect() as conn:
+        row = (await conn.execute(text(TABLE_STATS))).one()
+    return {key: int(value or 0) for key, value in row._mapping.items()}
+
+
+async def snapshot(elapsed: float) -> dict:
+    global interval
+    finished, interval = interval, Interval()
+    for name, histogram in finished.latencies.items():
+        totals[name].merge(histogram)
+    return {
+        "elapsed": round(elapsed),
+        "rate": round(rate_at(elapsed), 1),
+        "operations": {name: histogram.summary() for name, histogram in finished.latencies.items()},
+        "pool": {"max_checked_out": finished.max_checked_out, "saturated_seconds": finished.saturated_seconds},
+        "rss_bytes": rss_bytes(BOT_PID),
+        "caches": {"known_users": len(database.known_user_ids),
+                   "inline_results": len(generators._inline_results_cache)},
+        "memes": await table_stats(),
+    }
+
+
+def print_snapshot(row: dict) -> None:
+    operations = " ".join(f"{name} {stats['p95_ms']:.1f}" for name, stats in row["operations"].items())
+    print(f"{row['elapsed']:6d} s {row['rate']:6.0f} op/s  p95 ms: {operations}  "
+          f"pool {row['pool']['max_checked_out']}/{POOL_SIZE + POOL_MAX_OVERFLOW}  "
+          f"rss {row['rss_bytes'] / 2 ** 20:.0f} MiB  indexes {row['memes']['index_bytes'] / 2 ** 20:.0f} MiB  "
+          f"dead {row['memes']['dead_rows']}", flush=True)
+
+
+async def seed() -> None:
+    async with db_engine.engine.begin() as conn:
+        await conn.execute(text("""
+            INSERT INTO users (telegram_id) SELECT :user_base + i FROM generate_series(0, :users - 1) AS i
+            ON CONFLICT DO NOTHING
+        """), {"user_base": USER_BASE, "users": USERS})
+        existing = await conn.scalar(text("""
+            SELECT count(*) FROM memes WHERE creator_telegram_id BETWEEN :user_base AND :user_base + :users - 1
+        """), {"user_base": USER_BASE, "users": USERS})
+
+    started = time.perf_counter()
+    for first in range(existing + 1, MEMES + 1, SEED_BATCH):
+        async with db_engine.engine.begin() as conn:
+            await conn.execute(text(SEED), {"user_base": USER_BASE, "users": USERS, "words": WORDS,
+                                            "first": first, "last": min(first + SEED_BATCH - 1, MEMES)})
+        print(f"\rseeded {min(first + SEED_BATCH - 1, MEMES)} memes", end="", flush=True)
+    if existing < MEMES:
+        async with db_engine.engine.connect() as conn:
+            await conn.execute(text("ANALYZE memes"))
+        print(f" in {time.perf_counter() - started:.0f} s")
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        return "unknown"
+
+
+def summarize(intervals: list[dict]) -> dict:
+    """Whole run, and drift of p95 latency: last quarter of run against first quarter"""
+    quarter = max(1, len(intervals) // 4)
+
+    def mean_p95(rows: list[dict], name: str) -> float:
+        return sum(row["operations"][name]["p95_ms"] for row in rows) / len(rows)
+
+    hours = max(intervals[-1]["elapsed"] - intervals[0]["elapsed"], 1) / 3600 if intervals else 1
+    return {
+        "operations": {
+            name: {**totals[name].summary(),
+                   "p95_drift": round(mean_p95(intervals[-quarter:], name) / max(mean_p95(intervals[:quarter], name),
+                                                                                0.01), 2)}
+            for name in MIX
+        },
+        "pool_saturated_seconds": sum(row["pool"]["saturated_seconds"] for row in intervals),
+        "max_checked_out": max(row["pool"]["max_checked_out"] for row in intervals),
+        "rss_growth_mib_per_hour": round((intervals[-1]["rss_bytes"] - intervals[0]["rss_bytes"]) / 2 ** 20 / hours, 1),
+        "index_growth_mib": round((intervals[-1]["memes"]["index_bytes"] - intervals[0]["memes"]["index_bytes"])
+                                  / 2 ** 20, 1),
+        "index_bytes_per_row": round(intervals[-1]["memes"]["index_bytes"]
+                                     / max(intervals[-1]["memes"]["live_rows"], 1), 1),
+        "dead_rows": intervals[-1]["memes"]["dead_rows"],
+    }
+
+
+async def run() -> None:
+    logging.basicConfig(level=logging.WARNING)
+    unknown = set(MIX) - set(OPERATIONS)
+    if unknown:
+        raise ValueError(f"Unknown operations in SOAK_MIX: {', '.join(unknown)}")
+    started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    await database.init_database()
+    await seed()
+    if IN_MEMORY_SEARCH:
+        search_index.start()
+        await change_feed.start(database.CONNINFO)
+
+    started = time.perf_counter()
+    users = [SimulatedUser(USER_BASE + i) for i in range(USERS)]
+    workers = [asyncio.create_task(simulate_user(user, started)) for user in users]
+    pool_watcher = asyncio.create_task(watch_pool())
+
+    intervals = [await snapshot(0)]
+    while (elapsed := time.perf_counter() - started) < DURATION:
+        await asyncio.sleep(min(INTERVAL, DURATION - elapsed))
+        intervals.append(await snapshot(time.perf_counter() - started))
+        print_snapshot(intervals[-1])
+
+    await asyncio.gather(*workers)
+    pool_watcher.cancel()
+    # First snapshot was taken before any operation
+    report = {
+        "commit": current_commit(),
+        "started": started_at,
+        "settings": {"duration": DURATION, "day": DAY, "users": USERS, "memes": MEMES, "peak_rate": PEAK_RATE,
+                     "mix": MIX, "in_memory_search": IN_MEMORY_SEARCH,
+                     "pool": {"size": POOL_SIZE, "max_overflow": POOL_MAX_OVERFLOW}},
+        "summary": summarize(intervals[1:]),
+        "intervals": intervals,
+    }
+    REPORTS_DIR.mkdir(parents=True, exist_ok=True)
+    path = REPORTS_DIR / f"soak-{report['commit']}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    path.write_text(json.dumps(report, indent=1, ensure_ascii=False))
+    print(f"Report written to {path}")
+
+    if IN_MEMORY_SEARCH:
+        await change_feed.stop()
+    await database.close_all_connections()
+
+
+def compare(old_path: str, new_path: str) -> None:
+    old, new = (json.loads(Path(path).read_text()) for path in (old_path, new_path))
+    print(f"{'':28} {old['commit']:>12} {new['commit']:>12}")
+    for name in new["summary"]["operations"]:
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "p95_drift", "errors"):
+            old_value = old["summary"]["operations"].get(name, {}).get(metric, "-")
+            print(f"{name + ' ' + metric:28} {old_value:>12} {new['summary']['operations'][name][metric]:>12}")
+    for metric in ("pool_saturated_seconds", "max_checked_out", "rss_growth_mib_per_hour", "index_growth_mib",
+                   "index_bytes_per_row", "dead_rows"):
+        print(f"{metric:28} {old['summary'].get(metric, '-'):>12} {new['summary'][metric]:>12}")
+    if old["settings"] != new["settings"]:
+        print("Warning: reports were made with different settings")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "compare":
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        asyncio.run(run())
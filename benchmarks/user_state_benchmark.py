@@ -0,0 +1,95 @@
+"""
+Memory of per user bot state for many active users: upload drafts in user_data,
+meme menus and idle state eviction.
+
+Usage: python benchmarks/user_state_benchmark.py [users_amount]
+"""
+import asyncio
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path[:0] = [str(Path(__file__).parent.parent), str(Path(__file__).parent.parent / "bot_backend"),
+                str(Path(__file__).parent.parent / "bot_backend" / "src")]
+
+from telegram.ext import Application
+
+import user_state
+from src.constants import (MEME_NAME, MEME_PUBLIC, MEDIA_TYPE, TAGS, TELEGRAM_MEDIA_ID, TELEGRAM_FILE_UNIQUE_ID,
+                           DURATION, LAST_UPLOAD_TIME)
+from src.tg_utilities.classes import MemeMenu
+
+UPLOAD_KEYS = (TELEGRAM_MEDIA_ID, TELEGRAM_FILE_UNIQUE_ID, MEME_NAME, TAGS, MEDIA_TYPE, DURATION, MEME_PUBLIC)
+
+
+class DictMemeMenu:
+    """MemeMenu without __slots__"""
+    def __init__(self, chat_id, text_message_id, media_message_id=None):
+        self.chat_id = chat_id
+        self.text_message_id = text_message_id
+        self.media_message_id = media_message_id
+
+
+def measure(label: str, users_amount: int, build) -> object:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{label:45} {size / 2 ** 20:8.2f} MiB, {size / users_amount:6.0f} B per user")
+    return built
+
+
+def finished_uploads_reset_to_none(users_amount: int) -> dict:
+    """user_data after upload, when draft keys were set to None instead of removed"""
+    user_data = {}
+    for user_id in range(users_amount):
+        data = {key: None for key in UPLOAD_KEYS}
+        data[LAST_UPLOAD_TIME] = time.time()
+        user_data[user_id] = data
+    return user_data
+
+
+def finished_uploads_popped(users_amount: int) -> dict:
+    user_data = {}
+    for user_id in range(users_amount):
+        user_data[user_id] = {LAST_UPLOAD_TIME: time.time()}
+    return user_data
+
+
+async def measure_eviction(users_amount: int) -> None:
+    application = Application.builder().token("1:benchmark").build()
+    for user_id in range(users_amount):
+        application.user_data[user_id][LAST_UPLOAD_TIME] = time.time()
+
+    evictor = user_state.IdleStateEvictor(ttl=60, max_users=users_amount // 2)
+    measure("evictor tracking", users_amount,
+            lambda: [evictor.touch(user_id, user_id) for user_id in range(users_amount)])
+
+    start = time.perf_counter()
+    dropped = await evictor.evict(application)
+    print(f"{'evict over cap':45} {(time.perf_counter() - start) * 1000:8.2f} ms, "
+          f"{dropped} dropped, {len(application.user_data)} users left")
+
+    evictor.ttl = 0
+    start = time.perf_counter()
+    dropped = await evictor.evict(application)
+    print(f"{'evict all idle':45} {(time.perf_counter() - start) * 1000:8.2f} ms, "
+          f"{dropped} dropped, {len(application.user_data)} users left")
+
+
+def main(users_amount: int) -> None:
+    measure("user_data, draft keys set to None", users_amount,
+            lambda: finished_uploads_reset_to_none(users_amount))
+    measure("user_data, draft keys removed", users_amount,
+            lambda: finished_uploads_popped(users_amount))
+    measure("meme menus without __slots__", users_amount,
+            lambda: [DictMemeMenu(user_id, user_id, user_id) for user_id in range(users_amount)])
+    measure("meme menus with __slots__", users_amount,
+            lambda: [MemeMenu(user_id, user_id, user_id) for user_id in range(users_amount)])
+    asyncio.run(measure_eviction(users_amount))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -1,5 +1,10 @@
+import startup_timing
+import asyncio
+import re
+import signal
 import time
-from typing import Final
+from functools import partial
+from typing import Final, Optional
 
 from dotenv import load_dotenv
 from os import getenv
@@ -9,7 +14,8 @@ import traceback
 
 from telegram import (Update,
                       ReplyKeyboardMarkup,
-                      ReplyKeyboardRemove)
+                      ReplyKeyboardRemove,
+                      ForceReply)
 
 from telegram.ext import (
     Application,
@@ -19,26 +25,47 @@ from telegram.ext import (
     MessageHandler,
     filters,
     InlineQueryHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop
 )
-from models import MediaType
+from memes_db.models import MediaType
 
 import logging
 
 import database
+import change_feed
+import user_state
+from profiler import profiler, PROFILE_DIR
+import query_log
+import upload_queue
+from memes_db.unit_of_work import shared_session
 
 
 from tg_utilities.generators import (generate_inline_list,
                                      generate_inline_keyboard_page,
                                      generate_meme_controls,
                                      generate_yes_no_for_meme_deletion,
-                                     generate_back_button)
-from src.tg_utilities.menu_manager import create_or_update_menu
-
-from src.constants import (MEME_NAME, MEME_PUBLIC, MEDIA_TYPE, TAGS, TELEGRAM_MEDIA_ID, DURATION,
-                           LAST_SELECTED_PAGE, CALLBACK_MEME, CALLBACK_PAGE, CALLBACK_BACK, CALLBACK_DELETE,
-                           CALLBACK_RENAME, CALLBACK_CONFIRM_DELETE, RENAMING_MEME_ID, LAST_UPLOAD_TIME,
-                            UPLOAD_COOLDOWN, MAX_TAGS, MAX_TEXT_LENGTH)
+                                     generate_back_button,
+                                     generate_collections_choice,
+                                     forget_inline_results, forget_all_inline_results,
+                                     count_cached_inline_results,
+                                     generate_yes_no_for_bulk_deletion,
+                                     get_page)
+from src.tg_utilities.menu_manager import send_menu, update_menu
+from src.tg_utilities.callback_data import MenuState, decode_callback, selection_fingerprint
+from src.inline_query_parser import (parse_inline_query, normalize_tag, normalize_collection_name,
+                                     resolve_collections, ParsedQuery)
+
+from src.constants import (MEME_NAME, MEME_PUBLIC, MEDIA_TYPE, TAGS, TELEGRAM_MEDIA_ID, TELEGRAM_FILE_UNIQUE_ID, DURATION,
+                           CALLBACK_MEME, CALLBACK_PAGE, CALLBACK_BACK, CALLBACK_DELETE,
+                           CALLBACK_RENAME, CALLBACK_CONFIRM_DELETE, CALLBACK_COLLECTIONS, CALLBACK_ADD_TO_COLLECTION,
+                           CALLBACK_SELECT, CALLBACK_TOGGLE, CALLBACK_SELECT_PAGE, CALLBACK_BULK_DELETE,
+                           CALLBACK_BULK_CONFIRM_DELETE, CALLBACK_BULK_ADD_TAG, CALLBACK_BULK_REMOVE_TAG,
+                           CALLBACK_BULK_PUBLIC, CALLBACK_BULK_PRIVATE, MAX_SELECTED_MEMES,
+                           SHARE_COLLECTION_START, LAST_UPLOAD_TIME,
+                            UPLOAD_COOLDOWN, MAX_TAGS, MAX_TEXT_LENGTH, INLINE_CACHE_TIME_PUBLIC,
+                           INLINE_CACHE_TIME_PERSONAL, TAG_SUGGESTIONS_AMOUNT)
 
 
 logging.basicConfig(
@@ -51,6 +78,30 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 BOT_TOKEN: Final = getenv("BOT_KEY")
 BOT_USERNAME: Final = getenv("BOT_NAME")
+# Keep public memes in memory and search them without database
+IN_MEMORY_SEARCH: Final = getenv("IN_MEMORY_SEARCH", "false").lower() in ("1", "true", "yes")
+# Imported by start_db only if IN_MEMORY_SEARCH is on
+search_index = None
+# user_data and chat_data of users who didn't write for that long are dropped
+USER_STATE_TTL: Final = float(getenv("USER_STATE_TTL", 6 * 60 * 60))
+USER_STATE_MAX_USERS: Final = int(getenv("USER_STATE_MAX_USERS", 100_000))
+USER_STATE_EVICT_INTERVAL: Final = 60
+# Telegram ids of users allowed to use admin commands, separated by commas
+ADMIN_IDS: Final = [int(admin_id) for admin_id in getenv("ADMIN_IDS", "").split(",") if admin_id.strip()]
+# Updates slower than that get profiled, see profiler.py. Off if not set
+SLOW_UPDATE_PROFILE_MS: Final = getenv("SLOW_UPDATE_PROFILE_MS")
+# Share of inline queries written to inline query log, 0 turns log off
+QUERY_LOG_SAMPLE_RATE: Final = float(getenv("QUERY_LOG_SAMPLE_RATE", 0.1))
+# Most frequent queries that are searched on startup to warm up caches
+WARM_UP_QUERIES: Final = int(getenv("WARM_UP_QUERIES", 100))
+# Nobody has this id, so warm up searches see only public memes
+WARM_UP_USER_ID: Final = 0
+# Upload workers of this process, see upload_queue.py
+UPLOAD_WORKERS: Final = int(getenv("UPLOAD_WORKERS", 2))
+inline_warm_up_task: Optional[asyncio.Task] = None
+idle_state_evictor = user_state.IdleStateEvictor(ttl=USER_STATE_TTL, max_users=USER_STATE_MAX_USERS)
+
+startup_timing.mark("imports")
 
 # MEME, NAME, DECIDE_USE_TAGS_OR_NO, HANDLE_TAGS, DECIDE_PUBLIC_OR_NO = map(chr, range(5))
 #
@@ -68,6 +119,12 @@ ENTER_NEW_NAME = chr(9)
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
+
+    # Opened link that shares collection
+    if context.args and context.args[0].startswith(SHARE_COLLECTION_START):
+        await save_shared_collection(update, context.args[0][len(SHARE_COLLECTION_START):])
+        return
+
     success = await database.add_user_to_database(user_id)
     if success:
         await update.message.reply_text("Hey! To use just mention me @MemeSender_Bot in your message. Send me your meme using /add command if you want to add your own meme. Please report any issues you encounter here https://github.com/pixol20/MemeSender/issues")
@@ -75,26 +132,79 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.message.reply_text("It seems that something failed. Please report this to the developer")
 
 
+async def save_shared_collection(update: Update, collection_id: str) -> None:
+    if not collection_id.isdigit():
+        await update.message.reply_text("❌ this link is broken")
+        return
+
+    collection = await database.save_collection(int(collection_id), update.message.from_user.id)
+    if collection:
+        await update.message.reply_text(f"Collection {collection.title} saved. "
+                                        f"Search in it with @{normalize_collection_name(collection.title)} in inline query")
+    else:
+        await update.message.reply_text("❌ this collection doesn't exist or is private")
+
+
+def get_share_link(collection_id: int) -> str:
+    return f"https://t.me/{BOT_USERNAME}?start={SHARE_COLLECTION_START}{collection_id}"
+
+
+async def new_collection_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Creates collection with title from command arguments"""
+    title = " ".join(context.args or []).strip()
+    if not title:
+        await update.message.reply_text("Usage: /new_collection <title>")
+        return
+    if len(title) > MAX_TEXT_LENGTH:
+        await update.message.reply_text("❌ the title is too long")
+        return
+
+    collection = await database.create_collection(update.message.from_user.id, title)
+    if collection:
+        await update.message.reply_text(f"Collection {title} created. Add memes to it from /memes menu and share it "
+                                        f"with this link: {get_share_link(collection.id)}")
+    else:
+        await update.message.reply_text("Something failed")
+
+
+async def collections_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Lists saved collections with their share links"""
+    collections = await database.get_saved_collections(update.message.from_user.id)
+    if not collections:
+        await update.message.reply_text("You have no collections. Create one with /new_collection <title>")
+        return
+
+    lines = [f"@{normalize_collection_name(title)} — {get_share_link(collection_id)}"
+             for collection_id, title in collections]
+    await update.message.reply_text("Your collections, search in them with @name in inline query:\n" + "\n".join(lines))
+
+
 async def add_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     """Prompts user to send meme"""
     await update.message.reply_text("Send your meme")
     return UPLOAD_MEME_MEDIA
 
+UPLOAD_RESULT_MESSAGES = {
+    database.AddMemeResult.ADDED: "Meme uploaded",
+    database.AddMemeResult.MERGED: "This meme is already public, your tags were added to it",
+    database.AddMemeResult.DUPLICATE: "You already have this meme",
+    database.AddMemeResult.FAILED: "Something failed",
+}
+
+ENQUEUE_RESULT_MESSAGES = {
+    database.EnqueueResult.QUEUED: "Uploading meme, I'll message you when it's done",
+    database.EnqueueResult.ALREADY_QUEUED: "This meme is already being uploaded",
+    database.EnqueueResult.FAILED: "Something failed",
+}
+
 def reset_current_upload_data(user_data):
     """Resets all current meme upload related data"""
-    user_data[TELEGRAM_MEDIA_ID] = None
-    user_data[MEME_NAME] = None
-    user_data[TAGS] = None
-    user_data[MEDIA_TYPE] = None
-    user_data[DURATION] = None
-    user_data[MEME_PUBLIC] = None
-
-def reset_current_edit_data(user_data):
-    user_data[RENAMING_MEME_ID] = None
+    for key in (TELEGRAM_MEDIA_ID, TELEGRAM_FILE_UNIQUE_ID, MEME_NAME, TAGS, MEDIA_TYPE, DURATION, MEME_PUBLIC):
+        user_data.pop(key, None)
 
 async def handle_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
-    Sends user's meme to the database
+    Queues user's meme for upload workers, they add it to the database and message user when it's done
     Args:
         update: Update object from python-telegram-bot
         context: Context object from python-telegram-bot
@@ -112,29 +222,41 @@ async def handle_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> b
             await update.message.reply_text(f"Please wait {UPLOAD_COOLDOWN} seconds between meme uploads")
             return False
 
+    if user_data.get(TELEGRAM_MEDIA_ID) is None or user_data.get(MEME_NAME) is None:
+        # Draft was dropped while user was idle
+        await update.message.reply_text("Upload expired, start again with /add", reply_markup=ReplyKeyboardRemove())
+        reset_current_upload_data(user_data)
+        return False
+
     logger.info("User %s uploading meme: %s", update.message.from_user.first_name,
                 context.user_data[MEME_NAME])
 
-    await update.message.reply_text("Uploading meme", reply_markup=ReplyKeyboardRemove())
     try:
-        is_successful = await database.add_meme(user_id=user_id, telegram_media_id=user_data[TELEGRAM_MEDIA_ID],
-                                                name=user_data[MEME_NAME], tags=user_data[TAGS],
-                                                media_type=user_data[MEDIA_TYPE], duration=user_data[DURATION],
-                                                is_public=user_data[MEME_PUBLIC])
+        result = await database.enqueue_upload(user_id=user_id, chat_id=update.effective_chat.id,
+                                               telegram_media_id=user_data[TELEGRAM_MEDIA_ID],
+                                               name=user_data[MEME_NAME], tags=user_data.get(TAGS, []),
+                                               media_type=user_data[MEDIA_TYPE], duration=user_data.get(DURATION, 0),
+                                               is_public=user_data.get(MEME_PUBLIC, False),
+                                               telegram_file_unique_id=user_data.get(TELEGRAM_FILE_UNIQUE_ID))
     except Exception as e:
-        is_successful = False
-        logger.error(f"Error while uploading meme: {str(e)}")
+        result = database.EnqueueResult.FAILED
+        logger.error(f"Error while queueing meme upload: {str(e)}")
         logger.error("Stack Trace:\n" + traceback.format_exc())
 
+    is_successful = result != database.EnqueueResult.FAILED
     if is_successful:
         context.user_data[LAST_UPLOAD_TIME] = time.time()
-        await update.message.reply_text("Meme uploaded")
-    else:
-        await update.message.reply_text("Something failed")
+        upload_queue.job_added()
+    await update.message.reply_text(ENQUEUE_RESULT_MESSAGES[result], reply_markup=ReplyKeyboardRemove())
 
     reset_current_upload_data(user_data)
     return is_successful
 
+async def notify_upload_finished(application: Application, chat_id: int, title: str,
+                                 result: database.AddMemeResult) -> None:
+    """Follow-up message of upload that was processed by upload worker"""
+    await application.bot.send_message(chat_id, f"{title}: {UPLOAD_RESULT_MESSAGES[result]}")
+
 async def upload_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     message = update.message
     media = None
@@ -165,6 +287,7 @@ async def upload_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str
     if media:
         context.user_data[MEDIA_TYPE] = media_type
         context.user_data[TELEGRAM_MEDIA_ID] = media.file_id
+        context.user_data[TELEGRAM_FILE_UNIQUE_ID] = media.file_unique_id
         context.user_data[DURATION] = duration
 
 
@@ -196,7 +319,8 @@ async def decide_use_tags_or_no(update: Update, context: ContextTypes.DEFAULT_TY
     user_data[TAGS] = []
 
     if update.message.text == "Yes✅":
-        await update.message.reply_text("Input tags one per message(up to 20), /finish_tags to finish",
+        await update.message.reply_text("Input tags one per message(up to 20), /finish_tags to finish. "
+                                        "Later you can filter by tag in inline search like #cat",
                                         reply_markup=ReplyKeyboardRemove())
         return HANDLE_TAGS
     else:
@@ -213,18 +337,31 @@ async def decide_use_tags_or_no(update: Update, context: ContextTypes.DEFAULT_TY
 async def handle_tags(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     """Retrieves user tags separated by messages"""
     user_input = update.message.text
-    processed_user_input = user_input.strip()
+    processed_user_input = normalize_tag(user_input)
 
     if len(processed_user_input) > MAX_TEXT_LENGTH:
         await update.message.reply_text("❌ the tag is too long")
         return HANDLE_TAGS
 
-    if len(context.user_data[TAGS]) >= MAX_TAGS:
+    tags = context.user_data.setdefault(TAGS, [])
+    if len(tags) >= MAX_TAGS:
         await update.message.reply_text("❌ too much tags")
         return HANDLE_TAGS
 
-    context.user_data[TAGS].append(processed_user_input)
-    await update.message.reply_text("✅")
+    if processed_user_input and processed_user_input not in tags:
+        tags.append(processed_user_input)
+
+    # Suggest existing tags that start with what user typed, so same things get same tags
+    suggestions = [tag for tag in await database.suggest_tags(processed_user_input, limit=TAG_SUGGESTIONS_AMOUNT + 1)
+                   if tag not in tags][:TAG_SUGGESTIONS_AMOUNT]
+    if suggestions:
+        await update.message.reply_text(
+            "✅ Popular similar tags:",
+            reply_markup=ReplyKeyboardMarkup([[tag] for tag in suggestions], one_time_keyboard=True,
+                                             input_field_placeholder="Next tag")
+        )
+    else:
+        await update.message.reply_text("✅", reply_markup=ReplyKeyboardRemove())
     return HANDLE_TAGS
 
 
@@ -279,11 +416,40 @@ async def command_in_wrong_place(update: Update, context: ContextTypes.DEFAULT_T
     )
 
     reset_current_upload_data(context.user_data)
-    reset_current_edit_data(context.user_data)
 
     return ConversationHandler.END
 
 
+async def search_inline(parsed_query: ParsedQuery, user_id: int,
+                        collection_ids: Optional[list[int]]) -> tuple[Optional[list], str]:
+    """Search memes for inline query. Returns memes and where they came from: index or database"""
+    # Index doesn't know exact tags or collections and can't list memes without text,
+    # such queries go to the database
+    if (IN_MEMORY_SEARCH and search_index.is_ready() and parsed_query.text
+            and not parsed_query.tags and collection_ids is None):
+        return await search_index.search(parsed_query.text, user_id, database.MEMES_IN_INLINE_LIST,
+                                         parsed_query.media_type), "index"
+    return await database.search_for_meme_inline_by_query(parsed_query.text, user_id, parsed_query.tags,
+                                                          parsed_query.media_type, collection_ids), "database"
+
+async def warm_up_inline_results() -> None:
+    """
+    Search most frequent inline queries, so after deploy their results are already built
+    and database has their pages in memory
+    """
+    try:
+        queries = await database.get_top_inline_queries(WARM_UP_QUERIES)
+        for query in queries:
+            parsed_query = parse_inline_query(query)
+            if parsed_query.is_empty() or parsed_query.collection is not None:
+                continue
+            db_response, _ = await search_inline(parsed_query, WARM_UP_USER_ID, None)
+            await generate_inline_list(db_response)
+    except Exception as e:
+        logger.error(f"Error while warming up inline results: {e}")
+        return
+    logger.info(f"Warmed up inline results of {len(queries)} top queries")
+
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.inline_query.query
 
@@ -291,158 +457,254 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not query:  # empty query should not be handled
         return
 
-    processed_query = query.strip()
-    db_response = await database.search_for_meme_inline_by_query(processed_query, user_id)
+    parsed_query = parse_inline_query(query)
+    if parsed_query.is_empty():
+        return
+
+    collection_ids = None
+    if parsed_query.collection is not None:
+        saved_collections = await database.get_saved_collections(user_id)
+        collection_ids = resolve_collections(parsed_query.collection, saved_collections)
+        if not collection_ids:
+            await update.inline_query.answer([], cache_time=INLINE_CACHE_TIME_PERSONAL, is_personal=True)
+            return
+
+    started = time.perf_counter()
+    db_response, tier = await search_inline(parsed_query, user_id, collection_ids)
+    cached_results = count_cached_inline_results(meme.id for meme in db_response or [])
     results = await generate_inline_list(db_response)
+    # Collection names are personal, such queries aren't logged
+    if collection_ids is None:
+        query_log.record(query, len(results), time.perf_counter() - started, tier, cached_results)
+
+    # Answer is never shared between users, answer of user without private memes would hide private memes
+    # of others. It's cached longer only when nothing of it depends on user's private memes or collections
+    long_cache = collection_ids is None and database.has_no_private_memes(user_id)
+    cache_time = INLINE_CACHE_TIME_PUBLIC if long_cache else INLINE_CACHE_TIME_PERSONAL
+
+    await update.inline_query.answer(results, cache_time=cache_time, is_personal=True)
+
+RENAME_PROMPT = "✏️ Send new name for {title} in reply to this message (meme #{meme_id})"
+RENAME_PROMPT_PATTERN = re.compile(r"\(meme #(\d+)\)$")
+BULK_TAG_PROMPT = "🏷️ Send tag to {action} {amount} selected memes in reply to this message ({action} tag)"
+BULK_TAG_PROMPT_PATTERN = re.compile(r"\((add|remove) tag\)$")
 
-    await update.inline_query.answer(results, cache_time=4)
 
 async def user_get_memes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     user_id = update.message.from_user.id
     chat_id = update.message.chat_id
 
     memes = await database.get_all_user_memes(user_id)
+    await database.clear_selected_memes(user_id)
 
-    keyboard = await generate_inline_keyboard_page(memes, 0)
-    context.user_data[LAST_SELECTED_PAGE] = 0
+    keyboard = await generate_inline_keyboard_page(memes, 0, chat_id)
 
-    await create_or_update_menu(context=context,
-                                chat_id=chat_id,
-                                text="choose meme: ",
-                                reply_markup=keyboard,
-                                delete_media=True,
-                                destroy_menu=True)
+    await send_menu(context=context,
+                    chat_id=chat_id,
+                    text="choose meme: ",
+                    reply_markup=keyboard)
     return MEME_LIST
 
 
+async def get_menu_state(update: Update) -> Optional[MenuState]:
+    """Answer callback query and restore menu state from its data. None if data can't be trusted"""
+    query = update.callback_query
+    state = decode_callback(query.data, query.message.chat.id)
+    if state is None:
+        await query.answer("This menu is outdated, use /memes to get new one")
+    else:
+        await query.answer()
+    return state
+
+
 async def meme_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     query = update.callback_query
-    query_text = query.data
     user_id = query.from_user.id
     chat_id = query.message.chat.id
 
-    await query.answer()
-    memes = await database.get_all_user_memes(user_id)
+    state = await get_menu_state(update)
+    if state is None:
+        return MEME_LIST
 
-    selected_page = int(query_text[5:])
-    context.user_data[LAST_SELECTED_PAGE] = selected_page
+    memes = await database.get_all_user_memes(user_id)
 
-    keyboard = await generate_inline_keyboard_page(memes, selected_page)
+    keyboard = await generate_inline_keyboard_page(memes, state.page, chat_id)
 
-    await create_or_update_menu(context=context,
-                                chat_id=chat_id,
-                                text="choose meme: ",
-                                reply_markup=keyboard,
-                                delete_media=True)
+    await update_menu(context=context,
+                      chat_id=chat_id,
+                      text_message_id=query.message.message_id,
+                      state=state,
+                      text="choose meme: ",
+                      reply_markup=keyboard,
+                      delete_media=True)
     return MEME_LIST
 
 
 async def get_meme_control(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     query = update.callback_query
-    query_text = query.data
     user_id = query.from_user.id
     chat_id = query.message.chat.id
-    selected_meme = int(query_text[5:])
 
-    await query.answer()
-    meme = await database.get_meme_by_id_and_check_user(selected_meme, user_id)
+    state = await get_menu_state(update)
+    if state is None:
+        return CHOOSE_MEME_ACTION
+
+    meme = await database.get_meme_by_id_and_check_user(state.meme_id, user_id)
     if meme:
-        meme_controls = await generate_meme_controls(meme)
-
-        await create_or_update_menu(context=context,
-                                    chat_id=chat_id,
-                                    text=meme.title,
-                                    delete_media=False,
-                                    new_meme=meme,
-                                    reply_markup=meme_controls)
+        await update_menu(context=context,
+                          chat_id=chat_id,
+                          text_message_id=query.message.message_id,
+                          state=state,
+                          text=meme.title,
+                          keyboard_factory=lambda new_state: generate_meme_controls(new_state, chat_id),
+                          new_meme=meme)
     return CHOOSE_MEME_ACTION
 
 
 async def delete_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     query = update.callback_query
-    query_text = query.data
     user_id = query.from_user.id
     chat_id = query.message.chat.id
 
-    await query.answer()
+    state = await get_menu_state(update)
+    if state is None:
+        return CONFIRM_DELETE
 
-    meme_id = int(query_text[5:])
-    meme = await database.get_meme_by_id_and_check_user(meme_id=meme_id, user_telegram_id=user_id)
+    meme = await database.get_meme_by_id_and_check_user(meme_id=state.meme_id, user_telegram_id=user_id)
 
     if meme:
-        buttons = await generate_yes_no_for_meme_deletion(meme)
-
-        await create_or_update_menu(context=context,
-                                    chat_id=chat_id,
-                                    text=f"Are you sure you want to delete {meme.title}",
-                                    delete_media=True,
-                                    reply_markup=buttons)
+        await update_menu(context=context,
+                          chat_id=chat_id,
+                          text_message_id=query.message.message_id,
+                          state=state,
+                          text=f"Are you sure you want to delete {meme.title}",
+                          keyboard_factory=lambda new_state: generate_yes_no_for_meme_deletion(new_state, chat_id),
+                          delete_media=True)
     return CONFIRM_DELETE
 
 
 async def confirm_delete_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     query = update.callback_query
-    query_text = query.data
     user_id = query.from_user.id
     chat_id = query.message.chat.id
 
-    await query.answer()
+    state = await get_menu_state(update)
+    if state is None:
+        return MEME_LIST
 
-    meme_id = int(query_text[5:])
-    successful = await database.delete_meme_check_and_check_user(meme_id=meme_id, user_telegram_id=user_id)
+    successful = await database.delete_meme_check_and_check_user(meme_id=state.meme_id, user_telegram_id=user_id)
     if successful:
-        back_button = await generate_back_button()
-
-        await create_or_update_menu(context=context,
-                                    chat_id=chat_id,
-                                    text="Meme deleted",
-                                    delete_media=True,
-                                    reply_markup=back_button)
+        await update_menu(context=context,
+                          chat_id=chat_id,
+                          text_message_id=query.message.message_id,
+                          state=state.with_changes(meme_id=0),
+                          text="Meme deleted",
+                          keyboard_factory=lambda new_state: generate_back_button(new_state, chat_id),
+                          delete_media=True)
     else:
         await context.bot.sendMessage(text="Something failed", chat_id=chat_id)
 
     return MEME_LIST
 
-async def rename_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+async def choose_collection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     query = update.callback_query
-    query_text = query.data
     user_id = query.from_user.id
     chat_id = query.message.chat.id
 
-    await query.answer()
+    state = await get_menu_state(update)
+    if state is None:
+        return CHOOSE_MEME_ACTION
+
+    collections = await database.get_user_created_collections(user_id)
+    text = "Choose collection: " if collections else "You have no collections. Create one with /new_collection <title>"
+    await update_menu(context=context,
+                      chat_id=chat_id,
+                      text_message_id=query.message.message_id,
+                      state=state,
+                      text=text,
+                      keyboard_factory=lambda new_state: generate_collections_choice(collections, new_state, chat_id))
+    return CHOOSE_MEME_ACTION
+
+
+async def add_to_collection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    query = update.callback_query
+    user_id = query.from_user.id
+    chat_id = query.message.chat.id
 
-    meme_id = int(query_text[5:])
-    context.user_data[RENAMING_MEME_ID] = meme_id
+    state = await get_menu_state(update)
+    if state is None:
+        return CHOOSE_MEME_ACTION
+
+    successful = await database.add_meme_to_collection(meme_id=state.meme_id, collection_id=state.collection_id,
+                                                       user_id=user_id)
+    await update_menu(context=context,
+                      chat_id=chat_id,
+                      text_message_id=query.message.message_id,
+                      state=state,
+                      text="Added to collection" if successful else "Something failed",
+                      keyboard_factory=lambda new_state: generate_back_button(new_state, chat_id),
+                      delete_media=True)
+    return CHOOSE_MEME_ACTION
 
-    back_button = await generate_back_button()
-    await create_or_update_menu(context=context,
-                                chat_id=chat_id,
-                                text="Enter new name: ",
-                                delete_media=True,
-                                reply_markup=back_button)
+
+async def rename_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Asks for new name with a message user has to reply to. That message keeps id of renamed meme"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    chat_id = query.message.chat.id
+
+    state = await get_menu_state(update)
+    if state is None:
+        return ENTER_NEW_NAME
+
+    meme = await database.get_meme_by_id_and_check_user(meme_id=state.meme_id, user_telegram_id=user_id)
+    if not meme:
+        return ENTER_NEW_NAME
+
+    await update_menu(context=context,
+                      chat_id=chat_id,
+                      text_message_id=query.message.message_id,
+                      state=state,
+                      text="Reply to the message below with new name",
+                      keyboard_factory=lambda new_state: generate_back_button(new_state, chat_id),
+                      delete_media=True)
+    await context.bot.sendMessage(text=RENAME_PROMPT.format(title=meme.title, meme_id=meme.id),
+                                  chat_id=chat_id,
+                                  reply_markup=ForceReply(input_field_placeholder="New name"))
     return ENTER_NEW_NAME
 
 
 
+async def reply_to_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handles replies to prompts of rename and bulk tag actions"""
+    prompt = update.message.reply_to_message
+
+    # Only trust prompts sent by the bot itself
+    if prompt.from_user.id != context.bot.id or not prompt.text:
+        return ConversationHandler.END
+    if RENAME_PROMPT_PATTERN.search(prompt.text):
+        return await rename_meme(update, context)
+    if BULK_TAG_PROMPT_PATTERN.search(prompt.text):
+        return await bulk_tag_reply(update, context)
+    return ConversationHandler.END
+
+
 async def rename_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    chat_id = update.message.chat_id
-    new_name = update.message.text
+    new_name = update.message.text.strip()
     user_id = update.message.from_user.id
+    prompt = update.message.reply_to_message
+    match = RENAME_PROMPT_PATTERN.search(prompt.text)
 
-    meme_id = context.user_data.get(RENAMING_MEME_ID)
-    back_button = await generate_back_button()
+    if len(new_name) > MAX_TEXT_LENGTH:
+        await update.message.reply_text("❌ the name is too long")
+        return ConversationHandler.END
 
-    if isinstance(meme_id, int):
-        await database.rename_meme_and_check_user(meme_id=meme_id, user_telegram_id=user_id, new_name=new_name)
-        await create_or_update_menu(context=context,
-                                  chat_id=chat_id,
-                                  text="Meme renamed",
-                                  reply_markup=back_button)
+    meme_id = int(match.group(1))
+    successful = await database.rename_meme_and_check_user(meme_id=meme_id, user_telegram_id=user_id, new_name=new_name)
+    if successful:
+        await prompt.edit_text("Meme renamed")
     else:
-        await create_or_update_menu(context=context,
-                                    chat_id=chat_id,
-                                    text="It seems that something went wrong on our side. Try going back and renaming again",
-                                    reply_markup=back_button)
+        await prompt.edit_text("It seems that something went wrong on our side. Try going back and renaming again")
     await update.message.delete()
     return ConversationHandler.END
 
@@ -451,19 +713,172 @@ async def back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = query.from_user.id
     chat_id = query.message.chat.id
 
-    await query.answer()
+    state = await get_menu_state(update)
+    if state is None:
+        return ConversationHandler.END
 
     memes = await database.get_all_user_memes(user_id)
-    selected_page = context.user_data.get(LAST_SELECTED_PAGE, 0)
-    keyboard = await generate_inline_keyboard_page(memes, selected_page)
-
-    await create_or_update_menu(context=context,
-                                chat_id=chat_id,
-                                text="Choose meme: ",
-                                delete_media=True,
-                                reply_markup=keyboard)
+    await database.clear_selected_memes(user_id)
+    keyboard = await generate_inline_keyboard_page(memes, state.page, chat_id)
+
+    await update_menu(context=context,
+                      chat_id=chat_id,
+                      text_message_id=query.message.message_id,
+                      state=state,
+                      text="Choose meme: ",
+                      reply_markup=keyboard,
+                      delete_media=True)
+    return ConversationHandler.END
+
+async def show_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, state: MenuState,
+                         text: Optional[str] = None) -> None:
+    """Show page of memes menu in multi-select mode"""
+    query = update.callback_query
+    chat_id = query.message.chat.id
+    selected = await database.get_selected_memes(query.from_user.id)
+
+    memes = await database.get_all_user_memes(query.from_user.id)
+    keyboard = await generate_inline_keyboard_page(memes, state.page, chat_id, selected=selected)
+    await update_menu(context=context,
+                      chat_id=chat_id,
+                      text_message_id=query.message.message_id,
+                      state=state.with_changes(meme_id=0, selection=0),
+                      text=text or f"Selected {len(selected)} memes",
+                      reply_markup=keyboard,
+                      delete_media=True)
+
+
+async def select_memes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    state = await get_menu_state(update)
+    if state is not None:
+        await show_selection(update, context, state)
+    return MEME_LIST
+
+
+async def toggle_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    state = await get_menu_state(update)
+    if state is None:
+        return MEME_LIST
+
+    # Memes of other users can't get here, bulk actions check creator anyway
+    await database.toggle_selected_meme(update.callback_query.from_user.id, state.meme_id, MAX_SELECTED_MEMES)
+    await show_selection(update, context, state)
+    return MEME_LIST
+
+
+async def select_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Select all memes of page, or unselect them if all are selected"""
+    state = await get_menu_state(update)
+    if state is None:
+        return MEME_LIST
+
+    user_id = update.callback_query.from_user.id
+    page_ids = [meme.id for meme in get_page(await database.get_all_user_memes(user_id), state.page)]
+    await database.toggle_selected_page(user_id, page_ids, MAX_SELECTED_MEMES)
+    await show_selection(update, context, state)
+    return MEME_LIST
+
+
+async def bulk_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    query = update.callback_query
+    chat_id = query.message.chat.id
+
+    state = await get_menu_state(update)
+    if state is None:
+        return MEME_LIST
+
+    selected = await database.get_selected_memes(query.from_user.id)
+    if not selected:
+        await show_selection(update, context, state, text="Select memes first")
+        return MEME_LIST
+
+    # Selection can be changed meanwhile from other menu, confirmation deletes only memes it showed
+    await update_menu(context=context,
+                      chat_id=chat_id,
+                      text_message_id=query.message.message_id,
+                      state=state.with_changes(selection=selection_fingerprint(selected)),
+                      text=f"Are you sure you want to delete {len(selected)} memes",
+                      keyboard_factory=lambda new_state: generate_yes_no_for_bulk_deletion(new_state, chat_id))
+    return CONFIRM_DELETE
+
+
+async def confirm_bulk_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    state = await get_menu_state(update)
+    if state is None:
+        return MEME_LIST
+
+    user_id = update.callback_query.from_user.id
+    selected = await database.get_selected_memes(user_id)
+    if not selected or selection_fingerprint(selected) != state.selection:
+        await show_selection(update, context, state, text="Selection has changed, nothing deleted")
+        return MEME_LIST
+
+    deleted = await database.bulk_delete_memes(list(selected), user_id)
+    await database.clear_selected_memes(user_id, list(selected))
+    await show_selection(update, context, state, text=f"Deleted {deleted} memes")
+    return MEME_LIST
+
+
+async def bulk_set_public(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    query = update.callback_query
+    state = await get_menu_state(update)
+    if state is None:
+        return MEME_LIST
+
+    selected = await database.get_selected_memes(query.from_user.id)
+    if not selected:
+        await show_selection(update, context, state, text="Select memes first")
+        return MEME_LIST
+
+    is_public = query.data.startswith(CALLBACK_BULK_PUBLIC)
+    changed = await database.bulk_set_memes_public(list(selected), query.from_user.id, is_public)
+    visibility = "public" if is_public else "private"
+    await show_selection(update, context, state, text=f"Made {changed} of {len(selected)} selected memes {visibility}")
+    return MEME_LIST
+
+
+async def bulk_tag_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Asks for tag with a message user has to reply to, like rename does"""
+    query = update.callback_query
+    chat_id = query.message.chat.id
+
+    state = await get_menu_state(update)
+    if state is None:
+        return MEME_LIST
+
+    selected = await database.get_selected_memes(query.from_user.id)
+    if not selected:
+        await show_selection(update, context, state, text="Select memes first")
+        return MEME_LIST
+
+    action = "add" if query.data.startswith(CALLBACK_BULK_ADD_TAG) else "remove"
+    await context.bot.sendMessage(text=BULK_TAG_PROMPT.format(action=action, amount=len(selected)),
+                                  chat_id=chat_id,
+                                  reply_markup=ForceReply(input_field_placeholder="Tag"))
+    return MEME_LIST
+
+
+async def bulk_tag_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user_id = update.message.from_user.id
+    prompt = update.message.reply_to_message
+    action = BULK_TAG_PROMPT_PATTERN.search(prompt.text).group(1)
+    tag = normalize_tag(update.message.text)
+
+    if not tag or len(tag) > MAX_TEXT_LENGTH:
+        await update.message.reply_text("❌ the tag is too long" if tag else "❌ the tag is empty")
+        return ConversationHandler.END
+
+    selected = list(await database.get_selected_memes(user_id))
+    if action == "add":
+        changed = await database.bulk_add_tag(selected, user_id, tag, MAX_TAGS)
+        await prompt.edit_text(f"Tag #{tag} added to {changed} memes")
+    else:
+        changed = await database.bulk_remove_tag(selected, user_id, tag)
+        await prompt.edit_text(f"Tag #{tag} removed from {changed} memes")
+    await update.message.delete()
     return ConversationHandler.END
 
+
 async def unknown_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
@@ -473,16 +888,115 @@ async def unknown_callback_query(update: Update, context: ContextTypes.DEFAULT_T
     logger.error(f"Unknown callback query: {query} from user_id: {user_id}")
 
 
+async def forget_changed_inline_results(changes: list[change_feed.Change]):
+    forget_inline_results(change.id for change in changes if change.op != "I")
+
+
+async def forget_all_inline_results_on_resync():
+    forget_all_inline_results()
+
+class UnitOfWorkApplication(Application):
+    """Units of work of every update share one database session, see memes_db.unit_of_work"""
+
+    async def process_update(self, update: object) -> None:
+        profiling = profiler.active
+        if profiling:
+            profiler.update_started()
+        try:
+            async with shared_session():
+                await super().process_update(update)
+        finally:
+            if profiling:
+                profiler.update_finished(getattr(update, "update_id", 0))
+
+async def reject_banned_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before all other handlers, updates of banned users go no further"""
+    if update.effective_user and update.effective_user.id in database.banned_user_ids:
+        raise ApplicationHandlerStop
+
+async def report_startup_timing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    startup_timing.report_once("first update")
+
+async def track_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    idle_state_evictor.touch(update.effective_user and update.effective_user.id,
+                             update.effective_chat and update.effective_chat.id)
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/profile on, /profile off, /profile slow <ms> or /profile slow off"""
+    args = context.args
+    if args == ["on"]:
+        profiler.start()
+        await update.message.reply_text("Profiling started")
+    elif args == ["off"]:
+        path = profiler.stop()
+        if path is None:
+            await update.message.reply_text("Profiling stopped, nothing was sampled")
+        else:
+            await update.message.reply_document(path, caption="Folded stacks per handler")
+    elif len(args) == 2 and args[0] == "slow" and args[1] == "off":
+        profiler.capture_slow_updates(None)
+        await update.message.reply_text("Slow updates aren't profiled")
+    elif len(args) == 2 and args[0] == "slow" and args[1].isdigit():
+        profiler.capture_slow_updates(int(args[1]) / 1000)
+        await update.message.reply_text(f"Updates slower than {args[1]} ms are profiled to {PROFILE_DIR}")
+    else:
+        await update.message.reply_text("Usage: /profile on|off, /profile slow <ms>|off")
+
+def toggle_profiling():
+    if profiler.enabled:
+        profiler.stop()
+    else:
+        profiler.start()
+
 async def start_db(application: Application):
+    global search_index, inline_warm_up_task
     await database.init_database()
+    startup_timing.mark("database ready")
+
+    change_feed.subscribe("memes", forget_changed_inline_results, on_resync=forget_all_inline_results_on_resync)
+    change_feed.subscribe("memes", database.apply_private_meme_changes, on_resync=database.load_private_meme_creators)
+    change_feed.subscribe("users", database.forget_deleted_users, on_resync=database.reload_known_users)
+    change_feed.subscribe("users", database.apply_ban_changes, on_resync=database.load_banned_users)
+    change_feed.subscribe("users", database.forget_saved_collections, on_resync=database.forget_all_saved_collections)
+    change_feed.subscribe("collections", database.forget_saved_collections)
+    if IN_MEMORY_SEARCH:
+        import search_index
+        search_index.start()
+    await change_feed.start(database.CONNINFO)
+    startup_timing.mark("change feed started")
+    idle_state_evictor.start(application, USER_STATE_EVICT_INTERVAL)
+    query_log.start(QUERY_LOG_SAMPLE_RATE)
+    upload_queue.start(UPLOAD_WORKERS, partial(notify_upload_finished, application))
+    inline_warm_up_task = asyncio.create_task(warm_up_inline_results())
+
+    if SLOW_UPDATE_PROFILE_MS:
+        profiler.capture_slow_updates(int(SLOW_UPDATE_PROFILE_MS) / 1000)
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_profiling)
+    except (AttributeError, NotImplementedError):
+        # No SIGUSR1 on Windows
+        pass
 
 async def stop_db(application: Application):
+    await idle_state_evictor.stop()
+    if inline_warm_up_task:
+        inline_warm_up_task.cancel()
+    await query_log.stop()
+    await upload_queue.stop()
+    profiler.capture_slow_updates(None)
+    if profiler.enabled:
+        profiler.stop()
+    await change_feed.stop()
     await database.close_all_connections()
 
 if __name__ == "__main__":
     logger.info("building")
-    app = Application.builder().token(BOT_TOKEN).post_init(start_db).post_shutdown(stop_db).concurrent_updates(False).build()
+    app = Application.builder().application_class(UnitOfWorkApplication).token(BOT_TOKEN).post_init(start_db).post_shutdown(stop_db).concurrent_updates(False).build()
+    startup_timing.mark("application built")
     logger.info("adding commands")
+    app.add_handler(TypeHandler(Update, report_startup_timing), group=-1)
+    app.add_handler(TypeHandler(Update, reject_banned_users), group=-3)
+    app.add_handler(TypeHandler(Update, track_user_activity), group=-2)
     app.add_handler(CommandHandler('start', start_command), group=1)
 
     add_meme_conv = ConversationHandler(entry_points=[CommandHandler("add", add_command)],
@@ -525,27 +1039,31 @@ if __name__ == "__main__":
 
     # app.add_handler(edit_meme_conv, group=0)
 
-    rename_conversation_handler = ConversationHandler(
-                            entry_points=[CallbackQueryHandler(rename_callback_query, pattern="^"+CALLBACK_RENAME)],
-                            states={
-                                ENTER_NEW_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND,rename_meme)]
-                            },
-                            fallbacks=[
-                                CallbackQueryHandler(back, pattern="^" + CALLBACK_BACK),
-                                MessageHandler(filters.COMMAND, command_in_wrong_place),
-                                CallbackQueryHandler(unknown_callback_query)
-                            ])
-
-    app.add_handler(rename_conversation_handler, group=1)
-
     app.add_handler(CommandHandler("memes", user_get_memes), group=0)
     app.add_handler(CallbackQueryHandler(get_meme_control, pattern="^" + CALLBACK_MEME), group=0)
     app.add_handler(CallbackQueryHandler(meme_list, pattern="^" + CALLBACK_PAGE), group=0)
     app.add_handler(CallbackQueryHandler(delete_meme, pattern="^" + CALLBACK_DELETE), group=0)
     app.add_handler(CallbackQueryHandler(confirm_delete_meme, pattern="^" + CALLBACK_CONFIRM_DELETE), group=0)
     app.add_handler(CallbackQueryHandler(back, pattern="^" + CALLBACK_BACK), group=0)
+    app.add_handler(CallbackQueryHandler(rename_callback_query, pattern="^" + CALLBACK_RENAME), group=0)
+    app.add_handler(CallbackQueryHandler(choose_collection, pattern="^" + CALLBACK_COLLECTIONS), group=0)
+    app.add_handler(CallbackQueryHandler(add_to_collection, pattern="^" + CALLBACK_ADD_TO_COLLECTION), group=0)
+    app.add_handler(CommandHandler("new_collection", new_collection_command), group=0)
+    app.add_handler(CommandHandler("collections", collections_command), group=0)
+    app.add_handler(CallbackQueryHandler(select_memes, pattern="^" + CALLBACK_SELECT), group=0)
+    app.add_handler(CallbackQueryHandler(toggle_meme, pattern="^" + CALLBACK_TOGGLE), group=0)
+    app.add_handler(CallbackQueryHandler(select_page, pattern="^" + CALLBACK_SELECT_PAGE), group=0)
+    app.add_handler(CallbackQueryHandler(bulk_delete, pattern="^" + CALLBACK_BULK_DELETE), group=0)
+    app.add_handler(CallbackQueryHandler(confirm_bulk_delete, pattern="^" + CALLBACK_BULK_CONFIRM_DELETE), group=0)
+    app.add_handler(CallbackQueryHandler(bulk_tag_prompt,
+                                         pattern=f"^({CALLBACK_BULK_ADD_TAG}|{CALLBACK_BULK_REMOVE_TAG})"), group=0)
+    app.add_handler(CallbackQueryHandler(bulk_set_public,
+                                         pattern=f"^({CALLBACK_BULK_PUBLIC}|{CALLBACK_BULK_PRIVATE})"), group=0)
+    app.add_handler(MessageHandler(filters.TEXT & filters.REPLY & ~filters.COMMAND, reply_to_prompt), group=0)
 
     app.add_handler(add_meme_conv, group=1)
     app.add_handler(InlineQueryHandler(inline_query))
+    app.add_handler(CommandHandler("profile", profile_command, filters=filters.User(user_id=ADMIN_IDS)), group=0)
+    profiler.register_handlers(handler for handlers in app.handlers.values() for handler in handlers)
     logger.info("polling")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
\ No newline at end of file
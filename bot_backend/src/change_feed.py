@@ -0,0 +1,120 @@
+"""
+Feed of changes in memes, users and collections tables.
+
+Triggers send a compact notification for every changed row to CHANGES_CHANNEL,
+they are created by migrations.
+Listener in each process collects notifications into batches and passes them to
+subscribers, so caches in any process can be invalidated after changes made by others.
+Notifications sent while listener was disconnected are lost, so every time listener
+(re)connects subscribers are asked to resync.
+"""
+import asyncio
+import json
+import logging
+from collections import namedtuple
+from typing import Awaitable, Callable, Optional
+
+import psycopg
+
+logger = logging.getLogger(__name__)
+
+CHANGES_CHANNEL = "changes"
+TRACKED_TABLES = ("memes", "users", "collections")
+
+# Wait that long for more notifications before passing batch to subscribers
+BATCH_WINDOW = 0.05
+MAX_BATCH_SIZE = 500
+RECONNECT_DELAY = 5
+
+# op is first letter of operation: I, U or D.
+# creator and public are None for tables that don't have them.
+# banned is new is_banned of user, None if it didn't change
+Change = namedtuple("Change", ["table", "op", "id", "creator", "public", "banned"], defaults=(None,))
+
+ChangesCallback = Callable[[list[Change]], Awaitable[None]]
+ResyncCallback = Callable[[], Awaitable[None]]
+
+_subscribers: dict[str, list[ChangesCallback]] = {table: [] for table in TRACKED_TABLES}
+_resync_callbacks: list[ResyncCallback] = []
+_listener_task: Optional[asyncio.Task] = None
+
+
+def subscribe(table: str, on_changes: ChangesCallback, on_resync: Optional[ResyncCallback] = None) -> None:
+    """
+    Args:
+        table: one of TRACKED_TABLES
+        on_changes: called with batch of changes of the table
+        on_resync: called on start and whenever changes could have been missed, e.g. after reconnect
+    """
+    _subscribers[table].append(on_changes)
+    if on_resync:
+        _resync_callbacks.append(on_resync)
+
+
+def parse(payload: str) -> Change:
+    data = json.loads(payload)
+    return Change(table=data["t"], op=data["op"], id=data["id"], creator=data.get("c"), public=data.get("p"),
+                  banned=data.get("b"))
+
+
+async def dispatch(changes: list[Change]) -> None:
+    by_table: dict[str, list[Change]] = {}
+    for change in changes:
+        by_table.setdefault(change.table, []).append(change)
+
+    for table, table_changes in by_table.items():
+        for callback in _subscribers.get(table, []):
+            try:
+                await callback(table_changes)
+            except Exception as e:
+                logger.error(f"Error in {table} changes subscriber {callback.__qualname__}: {e}")
+
+
+async def resync() -> None:
+    for callback in _resync_callbacks:
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"Error in resync callback {callback.__qualname__}: {e}")
+
+
+async def _read_batches(conn: psycopg.AsyncConnection) -> None:
+    while True:
+        # Block until first notification, then collect everything that arrives shortly after it
+        batch = [parse(notify.payload) async for notify in conn.notifies(stop_after=1)]
+        batch += [parse(notify.payload)
+                  async for notify in conn.notifies(timeout=BATCH_WINDOW, stop_after=MAX_BATCH_SIZE - 1)]
+        await dispatch(batch)
+
+
+async def listen(conninfo: str) -> None:
+    """
+    Listen for changes until cancelled, reconnecting after connection loss.
+    Subscribers are resynced after every LISTEN, so they start from a state that includes
+    everything missed while there was no connection
+    """
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {CHANGES_CHANNEL}")
+                await resync()
+                await _read_batches(conn)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Change feed disconnected: {e}")
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def start(conninfo: str) -> None:
+    global _listener_task
+    _listener_task = asyncio.create_task(listen(conninfo))
+
+
+async def stop() -> None:
+    global _listener_task
+    if _listener_task:
+        _listener_task.cancel()
+        # Connection is closed by the time stop returns
+        await asyncio.gather(_listener_task, return_exceptions=True)
+        _listener_task = None
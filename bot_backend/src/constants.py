@@ -3,31 +3,52 @@ from typing import Final
 MEME_NAME: Final[str] = "meme_name"
 MEDIA_TYPE: Final[str]  = "media_type"
 TELEGRAM_MEDIA_ID: Final[str]  = "telegram_media_id"
+TELEGRAM_FILE_UNIQUE_ID: Final[str]  = "telegram_file_unique_id"
 DURATION: Final[str]  = "duration"
 TAGS: Final[str]  = "tags"
 MEME_PUBLIC: Final[str]  = "meme_public"
-RENAMING_MEME_ID: Final[str] = "renaming_meme_id"
-
-# Message from bot that contains memes created by user.
-MEMES_CONTROL_MESSAGE: Final[str]  = "memes_control_message"
-MEME_MEDIA_MESSAGE: Final[str]  = "meme_media_message"
-
-LAST_SELECTED_PAGE: Final[str]  = "last_selected_page"
 
 MEMES_PER_PAGE = 10
+MAX_SELECTED_MEMES = 500
 
-# callback data
+# callback data prefixes, all have to be 5 characters long.
+# Rest of callback data is signed menu state, see tg_utilities/callback_data.py
 CALLBACK_MEME: Final[str] = "meme:"
 CALLBACK_PAGE: Final[str] = "page:"
 CALLBACK_RENAME: Final[str] = "rnme:"
 CALLBACK_DELETE: Final[str] = "delt:"
 CALLBACK_BACK: Final[str] = "back:"
 CALLBACK_CONFIRM_DELETE: Final[str] = "cdel:"
+CALLBACK_COLLECTIONS: Final[str] = "cols:"
+CALLBACK_ADD_TO_COLLECTION: Final[str] = "acol:"
+# multi-select mode of memes menu
+CALLBACK_SELECT: Final[str] = "slct:"
+CALLBACK_TOGGLE: Final[str] = "tgle:"
+CALLBACK_SELECT_PAGE: Final[str] = "spge:"
+CALLBACK_BULK_DELETE: Final[str] = "bdel:"
+CALLBACK_BULK_CONFIRM_DELETE: Final[str] = "bcdl:"
+CALLBACK_BULK_ADD_TAG: Final[str] = "batg:"
+CALLBACK_BULK_REMOVE_TAG: Final[str] = "brtg:"
+CALLBACK_BULK_PUBLIC: Final[str] = "bpub:"
+CALLBACK_BULK_PRIVATE: Final[str] = "bprv:"
+
+# /start argument of links that share collections, followed by collection id
+SHARE_COLLECTION_START: Final[str] = "col_"
+
+# inline query answers are cached by telegram for this user for this many seconds.
+# Answers that may depend on user's private memes or collections must be refreshed quickly
+INLINE_CACHE_TIME_PUBLIC: Final[int] = 300
+INLINE_CACHE_TIME_PERSONAL: Final[int] = 4
+
+# Bump when format of inline results changes so telegram doesn't mix up old and new results
+INLINE_RESULT_VERSION: Final[int] = 1
+INLINE_RESULTS_CACHE_SIZE: Final[int] = 10000
 
 # 15 seconds
 UPLOAD_COOLDOWN: Final[float] = 15
 
 MAX_TAGS = 20
+TAG_SUGGESTIONS_AMOUNT = 5
 MAX_TEXT_LENGTH = 256
 
 LAST_UPLOAD_TIME: Final[str] = "last_upload_time"
@@ -1,76 +1,219 @@
+import asyncio
+import enum
 import logging
-from dotenv import load_dotenv
-from os import getenv
+from datetime import timedelta
 from typing import Optional
 
-from sqlalchemy import select, text, Sequence, ScalarResult, delete, update
-from sqlalchemy.orm import close_all_sessions
-from sqlalchemy.ext.asyncio import (
-    create_async_engine,
-    async_sessionmaker,
-    AsyncEngine,
-    AsyncSession,
-)
+from sqlalchemy import (select, text, Sequence, ScalarResult, delete, update, func, or_, any_, literal, BigInteger,
+                        literal_column)
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 from sqlalchemy.exc import IntegrityError
-from models import User, Base, Meme
-from src.models import MediaType
+from sqlalchemy.dialects.postgresql import insert
+from memes_db import engine as db_engine
+from memes_db import repository
+from memes_db.config import CONNINFO
+from memes_db.models import (User, Meme, Tag, Collection, MemeToCollection, MediaType, InlineQueryLog, TopInlineQuery,
+                              UploadJob, SelectedMeme)
+from memes_db.schema import check_revision
+from memes_db.search_query import NOT_BANNED_CONDITION
+from memes_db.unit_of_work import unit_of_work, transaction, after_commit
+import change_feed
 
 
-load_dotenv("../../.env")
-# Database configuration from environment variables
-HOST = getenv("DB_HOST", "localhost")
-DBNAME = getenv("POSTGRES_DB")
-USER = getenv("POSTGRES_USER")
-PASSWORD = getenv("POSTGRES_PASSWORD")
-PORT = getenv("PORT")
 MEMES_IN_INLINE_LIST = 20
 
-
 logger = logging.getLogger(__name__)
 
-# Global variables for engine and session maker
-engine: Optional[AsyncEngine] = None
+# Session maker of shared pool, set by init_database
 session_maker: Optional[async_sessionmaker[AsyncSession]] = None
+_warm_up_task: Optional[asyncio.Task] = None
+
+# Telegram ids that are known to have a row in users table.
+# Warmed up on startup so repeat users don't cost a round trip to the database
+known_user_ids: set[int] = set()
+
+# Telegram ids of banned users. Loaded before first update and kept up to date by change feed
+banned_user_ids: set[int] = set()
+
+# Telegram ids of users that have or had private memes, loaded when change feed connects and kept up to date by it.
+# Inline answers of other users can't contain private memes, so they are cached longer
+private_meme_creators: set[int] = set()
+private_meme_creators_loaded = False
+
+# user telegram id -> (id, title) of collections saved by user
+saved_collections_cache: dict[int, list[tuple[int, str]]] = {}
+SAVED_COLLECTIONS_CACHE_SIZE = 10000
+
+# Inline query log is kept for that many days, top queries are counted over last TOP_QUERIES_WINDOW_DAYS of it
+QUERY_LOG_RETENTION_DAYS = 30
+TOP_QUERIES_WINDOW_DAYS = 7
+TOP_QUERIES_AMOUNT = 1000
+# Advisory lock held by the process that rebuilds top_inline_queries
+ROLLUP_LOCK_KEY = 4201
+
+# Failed upload job is retried after UPLOAD_RETRY_DELAY seconds, doubled after every attempt
+UPLOAD_MAX_ATTEMPTS = 5
+UPLOAD_RETRY_DELAY = 5
+# Finished upload jobs are kept that long, so repeated uploads are recognized
+UPLOAD_JOBS_RETENTION_DAYS = 7
 
 
 async def init_database() -> None:
     """
-    Initialize the asynchronous engine and create all tables.
+    Connect shared pool and check that database is migrated.
+    Known users are loaded in background, until then they are checked in database
     """
-    global engine, session_maker
+    global session_maker, _warm_up_task
+
+    session_maker = db_engine.connect()
+    async with db_engine.engine.connect() as conn:
+        await check_revision(conn)
+    await load_banned_users()
+
+    _warm_up_task = asyncio.create_task(warm_up_known_users())
+
 
-    db_url = f"postgresql+psycopg://{USER}:{PASSWORD}@{HOST}:{PORT}/{DBNAME}"
-    engine = create_async_engine(db_url)
-    if not engine:
-        logger.error("Failed to create engine")
+async def warm_up_known_users() -> None:
+    """Load ids of all existing users into known_user_ids"""
+    try:
+        async with session_maker() as session:
+            result = await session.stream_scalars(select(User.telegram_id).execution_options(yield_per=10000))
+            async for telegram_id in result:
+                known_user_ids.add(telegram_id)
+    except Exception as e:
+        logger.error(f"Error while loading known users: {e}")
         return
+    logger.info(f"Loaded {len(known_user_ids)} known users")
+
+
+async def reload_known_users() -> None:
+    """Deleted users could have been missed by change feed, known users are loaded again from scratch"""
+    global _warm_up_task
+    if _warm_up_task:
+        _warm_up_task.cancel()
+    known_user_ids.clear()
+    _warm_up_task = asyncio.create_task(warm_up_known_users())
+
+
+async def load_private_meme_creators() -> None:
+    global private_meme_creators, private_meme_creators_loaded
+    private_meme_creators = await get_users_with_private_memes()
+    private_meme_creators_loaded = True
+    logger.info(f"Loaded {len(private_meme_creators)} users with private memes")
+
+
+async def apply_private_meme_changes(changes: list[change_feed.Change]) -> None:
+    """Users are never removed, user counted as having private memes only gets shorter cache"""
+    for change in changes:
+        if change.public is False and change.creator is not None:
+            private_meme_creators.add(change.creator)
+
 
-    # Create database tables
-    async with engine.begin() as conn:
-        await conn.execute(text("""CREATE EXTENSION IF NOT EXISTS pgroonga;"""))
-        await conn.run_sync(Base.metadata.create_all)
-    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+def has_no_private_memes(user_telegram_id: int) -> bool:
+    return private_meme_creators_loaded and user_telegram_id not in private_meme_creators
 
 
+async def load_banned_users() -> None:
+    """Replace banned_user_ids with banned users from database"""
+    global banned_user_ids
+    async with session_maker() as session:
+        result = await session.scalars(select(User.telegram_id).where(User.is_banned))
+        banned_user_ids = set(result.all())
+    logger.info(f"Loaded {len(banned_user_ids)} banned users")
+
+
+async def apply_ban_changes(changes: list[change_feed.Change]) -> None:
+    for change in changes:
+        if change.op == "D" or change.banned is False:
+            banned_user_ids.discard(change.id)
+        elif change.banned:
+            banned_user_ids.add(change.id)
+
+
+async def forget_deleted_users(changes: list[change_feed.Change]) -> None:
+    for change in changes:
+        if change.op == "D":
+            known_user_ids.discard(change.id)
+
+
+async def ensure_user_exists(session: AsyncSession, telegram_id: int) -> None:
+    """
+    Insert user into the database inside given session's transaction if it isn't known yet.
+    telegram_id is added to known_user_ids after commit
+    """
+    if telegram_id in known_user_ids:
+        return
+
+    stmt = insert(User).values(telegram_id=telegram_id).on_conflict_do_nothing(index_elements=[User.telegram_id])
+    await session.execute(stmt)
+    after_commit(session, lambda: known_user_ids.add(telegram_id))
+
 
 async def add_user_to_database(telegram_id: int) -> bool:
+    if telegram_id in known_user_ids:
+        return True
+
     try:
-        async with session_maker() as session:
-            async with session.begin():
-                get_user_stmt = select(User).where(User.telegram_id == telegram_id)
-                db_response = await session.execute(get_user_stmt)
-                user_exists = db_response.first()
-
-                if not user_exists:
-                    new_user = User(telegram_id = telegram_id)
-                    session.add(new_user)
-                return True
+        async with transaction() as session:
+            await ensure_user_exists(session, telegram_id)
+        return True
     except Exception as e:
         logger.error(f"Error while adding user to database: {e}")
         return False
 
 
 
+class AddMemeResult(enum.Enum):
+    ADDED = "added"
+    # Same file was already public, tags were merged into existing meme
+    MERGED = "merged"
+    # User already has same file as private meme
+    DUPLICATE = "duplicate"
+    FAILED = "failed"
+
+
+def _add_meme_statement(
+        user_id: int,
+        telegram_media_id: str,
+        name: str,
+        tags: list[str],
+        media_type: MediaType,
+        duration: int,
+        is_public: bool,
+        telegram_file_unique_id: Optional[str] = None,
+):
+    """Insert of meme that returns (id, inserted), or nothing for duplicate private meme"""
+    stmt = insert(Meme).values(
+        creator_telegram_id=user_id,
+        telegram_media_id=telegram_media_id,
+        telegram_file_unique_id=telegram_file_unique_id,
+        duration=duration,
+        title=name,
+        tags=tags,
+        media_type=media_type,
+        is_public=is_public,
+    )
+    if telegram_file_unique_id and is_public:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Meme.telegram_file_unique_id, Meme.is_public],
+            index_where=text("is_public"),
+            set_={"tags": text("ARRAY(SELECT DISTINCT unnest(memes.tags || excluded.tags))")}
+        )
+    elif telegram_file_unique_id:
+        stmt = stmt.on_conflict_do_nothing(
+            index_elements=[Meme.creator_telegram_id, Meme.telegram_file_unique_id, Meme.is_public],
+            index_where=text("NOT is_public")
+        )
+    # xmax is zero only for rows inserted by this statement
+    return stmt.returning(Meme.id, literal_column("xmax = 0").label("inserted"))
+
+
+def _add_meme_result(row) -> AddMemeResult:
+    if row is None:
+        return AddMemeResult.DUPLICATE
+    return AddMemeResult.ADDED if row.inserted else AddMemeResult.MERGED
+
+
 async def add_meme(
         user_id: int,
         telegram_media_id: str,
@@ -79,106 +222,352 @@ async def add_meme(
         media_type: MediaType,
         duration: int,
         is_public: bool,
-) -> bool:
+        telegram_file_unique_id: Optional[str] = None,
+) -> AddMemeResult:
+    """
+    Add meme unless same file is already uploaded.
+    Public duplicates are merged into canonical public meme, its tags get new tags
+    """
+    stmt = _add_meme_statement(user_id, telegram_media_id, name, tags, media_type, duration, is_public,
+                               telegram_file_unique_id)
     try:
-        async with session_maker() as session:
-            async with session.begin():
-                new_meme = Meme(
-                    creator_telegram_id=user_id,
-                    telegram_media_id=telegram_media_id,
-                    duration=duration,
-                    title=name,
-                    tags=tags,
-                    media_type=media_type,
-                    is_public=is_public,
-                )
-                session.add(new_meme)
-        return True
+        async with transaction() as session:
+            await ensure_user_exists(session, user_id)
+            row = (await session.execute(stmt)).first()
 
     except Exception as e:
         logger.error(f"Error while adding meme to database: {e}")
-        return False
+        return AddMemeResult.FAILED
+
+    return _add_meme_result(row)
+
+
+def upload_idempotency_key(user_id: int, telegram_media_id: str, telegram_file_unique_id: Optional[str],
+                           is_public: bool) -> str:
+    """Same for every upload of the same file by the same user with the same visibility"""
+    return f"{user_id}:{'public' if is_public else 'private'}:{telegram_file_unique_id or telegram_media_id}"
 
 
-async def generate_OR_query(query: str) -> str:
-    return " OR ".join(query.split())
+class EnqueueResult(enum.Enum):
+    QUEUED = "queued"
+    # Same upload is already waiting in queue
+    ALREADY_QUEUED = "already queued"
+    FAILED = "failed"
 
 
-async def search_for_meme_inline_by_query(query: str, user_id: int):
+async def enqueue_upload(
+        user_id: int,
+        chat_id: int,
+        telegram_media_id: str,
+        name: str,
+        tags: list[str],
+        media_type: MediaType,
+        duration: int,
+        is_public: bool,
+        telegram_file_unique_id: Optional[str] = None,
+) -> EnqueueResult:
+    """
+    Put meme upload into upload_jobs, upload workers add it to memes later.
+    Finished job with the same idempotency key is queued again, pending one is left as is
+    """
+    values = dict(
+        user_telegram_id=user_id,
+        chat_id=chat_id,
+        telegram_media_id=telegram_media_id,
+        telegram_file_unique_id=telegram_file_unique_id,
+        title=name,
+        tags=tags,
+        media_type=media_type,
+        duration=duration,
+        is_public=is_public,
+    )
+    stmt = insert(UploadJob).values(
+        idempotency_key=upload_idempotency_key(user_id, telegram_media_id, telegram_file_unique_id, is_public),
+        **values,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UploadJob.idempotency_key],
+        set_={**values, "status": "pending", "result": None, "attempts": 0, "run_after": func.now(),
+              "created_at": func.now(), "finished_at": None},
+        where=UploadJob.status != "pending",
+    ).returning(UploadJob.id)
+
+    try:
+        async with transaction() as session:
+            job_id = await session.scalar(stmt)
+    except Exception as e:
+        logger.error(f"Error while queueing meme upload: {e}")
+        return EnqueueResult.FAILED
+
+    return EnqueueResult.QUEUED if job_id is not None else EnqueueResult.ALREADY_QUEUED
+
+
+async def process_upload_batch(batch_size: int) -> tuple[int, list[tuple[int, str, AddMemeResult]]]:
+    """
+    Take up to batch_size due upload jobs that no other worker holds and add their memes in one transaction.
+    Every job runs in its own savepoint, failed job is retried after backoff until UPLOAD_MAX_ATTEMPTS.
+    If transaction fails as a whole, jobs stay pending and are taken again.
+    Returns:
+        amount of jobs taken, and (chat_id, title, result) of jobs that finished
+    """
+    finished = []
+    async with transaction() as session:
+        jobs = (await session.scalars(
+            select(UploadJob)
+            .where(UploadJob.status == "pending", UploadJob.run_after <= func.now())
+            .order_by(UploadJob.run_after, UploadJob.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )).all()
+
+        for user_id in {job.user_telegram_id for job in jobs}:
+            await ensure_user_exists(session, user_id)
+
+        for job in jobs:
+            job.attempts += 1
+            stmt = _add_meme_statement(job.user_telegram_id, job.telegram_media_id, job.title, job.tags,
+                                       job.media_type, job.duration, job.is_public, job.telegram_file_unique_id)
+            try:
+                async with session.begin_nested():
+                    result = _add_meme_result((await session.execute(stmt)).first())
+            except Exception as e:
+                logger.error(f"Error while processing upload job {job.id}, attempt {job.attempts}: {e}")
+                if job.attempts < UPLOAD_MAX_ATTEMPTS:
+                    job.run_after = func.now() + timedelta(seconds=UPLOAD_RETRY_DELAY * 2 ** (job.attempts - 1))
+                    continue
+                result = AddMemeResult.FAILED
+
+            job.status = "failed" if result == AddMemeResult.FAILED else "done"
+            job.result = result.value
+            job.finished_at = func.now()
+            finished.append((job.chat_id, job.title, result))
+
+    return len(jobs), finished
+
+
+async def delete_finished_upload_jobs() -> None:
+    async with transaction() as session:
+        await session.execute(delete(UploadJob).where(
+            UploadJob.status != "pending",
+            UploadJob.finished_at < func.now() - timedelta(days=UPLOAD_JOBS_RETENTION_DAYS)))
+
+
+async def search_for_meme_inline_by_query(query: str, user_id: int, tags: Optional[list[str]] = None,
+                                          media_type: Optional[MediaType] = None,
+                                          collection_ids: Optional[list[int]] = None):
+    """Search memes visible to user, see repository.search_memes"""
+    return await repository.search_memes(query, user_id, MEMES_IN_INLINE_LIST, tags=tags, media_type=media_type,
+                                         collection_ids=collection_ids)
+
+
+async def search_for_private_meme_inline_by_query(query: str, user_id: int, media_type: Optional[MediaType] = None):
+    """Same as search_for_meme_inline_by_query but only looks at user's private memes"""
+    return await repository.search_memes(query, user_id, MEMES_IN_INLINE_LIST, media_type=media_type,
+                                         private_only=True)
+
+
+async def stream_public_memes_for_index(batch_size: int = 10000):
+    """
+    Yield (id, title, tags, telegram_media_id, telegram_file_unique_id, media_type)
+    of every public meme of users that aren't banned
+    """
+    # Own session, rows are streamed while caller does other work
     async with session_maker() as session:
-        OR_query = await generate_OR_query(query)
+        stmt = text(f"""
+            SELECT id, title, tags, telegram_media_id, telegram_file_unique_id, media_type
+            FROM memes
+            WHERE is_public = TRUE AND {NOT_BANNED_CONDITION}
+        """).execution_options(yield_per=batch_size)
+        result = await session.stream(stmt)
+        async for row in result:
+            yield row
 
-        search_query = text("""
-            SELECT title, telegram_media_id, media_type
+
+async def get_public_memes_by_ids(meme_ids: list[int]):
+    """
+    Get (id, title, tags, telegram_media_id, telegram_file_unique_id, media_type)
+    of public memes with given ids whose creators aren't banned
+    """
+    async with unit_of_work() as session:
+        stmt = text(f"""
+            SELECT id, title, tags, telegram_media_id, telegram_file_unique_id, media_type
             FROM memes
-            WHERE (
-                title &@ pgroonga_condition(
-                    :query,
-                    ARRAY[5],
-                    index_name => 'pgroonga_memes_titles_index',
-                    fuzzy_max_distance_ratio => 0.34
-                )
-                OR tags &@ pgroonga_condition(
-                    :query,
-                    index_name => 'pgroonga_memes_tags_index',
-                    fuzzy_max_distance_ratio => 0.34
-                )
-                OR title &@~ pgroonga_condition(
-                    :OR_query,
-                    ARRAY[1],
-                    index_name => 'pgroonga_memes_titles_index',
-                    fuzzy_max_distance_ratio => 0.34
-                )
-                OR tags &@~ pgroonga_condition(
-                    :OR_query,
-                    index_name => 'pgroonga_memes_tags_index',
-                    fuzzy_max_distance_ratio => 0.34
-                )
-            )
-            AND (is_public = TRUE OR creator_telegram_id = :user_id)
-            ORDER BY pgroonga_score(tableoid, ctid) DESC;
+            WHERE id = ANY(:ids) AND is_public = TRUE AND {NOT_BANNED_CONDITION}
         """)
+        result = await session.execute(stmt, {'ids': meme_ids})
+        return result.fetchall()
 
-        result = await session.execute(
-            search_query,
-            {'query': query, 'OR_query': OR_query, 'user_id': user_id}
-        )
 
-        # Fetch all rows as a list of tuples
-        memes_list = result.fetchmany(MEMES_IN_INLINE_LIST)
-        return memes_list
+async def get_public_meme_ids_of_user(user_telegram_id: int) -> list[int]:
+    async with unit_of_work() as session:
+        stmt = select(Meme.id).where(Meme.creator_telegram_id == user_telegram_id).where(Meme.is_public == True)
+        result = await session.scalars(stmt)
+        return list(result.all())
+
+
+async def get_users_with_private_memes() -> set[int]:
+    async with unit_of_work() as session:
+        stmt = select(Meme.creator_telegram_id).where(Meme.is_public == False).distinct()
+        result = await session.execute(stmt)
+        return set(result.scalars().all())
+
+
+
+async def create_collection(user_id: int, title: str, is_public: bool = True) -> Optional[Collection]:
+    """Create collection and save it for its creator"""
+    try:
+        async with transaction() as session:
+            await ensure_user_exists(session, user_id)
+            collection = Collection(creator_telegram_id=user_id, title=title, is_public=is_public, users_amount=1)
+            session.add(collection)
+            await session.flush()
+            await session.execute(
+                update(User)
+                .where(User.telegram_id == user_id)
+                .values(saved_collections=func.array_append(User.saved_collections, literal(collection.id, BigInteger)))
+            )
+            after_commit(session, lambda: saved_collections_cache.pop(user_id, None))
+        return collection
+    except Exception as e:
+        logger.error(f"Error while creating collection: {e}")
+        return None
+
+
+async def get_user_created_collections(user_id: int) -> Sequence[Collection]:
+    async with unit_of_work() as session:
+        stmt = select(Collection).where(Collection.creator_telegram_id == user_id).order_by(Collection.id.desc())
+        result = await session.execute(stmt)
+        return result.scalars().all()
+
+
+async def get_saved_collections(user_id: int) -> list[tuple[int, str]]:
+    """(id, title) of collections saved by user. Cached until user or collections change"""
+    cached = saved_collections_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    async with unit_of_work() as session:
+        stmt = (select(Collection.id, Collection.title)
+                .join(User, Collection.id == any_(User.saved_collections))
+                .where(User.telegram_id == user_id)
+                .order_by(Collection.id))
+        result = await session.execute(stmt)
+        collections = [(row.id, row.title) for row in result]
+
+    if len(saved_collections_cache) >= SAVED_COLLECTIONS_CACHE_SIZE:
+        saved_collections_cache.clear()
+    saved_collections_cache[user_id] = collections
+    return collections
+
+
+async def forget_all_saved_collections() -> None:
+    saved_collections_cache.clear()
+
+
+async def forget_saved_collections(changes: list[change_feed.Change]) -> None:
+    """Users changes carry id of user, collections changes can affect any user who saved them"""
+    if any(change.table == "collections" for change in changes):
+        saved_collections_cache.clear()
+        return
+    for change in changes:
+        saved_collections_cache.pop(change.id, None)
+
+
+async def save_collection(collection_id: int, user_id: int) -> Optional[Collection]:
+    """Save public collection or user's own collection. Returns None if user can't save it"""
+    try:
+        async with transaction() as session:
+            await ensure_user_exists(session, user_id)
+            collection = (await session.execute(
+                select(Collection)
+                .where(Collection.id == collection_id)
+                .where(or_(Collection.is_public == True, Collection.creator_telegram_id == user_id))
+            )).scalars().first()
+            if collection is None:
+                return None
+
+            saved = await session.execute(
+                update(User)
+                .where(User.telegram_id == user_id)
+                .where(~(literal(collection_id, BigInteger) == any_(User.saved_collections)))
+                .values(saved_collections=func.array_append(User.saved_collections, literal(collection_id, BigInteger)))
+            )
+            if saved.rowcount:
+                collection.users_amount += 1
+            after_commit(session, lambda: saved_collections_cache.pop(user_id, None))
+        return collection
+    except Exception as e:
+        logger.error(f"Error while saving collection: {e}")
+        return None
+
+
+async def add_meme_to_collection(meme_id: int, collection_id: int, user_id: int) -> bool:
+    """Add meme visible to user into collection created by user"""
+    try:
+        async with transaction() as session:
+            stmt = insert(MemeToCollection).from_select(
+                ["meme_id", "collection_id"],
+                select(Meme.id, Collection.id)
+                .where(Meme.id == meme_id)
+                .where(or_(Meme.is_public == True, Meme.creator_telegram_id == user_id))
+                .where(Collection.id == collection_id)
+                .where(Collection.creator_telegram_id == user_id)
+            ).on_conflict_do_nothing(index_elements=["collection_id", "meme_id"])
+            await session.execute(stmt)
+            exists = await session.execute(
+                select(MemeToCollection.id)
+                .where(MemeToCollection.meme_id == meme_id)
+                .where(MemeToCollection.collection_id == collection_id)
+                .join(Collection, Collection.id == MemeToCollection.collection_id)
+                .where(Collection.creator_telegram_id == user_id)
+            )
+            return exists.first() is not None
+    except Exception as e:
+        logger.error(f"Error while adding meme to collection: {e}")
+        return False
+
 
+async def suggest_tags(prefix: str, limit: int = 5) -> list[str]:
+    """Most used tags that start with prefix"""
+    escaped_prefix = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    async with unit_of_work() as session:
+        stmt = (select(Tag.name)
+                .where(Tag.name.like(escaped_prefix + "%"))
+                .where(Tag.usage_count > 0)
+                .order_by(Tag.usage_count.desc())
+                .limit(limit))
+        result = await session.execute(stmt)
+        return list(result.scalars().all())
 
 
 async def get_all_user_memes(user_telegram_id: int) -> Sequence[Meme]:
     """get all memes created by user"""
-    async with session_maker() as session:
-        async with session.begin():
-            stmt = select(Meme).where(Meme.creator_telegram_id == user_telegram_id).order_by(Meme.id.desc())
+    async with unit_of_work() as session:
+        stmt = select(Meme).where(Meme.creator_telegram_id == user_telegram_id).order_by(Meme.id.desc())
 
-            result = await session.execute(stmt)
+        result = await session.execute(stmt)
 
-            memes = result.scalars().all()
-            return memes
+        memes = result.scalars().all()
+        return memes
 
 async def get_meme_by_id_and_check_user(meme_id: int, user_telegram_id: int) -> Optional[Meme]:
-    async with session_maker() as session:
-        async with session.begin():
-            stmt = select(Meme).where(Meme.id == meme_id).where(Meme.creator_telegram_id == user_telegram_id)
-
-            result = await session.execute(stmt)
-
-            meme = result.scalars().first()
-            return meme
+    """Meme loaded earlier in the same update is taken from identity map without query"""
+    async with unit_of_work() as session:
+        meme = await session.get(Meme, meme_id)
+        if meme is None or meme.creator_telegram_id != user_telegram_id:
+            return None
+        return meme
 
 
 async def delete_meme_check_and_check_user(meme_id: int, user_telegram_id: int) -> bool:
     try:
-        async with session_maker() as session:
-            async with session.begin():
-                stmt = delete(Meme).where(Meme.id == meme_id).where(Meme.creator_telegram_id == user_telegram_id)
+        async with transaction() as session:
+            users_meme = select(Meme.id).where(Meme.id == meme_id).where(Meme.creator_telegram_id == user_telegram_id)
+            await session.execute(delete(MemeToCollection).where(MemeToCollection.meme_id.in_(users_meme)))
+
+            stmt = delete(Meme).where(Meme.id == meme_id).where(Meme.creator_telegram_id == user_telegram_id)
 
-                result = await session.execute(stmt)
+            result = await session.execute(stmt)
     except Exception as e:
         logger.error(f"Error while deleting meme: {e}")
         return False
@@ -188,10 +577,9 @@ async def delete_meme_check_and_check_user(meme_id: int, user_telegram_id: int)
 
 async def rename_meme_and_check_user(meme_id: int, user_telegram_id: int, new_name: str) -> bool:
     try:
-        async with session_maker() as session:
-            async with session.begin():
-                stmt = update(Meme).where(Meme.id == meme_id).where(Meme.creator_telegram_id == user_telegram_id).values(title=new_name)
-                result = await session.execute(stmt)
+        async with transaction() as session:
+            stmt = update(Meme).where(Meme.id == meme_id).where(Meme.creator_telegram_id == user_telegram_id).values(title=new_name)
+            result = await session.execute(stmt)
     except Exception as e:
         logger.error(f"Error while deleting meme: {e}")
         return False
@@ -200,6 +588,179 @@ async def rename_meme_and_check_user(meme_id: int, user_telegram_id: int, new_na
 
 
 
+async def get_selected_memes(user_telegram_id: int) -> set[int]:
+    async with unit_of_work() as session:
+        result = await session.scalars(select(SelectedMeme.meme_id)
+                                       .where(SelectedMeme.user_telegram_id == user_telegram_id))
+        return set(result.all())
+
+
+async def toggle_selected_meme(user_telegram_id: int, meme_id: int, limit: int) -> None:
+    """Unselect meme if it's selected, otherwise select it if less than limit memes are selected"""
+    async with transaction() as session:
+        await ensure_user_exists(session, user_telegram_id)
+        unselected = await session.execute(
+            delete(SelectedMeme)
+            .where(SelectedMeme.user_telegram_id == user_telegram_id, SelectedMeme.meme_id == meme_id)
+            .returning(SelectedMeme.meme_id))
+        if unselected.first() is None:
+            await _select_memes(session, user_telegram_id, [meme_id], limit)
+
+
+async def toggle_selected_page(user_telegram_id: int, meme_ids: list[int], limit: int) -> None:
+    """Unselect memes if all of them are selected, otherwise select them up to limit"""
+    async with transaction() as session:
+        await ensure_user_exists(session, user_telegram_id)
+        selected = set((await session.scalars(
+            select(SelectedMeme.meme_id)
+            .where(SelectedMeme.user_telegram_id == user_telegram_id, SelectedMeme.meme_id.in_(meme_ids)))).all())
+        if selected >= set(meme_ids):
+            await session.execute(delete(SelectedMeme).where(SelectedMeme.user_telegram_id == user_telegram_id,
+                                                             SelectedMeme.meme_id.in_(meme_ids)))
+        else:
+            await _select_memes(session, user_telegram_id, [meme_id for meme_id in meme_ids if meme_id not in selected],
+                                limit)
+
+
+async def _select_memes(session: AsyncSession, user_telegram_id: int, meme_ids: list[int], limit: int) -> None:
+    count = await session.scalar(select(func.count()).select_from(SelectedMeme)
+                                 .where(SelectedMeme.user_telegram_id == user_telegram_id))
+    meme_ids = meme_ids[:max(limit - count, 0)]
+    if meme_ids:
+        await session.execute(insert(SelectedMeme)
+                              .values([{"user_telegram_id": user_telegram_id, "meme_id": meme_id} for meme_id in meme_ids])
+                              .on_conflict_do_nothing())
+
+
+async def clear_selected_memes(user_telegram_id: int, meme_ids: Optional[list[int]] = None) -> None:
+    """Unselect given memes, or all memes of user"""
+    async with transaction() as session:
+        stmt = delete(SelectedMeme).where(SelectedMeme.user_telegram_id == user_telegram_id)
+        if meme_ids is not None:
+            stmt = stmt.where(SelectedMeme.meme_id.in_(meme_ids))
+        await session.execute(stmt)
+
+
+# Bulk actions change all selected memes with one statement, so pgroonga indexes, triggers and WAL
+# are handled once per batch. Memes that already are in wanted state aren't touched at all
+
+async def bulk_delete_memes(meme_ids: list[int], user_telegram_id: int) -> int:
+    """Delete user's memes and their collection entries. Returns amount of deleted memes"""
+    try:
+        async with transaction() as session:
+            # Foreign key is checked at the end of statement, when both deletes are done
+            result = await session.execute(text("""
+                WITH deleted AS (
+                    DELETE FROM memes
+                    WHERE id = ANY(CAST(:ids AS bigint[])) AND creator_telegram_id = :user_id
+                    RETURNING id
+                ), deleted_entries AS (
+                    DELETE FROM meme_to_collection
+                    WHERE meme_id IN (SELECT id FROM deleted)
+                )
+                SELECT count(*) FROM deleted
+            """), {"ids": meme_ids, "user_id": user_telegram_id})
+            return result.scalar_one()
+    except Exception as e:
+        logger.error(f"Error while deleting memes: {e}")
+        return 0
+
+
+async def bulk_set_memes_public(meme_ids: list[int], user_telegram_id: int, is_public: bool) -> int:
+    """
+    Make user's memes public or private. Memes whose file already has a meme in that state are skipped,
+    there can be only one public meme and one private meme of user for every file.
+    Returns amount of changed memes
+    """
+    try:
+        async with transaction() as session:
+            result = await session.execute(text("""
+                UPDATE memes SET is_public = :is_public
+                WHERE id = ANY(CAST(:ids AS bigint[])) AND creator_telegram_id = :user_id
+                  AND is_public <> :is_public
+                  AND NOT EXISTS (
+                      SELECT 1 FROM memes AS other
+                      WHERE other.telegram_file_unique_id = memes.telegram_file_unique_id
+                        AND other.is_public = :is_public
+                        AND (:is_public OR other.creator_telegram_id = :user_id)
+                  )
+            """), {"ids": meme_ids, "user_id": user_telegram_id, "is_public": is_public})
+            return result.rowcount
+    except Exception as e:
+        logger.error(f"Error while changing visibility of memes: {e}")
+        return 0
+
+
+async def bulk_add_tag(meme_ids: list[int], user_telegram_id: int, tag: str, max_tags: int) -> int:
+    """Add tag to user's memes that don't have it and have less than max_tags tags. Returns amount of changed memes"""
+    try:
+        async with transaction() as session:
+            result = await session.execute(text("""
+                UPDATE memes SET tags = array_append(tags, :tag)
+                WHERE id = ANY(CAST(:ids AS bigint[])) AND creator_telegram_id = :user_id
+                  AND NOT (:tag = ANY(tags)) AND cardinality(tags) < :max_tags
+            """), {"ids": meme_ids, "user_id": user_telegram_id, "tag": tag, "max_tags": max_tags})
+            return result.rowcount
+    except Exception as e:
+        logger.error(f"Error while adding tag to memes: {e}")
+        return 0
+
+
+async def bulk_remove_tag(meme_ids: list[int], user_telegram_id: int, tag: str) -> int:
+    """Remove tag from user's memes that have it. Returns amount of changed memes"""
+    try:
+        async with transaction() as session:
+            result = await session.execute(text("""
+                UPDATE memes SET tags = array_remove(tags, :tag)
+                WHERE id = ANY(CAST(:ids AS bigint[])) AND creator_telegram_id = :user_id
+                  AND :tag = ANY(tags)
+            """), {"ids": meme_ids, "user_id": user_telegram_id, "tag": tag})
+            return result.rowcount
+    except Exception as e:
+        logger.error(f"Error while removing tag from memes: {e}")
+        return 0
+
+
+async def write_inline_query_log(entries: list[dict]) -> None:
+    """Insert batch of inline query log entries in one statement"""
+    async with transaction() as session:
+        await session.execute(insert(InlineQueryLog), entries)
+
+
+async def rollup_top_inline_queries() -> bool:
+    """
+    Rebuild top_inline_queries from recent log and delete log older than QUERY_LOG_RETENTION_DAYS.
+    Every bot process runs it, only one of them does it at a time, others return False
+    """
+    async with transaction() as session:
+        locked = await session.scalar(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": ROLLUP_LOCK_KEY})
+        if not locked:
+            return False
+        await session.execute(delete(InlineQueryLog).where(
+            InlineQueryLog.logged_at < func.now() - timedelta(days=QUERY_LOG_RETENTION_DAYS)))
+        await session.execute(delete(TopInlineQuery))
+        await session.execute(text("""
+            INSERT INTO top_inline_queries (query, searches, avg_result_count, avg_latency_ms, cache_hit_ratio)
+            SELECT query, count(*), avg(result_count), avg(latency_ms),
+                   coalesce(sum(cached_results)::float / nullif(sum(result_count), 0), 0)
+            FROM inline_query_log
+            WHERE logged_at > now() - make_interval(days => :days)
+            GROUP BY query
+            ORDER BY count(*) DESC
+            LIMIT :limit
+        """), {"days": TOP_QUERIES_WINDOW_DAYS, "limit": TOP_QUERIES_AMOUNT})
+    return True
+
+
+async def get_top_inline_queries(limit: int) -> list[str]:
+    async with unit_of_work() as session:
+        result = await session.scalars(select(TopInlineQuery.query)
+                                       .order_by(TopInlineQuery.searches.desc())
+                                       .limit(limit))
+        return list(result.all())
+
+
 async def close_all_connections():
-    close_all_sessions()
-    await engine.dispose()
+    if _warm_up_task:
+        _warm_up_task.cancel()
+    await db_engine.close()
@@ -0,0 +1,76 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+from memes_db.models import MediaType
+
+TAG_PREFIX = "#"
+COLLECTION_PREFIX = "@"
+MEDIA_TYPE_SEPARATOR = ":"
+MEDIA_TYPES_BY_PREFIX = {media_type.value: media_type for media_type in MediaType}
+
+
+def normalize_tag(tag: str) -> str:
+    """Tags are stored lowercase and without leading #, so #Cat and cat are the same tag"""
+    return tag.strip().lstrip(TAG_PREFIX).strip().lower()
+
+
+@dataclass
+class ParsedQuery:
+    # Text for full text search
+    text: str = ""
+    # Memes must have all of these tags
+    tags: list[str] = field(default_factory=list)
+    # Search only memes of this media type
+    media_type: Optional[MediaType] = None
+    # Search only in saved collection with this name or id, empty string means all saved collections
+    collection: Optional[str] = None
+
+    def is_empty(self) -> bool:
+        return not self.text and not self.tags and self.media_type is None and self.collection is None
+
+
+def normalize_collection_name(name: str) -> str:
+    """Collection names in queries can't have spaces, so "Funny cats" is written as @funny_cats"""
+    return "_".join(name.lower().split())
+
+
+def parse_inline_query(query: str) -> ParsedQuery:
+    """
+    Split inline query into filters and search text.
+    "#cat #funny dog" means memes with tags cat and funny that match "dog",
+    "gif:dog" or "gif: dog" means gifs that match "dog",
+    "@funny_cats dog" means memes from saved collection "Funny cats" that match "dog"
+    """
+    parsed = ParsedQuery()
+    words = []
+    for word in query.split():
+        prefix, separator, rest = word.partition(MEDIA_TYPE_SEPARATOR)
+        if separator and parsed.media_type is None and prefix.lower() in MEDIA_TYPES_BY_PREFIX:
+            parsed.media_type = MEDIA_TYPES_BY_PREFIX[prefix.lower()]
+            word = rest
+            if not word:
+                continue
+
+        if word.startswith(COLLECTION_PREFIX) and parsed.collection is None:
+            parsed.collection = normalize_collection_name(word[len(COLLECTION_PREFIX):])
+        elif word.startswith(TAG_PREFIX):
+            tag = normalize_tag(word)
+            if tag and tag not in parsed.tags:
+                parsed.tags.append(tag)
+        else:
+            words.append(word)
+    parsed.text = " ".join(words)
+    return parsed
+
+
+def resolve_collections(name: str, saved_collections: list[tuple[int, str]]) -> list[int]:
+    """
+    Ids of saved collections that query refers to
+    Args:
+        name: collection from parsed query, id or normalized name
+        saved_collections: (id, title) of collections saved by user
+    """
+    if not name:
+        return [collection_id for collection_id, _ in saved_collections]
+    return [collection_id for collection_id, title in saved_collections
+            if name == str(collection_id) or normalize_collection_name(title).startswith(name)]
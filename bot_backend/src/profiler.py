@@ -0,0 +1,151 @@
+"""
+Sampling profiler for update handlers, switched on at runtime by /profile admin command or SIGUSR1.
+
+While it is on, a thread takes stack of event loop thread every SAMPLE_INTERVAL while an update is handled.
+Stacks are written in folded format (one "root;frame;frame count" line per stack) that flamegraph.pl,
+speedscope and inferno read, with name of handler callback as root frame.
+Updates that take longer than slow update threshold get a profile file of their own.
+When both are off no thread runs and handling an update costs one attribute check.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Iterable, Optional
+
+from telegram.ext import BaseHandler, ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.005
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "profiles"))
+# Event loop waits for I/O in these, samples in them are counted as waiting
+_WAITING_FUNCTIONS = {"select", "poll", "epoll", "_run_once"}
+
+
+def _frame_label(code: CodeType) -> str:
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        # Updates slower than that many seconds are dumped to files, None to not capture them
+        self.slow_update_threshold: Optional[float] = None
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+
+        self._handler_names: dict[CodeType, str] = {}
+        self._loop_thread_id = threading.get_ident()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # Samples of update that is handled now, appended by sampling thread
+        self._update_started: Optional[float] = None
+        self._update_samples: list[tuple[CodeType, ...]] = []
+
+    @property
+    def active(self) -> bool:
+        return self.enabled or self.slow_update_threshold is not None
+
+    def register_handlers(self, handlers: Iterable[BaseHandler]) -> None:
+        """Remember callbacks of handlers, so samples are grouped by handler"""
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                self.register_handlers(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    self.register_handlers(state_handlers)
+                self.register_handlers(handler.fallbacks)
+            elif hasattr(handler.callback, "__code__"):
+                self._handler_names[handler.callback.__code__] = handler.callback.__name__
+
+    def start(self) -> None:
+        self.enabled = True
+        self._start_thread()
+        logger.info("Profiling started")
+
+    def stop(self) -> Optional[Path]:
+        """Stop profiling and dump collected stacks. Returns dump file if anything was collected"""
+        self.enabled = False
+        if not self.active:
+            self._stop_thread()
+        path = self.dump()
+        logger.info(f"Profiling stopped, stacks written to {path}")
+        return path
+
+    def capture_slow_updates(self, threshold: Optional[float]) -> None:
+        self.slow_update_threshold = threshold
+        if self.active:
+            self._start_thread()
+        else:
+            self._stop_thread()
+
+    def dump(self) -> Optional[Path]:
+        if not self.stacks:
+            return None
+        stacks, self.stacks = self.stacks, Counter()
+        return self._write(f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded", stacks)
+
+    def update_started(self) -> None:
+        self._update_samples = []
+        self._update_started = time.perf_counter()
+
+    def update_finished(self, update_id: int) -> None:
+        elapsed = time.perf_counter() - self._update_started
+        self._update_started = None
+        samples = [self._fold(sample) for sample in self._update_samples]
+        if self.enabled:
+            self.stacks.update(samples)
+        if self.slow_update_threshold is not None and elapsed >= self.slow_update_threshold and samples:
+            path = self._write(f"slow-{update_id}-{elapsed * 1000:.0f}ms.folded", Counter(samples))
+            logger.warning(f"Update {update_id} took {elapsed * 1000:.0f} ms, profile written to {path}")
+
+    def _fold(self, sample: tuple[CodeType, ...]) -> tuple[str, ...]:
+        """Stack from outermost frame, starting at handler callback, with handler name as root"""
+        for depth, code in enumerate(sample):
+            handler_name = self._handler_names.get(code)
+            if handler_name is not None:
+                return (handler_name, *map(_frame_label, sample[depth:]))
+        if sample and sample[-1].co_name in _WAITING_FUNCTIONS:
+            return ("(waiting)",)
+        return ("(update)", *map(_frame_label, sample))
+
+    def _write(self, name: str, stacks: Counter) -> Path:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_DIR / name
+        with open(path, "w") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{';'.join(stack)} {count}\n")
+        return path
+
+    def _start_thread(self) -> None:
+        if self._thread is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _stop_thread(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _sample(self) -> None:
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            if self._update_started is None:
+                continue
+            frame: Optional[FrameType] = sys._current_frames().get(self._loop_thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            self._update_samples.append(tuple(stack))
+
+
+profiler = Profiler()
@@ -0,0 +1,113 @@
+"""
+Sampled log of inline queries. Inline query handler only appends entries to a buffer in memory,
+background task writes buffer to database in batches and periodically rolls log up into top_inline_queries.
+"""
+import asyncio
+import logging
+import random
+from typing import Optional
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Buffer is written at least that often, or as soon as it has BATCH_SIZE entries
+FLUSH_INTERVAL = 10
+BATCH_SIZE = 500
+# Entries are dropped instead of buffered if database can't keep up
+MAX_BUFFERED = 10000
+ROLLUP_INTERVAL = 60 * 60
+
+sample_rate = 0.0
+_buffer: list[dict] = []
+_dropped = 0
+_flush_needed: Optional[asyncio.Event] = None
+_tasks: list[asyncio.Task] = []
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def record(query: str, result_count: int, latency: float, tier: str, cached_results: int) -> None:
+    """
+    Log inline query with probability sample_rate
+    Args:
+        query: raw text of inline query
+        latency: seconds spent searching and building results
+        tier: where results came from, "index" or "database"
+        cached_results: how many of results were already built
+    """
+    global _dropped
+    if _flush_needed is None or random.random() >= sample_rate:
+        return
+    if len(_buffer) >= MAX_BUFFERED:
+        _dropped += 1
+        return
+    _buffer.append({
+        "query": normalize_query(query),
+        "result_count": result_count,
+        "latency_ms": latency * 1000,
+        "tier": tier,
+        "cached_results": cached_results,
+    })
+    if len(_buffer) >= BATCH_SIZE:
+        _flush_needed.set()
+
+
+async def flush() -> None:
+    global _buffer, _dropped
+    if _dropped:
+        logger.warning(f"Dropped {_dropped} inline query log entries, buffer was full")
+        _dropped = 0
+    if not _buffer:
+        return
+    entries, _buffer = _buffer, []
+    try:
+        await database.write_inline_query_log(entries)
+    except Exception as e:
+        logger.error(f"Failed to write {len(entries)} inline query log entries: {e}")
+
+
+async def _flush_periodically() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_flush_needed.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_needed.clear()
+        await flush()
+
+
+async def _rollup_periodically() -> None:
+    while True:
+        await asyncio.sleep(ROLLUP_INTERVAL)
+        try:
+            if not await database.rollup_top_inline_queries():
+                logger.debug("Inline query log is being rolled up by other process")
+        except Exception as e:
+            logger.error(f"Failed to roll up inline query log: {e}")
+
+
+def start(rate: float) -> None:
+    """Start logging share rate of inline queries, does nothing if rate is 0"""
+    global sample_rate, _flush_needed
+    if rate <= 0:
+        return
+    sample_rate = rate
+    _flush_needed = asyncio.Event()
+    _tasks.append(asyncio.create_task(_flush_periodically()))
+    _tasks.append(asyncio.create_task(_rollup_periodically()))
+
+
+async def stop() -> None:
+    """Stop background tasks and write what is left in buffer"""
+    global _flush_needed
+    if _flush_needed is None:
+        return
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    _flush_needed = None
+    await flush()
@@ -0,0 +1,327 @@
+"""
+In-process search over public memes.
+
+Public memes are kept in an inverted index inside the bot process, so most inline
+queries are answered without a round trip to the database. The index is built on
+startup and kept up to date by change feed.
+User's private memes are still searched in the database and merged with index results.
+"""
+import heapq
+import logging
+import re
+import unicodedata
+from array import array
+from collections import namedtuple, Counter
+from typing import Optional, Iterable
+
+import change_feed
+import database
+from memes_db import repository
+
+logger = logging.getLogger(__name__)
+
+# Same value as fuzzy_max_distance_ratio in pgroonga search
+FUZZY_MAX_DISTANCE_RATIO = 0.34
+# Weight of whole query found in title, same as in pgroonga search
+TITLE_PHRASE_WEIGHT = 5
+# Compact index when this share of documents is deleted
+COMPACT_DELETED_RATIO = 0.25
+FUZZY_CACHE_SIZE = 10000
+# Search runs on the event loop, these cutoffs keep common terms from stalling it.
+# Only newest memes of a token are scored, postings are in order memes were added
+MAX_POSTINGS_PER_TOKEN = 2000
+# Closest tokens that a misspelled term matches
+MAX_FUZZY_TOKENS = 20
+
+MEDIA_TYPES = ("audio", "gif", "photo", "video", "voice")
+MEDIA_TYPE_CODES = {media_type: code for code, media_type in enumerate(MEDIA_TYPES)}
+
+# Looks like database search rows, so generate_inline_list can use both
+IndexedMeme = namedtuple("IndexedMeme", ["id", "title", "telegram_media_id", "telegram_file_unique_id",
+                                         "media_type", "is_public", "score"])
+
+NOT_WORD_PATTERN = re.compile(r"[\W_]+")
+
+
+def normalize(text: str) -> str:
+    """Approximation of NormalizerNFKC150("remove_symbol", true)"""
+    return NOT_WORD_PATTERN.sub(" ", unicodedata.normalize("NFKC", text).casefold())
+
+
+def tokenize(text: str) -> list[str]:
+    return normalize(text).split()
+
+
+def trigrams(token: str) -> set[str]:
+    padded = f"^{token}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def levenshtein(a: str, b: str, max_distance: int) -> int:
+    """Edit distance between a and b, or max_distance + 1 if it is bigger than max_distance"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class SearchIndex:
+    """
+    Inverted index over titles and tags of public memes.
+
+    Documents are stored in parallel arrays, postings are arrays of document positions.
+    Deleted documents are only marked as dead and removed from postings on compaction.
+    """
+
+    def __init__(self):
+        self.meme_ids = array("q")
+        self.titles: list[str] = []
+        self.media_ids: list[str] = []
+        self.file_unique_ids: list[Optional[str]] = []
+        self.media_types = bytearray()
+        self.alive = bytearray()
+        self.position_by_meme_id: dict[int, int] = {}
+        self.dead_count = 0
+
+        self.title_postings: dict[str, array] = {}
+        self.tag_postings: dict[str, array] = {}
+
+        # token -> trigram lookup for fuzzy search
+        self.vocabulary: dict[str, int] = {}
+        self.tokens: list[str] = []
+        self.trigram_postings: dict[str, array] = {}
+        # term -> matching tokens, cleared when vocabulary changes
+        self.fuzzy_cache: dict[str, list[str]] = {}
+
+    def __len__(self):
+        return len(self.position_by_meme_id)
+
+    def _add_token(self, token: str) -> None:
+        if token in self.vocabulary:
+            return
+        token_id = len(self.tokens)
+        self.vocabulary[token] = token_id
+        self.fuzzy_cache.clear()
+        self.tokens.append(token)
+        for trigram in trigrams(token):
+            self.trigram_postings.setdefault(trigram, array("I")).append(token_id)
+
+    @staticmethod
+    def _add_postings(postings: dict[str, array], tokens: Iterable[str], position: int) -> None:
+        for token in tokens:
+            postings.setdefault(token, array("I")).append(position)
+
+    def add(self, meme_id: int, title: str, tags: Optional[list[str]], telegram_media_id: str,
+            telegram_file_unique_id: Optional[str], media_type: str) -> None:
+        """Add meme to the index, replacing old version of it"""
+        media_type_code = MEDIA_TYPE_CODES.get(media_type)
+        if media_type_code is None:
+            return
+        self.remove(meme_id)
+
+        position = len(self.meme_ids)
+        self.meme_ids.append(meme_id)
+        self.titles.append(title)
+        self.media_ids.append(telegram_media_id)
+        self.file_unique_ids.append(telegram_file_unique_id)
+        self.media_types.append(media_type_code)
+        self.alive.append(1)
+        self.position_by_meme_id[meme_id] = position
+
+        title_tokens = tokenize(title)
+        tag_tokens = [token for tag in tags or [] for token in tokenize(tag)]
+        self._add_postings(self.title_postings, title_tokens, position)
+        self._add_postings(self.tag_postings, tag_tokens, position)
+        for token in title_tokens + tag_tokens:
+            self._add_token(token)
+
+    def remove(self, meme_id: int) -> None:
+        position = self.position_by_meme_id.pop(meme_id, None)
+        if position is None:
+            return
+        self.alive[position] = 0
+        self.dead_count += 1
+
+    def needs_compaction(self) -> bool:
+        return self.dead_count > len(self.meme_ids) * COMPACT_DELETED_RATIO
+
+    def compact(self) -> "SearchIndex":
+        """Build new index without deleted documents. Tags are taken from old postings"""
+        tags_by_position: dict[int, list[str]] = {}
+        for token, positions in self.tag_postings.items():
+            for position in positions:
+                if self.alive[position]:
+                    tags_by_position.setdefault(position, []).append(token)
+
+        compacted = SearchIndex()
+        for position, meme_id in enumerate(self.meme_ids):
+            if self.alive[position]:
+                compacted.add(meme_id, self.titles[position], tags_by_position.get(position),
+                              self.media_ids[position], self.file_unique_ids[position], MEDIA_TYPES[self.media_types[position]])
+        return compacted
+
+    def _matching_tokens(self, term: str) -> list[str]:
+        """Term itself and all tokens within fuzzy distance of it"""
+        cached = self.fuzzy_cache.get(term)
+        if cached is not None:
+            return cached
+
+        max_distance = int(len(term) * FUZZY_MAX_DISTANCE_RATIO)
+        if max_distance == 0:
+            matching = [term] if term in self.vocabulary else []
+        else:
+            term_trigrams = trigrams(term)
+            shared_trigrams = Counter()
+            for trigram in term_trigrams:
+                shared_trigrams.update(self.trigram_postings.get(trigram, ()))
+
+            # Every edit destroys at most 3 trigrams, so tokens sharing less can't be close enough
+            min_shared = len(term_trigrams) - 3 * max_distance
+            distances = []
+            for token_id, shared in shared_trigrams.items():
+                if shared >= min_shared:
+                    distance = levenshtein(term, self.tokens[token_id], max_distance)
+                    if distance <= max_distance:
+                        distances.append((distance, self.tokens[token_id]))
+            matching = [token for _, token in heapq.nsmallest(MAX_FUZZY_TOKENS, distances)]
+
+        if len(self.fuzzy_cache) >= FUZZY_CACHE_SIZE:
+            self.fuzzy_cache.clear()
+        self.fuzzy_cache[term] = matching
+        return matching
+
+    def search(self, query: str, limit: int, media_type: Optional[str] = None) -> list[IndexedMeme]:
+        """
+        Score is close to pgroonga_score of database search:
+        every matched term in title or tags adds 1, whole query in title adds TITLE_PHRASE_WEIGHT.
+        Older memes of very common tokens are left out, see MAX_POSTINGS_PER_TOKEN
+        Args:
+            media_type: value of MediaType, only memes of this type are returned
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        scores = Counter()
+        title_scores = Counter()
+        for term in terms:
+            for token in self._matching_tokens(term):
+                title_scores.update(self.title_postings.get(token, ())[-MAX_POSTINGS_PER_TOKEN:])
+                scores.update(self.tag_postings.get(token, ())[-MAX_POSTINGS_PER_TOKEN:])
+        scores.update(title_scores)
+
+        # Whole query can be in title only if every term matched title.
+        # One term query is the whole query, so titles don't have to be checked
+        normalized_query = " ".join(terms)
+        for position, title_score in title_scores.items():
+            if title_score >= len(terms) and (len(terms) == 1 or
+                                              normalized_query in " ".join(tokenize(self.titles[position]))):
+                scores[position] += TITLE_PHRASE_WEIGHT
+
+        alive = self.alive
+        if media_type is None:
+            scores = [(position, score) for position, score in scores.items() if alive[position]]
+        else:
+            media_type_code = MEDIA_TYPE_CODES[media_type]
+            media_types = self.media_types
+            scores = [(position, score) for position, score in scores.items()
+                      if alive[position] and media_types[position] == media_type_code]
+        best = heapq.nsmallest(limit, scores, key=lambda item: (-item[1], -self.meme_ids[item[0]]))
+        return [IndexedMeme(id=self.meme_ids[position],
+                            title=self.titles[position],
+                            telegram_media_id=self.media_ids[position],
+                            telegram_file_unique_id=self.file_unique_ids[position],
+                            media_type=MEDIA_TYPES[self.media_types[position]],
+                            is_public=True,
+                            score=score)
+                for position, score in best]
+
+
+index: Optional[SearchIndex] = None
+
+
+async def build_index() -> SearchIndex:
+    new_index = SearchIndex()
+    async for row in database.stream_public_memes_for_index():
+        new_index.add(row.id, row.title, row.tags, row.telegram_media_id, row.telegram_file_unique_id, row.media_type)
+    return new_index
+
+
+async def load() -> None:
+    """Build index from database"""
+    global index
+    index = await build_index()
+    logger.info(f"Search index built with {len(index)} public memes")
+
+
+async def apply_changes(changes: list[change_feed.Change]) -> None:
+    """Apply batch of memes changes. Rows of all new or updated public memes are fetched in one query"""
+    global index
+    if index is None:
+        return
+
+    changed_public_ids = []
+    for change in changes:
+        if change.op == "D" or not change.public:
+            index.remove(change.id)
+        else:
+            changed_public_ids.append(change.id)
+
+    if changed_public_ids:
+        for row in await database.get_public_memes_by_ids(changed_public_ids):
+            index.add(row.id, row.title, row.tags, row.telegram_media_id, row.telegram_file_unique_id, row.media_type)
+
+    if index.needs_compaction():
+        index = index.compact()
+
+
+async def apply_ban_changes(changes: list[change_feed.Change]) -> None:
+    """Drop public memes of banned users from index and bring them back when users are unbanned"""
+    if index is None:
+        return
+
+    for change in changes:
+        if change.banned is None:
+            continue
+        meme_ids = await database.get_public_meme_ids_of_user(change.id)
+        if change.banned:
+            for meme_id in meme_ids:
+                index.remove(meme_id)
+        elif meme_ids:
+            for row in await database.get_public_memes_by_ids(meme_ids):
+                index.add(row.id, row.title, row.tags, row.telegram_media_id, row.telegram_file_unique_id,
+                          row.media_type)
+
+
+def start() -> None:
+    """Build index when change feed connects and keep it updated. Until it's built is_ready() returns False"""
+    change_feed.subscribe("memes", apply_changes, on_resync=load)
+    change_feed.subscribe("users", apply_ban_changes)
+
+
+def is_ready() -> bool:
+    return index is not None
+
+
+async def search(query: str, user_id: int, limit: int, media_type=None) -> list:
+    """
+    Search public memes in index and user's private memes in database.
+    Users known to have no private memes, see database.private_meme_creators, are served from index alone
+    Args:
+        media_type: MediaType to search only memes of this type
+    """
+    results = index.search(query, limit, media_type.value if media_type else None)
+    if not database.has_no_private_memes(user_id):
+        private = await database.search_for_private_meme_inline_by_query(query, user_id, media_type)
+        merged = sorted(list(results) + list(private), key=lambda meme: -meme.score)
+        results = repository.collapse_duplicates(merged, limit)
+    return results
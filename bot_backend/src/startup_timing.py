@@ -0,0 +1,26 @@
+"""
+Time of startup steps since this module was imported, which is the first thing bot does.
+Report is logged when first update is handled, so it shows time to first update.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_started = time.perf_counter()
+_steps: list[tuple[str, float]] = []
+_reported = False
+
+
+def mark(step: str) -> None:
+    _steps.append((step, time.perf_counter() - _started))
+
+
+def report_once(step: str) -> None:
+    """Mark last step and log all of them, only first call does anything"""
+    global _reported
+    if _reported:
+        return
+    _reported = True
+    mark(step)
+    logger.info("Startup timing: " + ", ".join(f"{name} {seconds:.3f} s" for name, seconds in _steps))
@@ -1,5 +1,5 @@
 from telegram import Message
-from src.models import MediaType
+from memes_db.models import MediaType
 from typing import Optional
 
 
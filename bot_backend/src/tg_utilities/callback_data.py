@@ -0,0 +1,65 @@
+import base64
+import hashlib
+import hmac
+from dataclasses import dataclass, fields, replace
+from os import getenv
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+# All bot processes must share this key, otherwise menus made by one can't be used in another
+_SECRET = getenv("CALLBACK_SECRET") or getenv("BOT_KEY")
+if not _SECRET:
+    # Anyone could sign callback data with an empty key, including delete and visibility buttons
+    raise RuntimeError("CALLBACK_SECRET or BOT_KEY has to be set to sign callback data")
+_SECRET_KEY = hashlib.sha256(_SECRET.encode()).digest()
+SIGNATURE_LENGTH = 8
+
+
+@dataclass(frozen=True)
+class MenuState:
+    """
+    State of memes menu that is carried in callback data of its buttons,
+    so any bot process can handle button press without stored user data.
+    Zero means there is no selected meme, media message, collection or selection
+    """
+    page: int = 0
+    meme_id: int = 0
+    media_message_id: int = 0
+    collection_id: int = 0
+    # selection_fingerprint() of memes shown on bulk delete confirmation
+    selection: int = 0
+
+    def with_changes(self, **changes) -> "MenuState":
+        return replace(self, **changes)
+
+
+def selection_fingerprint(meme_ids: set[int]) -> int:
+    """Nonzero 32 bit hash of selected memes, confirmation acts only on the selection it showed"""
+    digest = hashlib.sha256(",".join(map(str, sorted(meme_ids))).encode()).digest()
+    return int.from_bytes(digest[:4], "big") or 1
+
+
+def _sign(prefix: str, payload: str, chat_id: int) -> str:
+    digest = hmac.new(_SECRET_KEY, f"{chat_id}:{prefix}{payload}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:SIGNATURE_LENGTH]).decode().rstrip("=")
+
+
+def encode_callback(prefix: str, state: MenuState, chat_id: int) -> str:
+    """Encode state into callback data like "page:1.0.0.0.0.signature". Signature is bound to chat"""
+    payload = f"{state.page}.{state.meme_id}.{state.media_message_id}.{state.collection_id}.{state.selection}"
+    return f"{prefix}{payload}.{_sign(prefix, payload, chat_id)}"
+
+
+def decode_callback(data: str, chat_id: int) -> Optional[MenuState]:
+    """Returns None if data is malformed or wasn't made by this bot for this chat"""
+    prefix, body = data[:5], data[5:]
+    payload, _, signature = body.rpartition(".")
+    if not hmac.compare_digest(signature, _sign(prefix, payload, chat_id)):
+        return None
+    try:
+        values = list(map(int, payload.split(".")))
+        return MenuState(*values) if len(values) == len(fields(MenuState)) else None
+    except ValueError:
+        return None
@@ -1,60 +1,53 @@
 from typing import Optional, Union
 
 
-from telegram import Message, InlineKeyboardMarkup
-from telegram.ext import ContextTypes
-from src.models import Meme, MediaType
+from telegram import InlineKeyboardMarkup, Bot
+from telegram.error import BadRequest
+from memes_db.models import Meme, MediaType
 
 class MemeMenu:
+    """
+    Memes menu made of text message with buttons and optional message with media of selected meme.
+    Only ids of messages are kept, so menu can be restored from any callback query
+    """
+    __slots__ = ("chat_id", "text_message_id", "media_message_id")
+
     def __init__(self,
-                 text_message: Optional[Message],
-                 media_message: Optional[Message] = None):
-        self.text_message = text_message
-        self.media_message = media_message
-
-    async def switch_state(self, context: ContextTypes.DEFAULT_TYPE,
-                           chat_id: Union[int, str],
-                           new_text: str,
-                           reply_markup: Optional[InlineKeyboardMarkup] = None,
-                           new_meme: Optional[Meme] = None,
-                           delete_media: bool = False):
-        if self.text_message:
-            await self.text_message.edit_text(text=new_text, reply_markup=reply_markup)
-
-        if delete_media:
-            await self.delete_media()
-
-        if new_meme:
-            await self.delete_media()
-
-            meme_media_type = new_meme.media_type
-            if meme_media_type.value == MediaType.PHOTO.value:
-                self.media_message = await context.bot.sendPhoto(photo=new_meme.telegram_media_id,
-                                                                 chat_id=chat_id)
-            elif meme_media_type.value == MediaType.VIDEO.value:
-                self.media_message = await context.bot.sendVideo(video=new_meme.telegram_media_id,
-                                                                 chat_id=chat_id)
-            elif meme_media_type.value == MediaType.GIF.value:
-                self.media_message = await context.bot.sendAnimation(animation=new_meme.telegram_media_id,
-                                                                     chat_id=chat_id)
-            elif meme_media_type.value == MediaType.VOICE.value:
-                self.media_message = await context.bot.sendVoice(voice=new_meme.telegram_media_id,
-                                                                 chat_id=chat_id)
-
-
-
-    async def destroy(self):
-        await self.delete_text()
-        await self.delete_media()
-
-
-    async def delete_text(self):
-        if isinstance(self.text_message, Message):
-            await self.text_message.delete()
-            self.text_message = None
-
-
-    async def delete_media(self):
-        if isinstance(self.media_message, Message):
-            await self.media_message.delete()
-            self.media_message = None
+                 chat_id: Union[int, str],
+                 text_message_id: Optional[int],
+                 media_message_id: Optional[int] = None):
+        self.chat_id = chat_id
+        self.text_message_id = text_message_id
+        self.media_message_id = media_message_id or None
+
+    async def edit_text(self, bot: Bot, new_text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        if self.text_message_id:
+            await bot.edit_message_text(text=new_text, chat_id=self.chat_id, message_id=self.text_message_id,
+                                        reply_markup=reply_markup)
+
+    async def send_media(self, bot: Bot, new_meme: Meme):
+        await self.delete_media(bot)
+
+        meme_media_type = new_meme.media_type
+        media_message = None
+        if meme_media_type.value == MediaType.PHOTO.value:
+            media_message = await bot.sendPhoto(photo=new_meme.telegram_media_id, chat_id=self.chat_id)
+        elif meme_media_type.value == MediaType.VIDEO.value:
+            media_message = await bot.sendVideo(video=new_meme.telegram_media_id, chat_id=self.chat_id)
+        elif meme_media_type.value == MediaType.GIF.value:
+            media_message = await bot.sendAnimation(animation=new_meme.telegram_media_id, chat_id=self.chat_id)
+        elif meme_media_type.value == MediaType.VOICE.value:
+            media_message = await bot.sendVoice(voice=new_meme.telegram_media_id, chat_id=self.chat_id)
+
+        if media_message:
+            self.media_message_id = media_message.message_id
+
+
+    async def delete_media(self, bot: Bot):
+        if self.media_message_id:
+            try:
+                await bot.delete_message(chat_id=self.chat_id, message_id=self.media_message_id)
+            except BadRequest:
+                # Message was already deleted, e.g. same button was pressed twice
+                pass
+            self.media_message_id = None
@@ -1,6 +1,6 @@
 import math
-from typing import Sequence
-from uuid import uuid4
+from collections import OrderedDict
+from typing import Sequence, Optional, Iterable, Callable, Union
 from telegram import (InlineQueryResultCachedVideo,
                       InlineQueryResultCachedPhoto,
                       InlineQueryResultCachedGif,
@@ -13,21 +13,98 @@ from telegram import (InlineQueryResultCachedVideo,
                       )
 from telegram.ext import ContextTypes
 
-from sqlalchemy import ScalarResult
+from sqlalchemy import ScalarResult, Row
 
 
-from src.models import Meme, MediaType
-from src.tg_utilities.classes import MemeMenu
+from memes_db.models import Meme, MediaType, Collection
+from src.tg_utilities.callback_data import MenuState, encode_callback
 import json
 
-from src.constants import MEMES_PER_PAGE
+from src.constants import MEMES_PER_PAGE, INLINE_RESULT_VERSION, INLINE_RESULTS_CACHE_SIZE
 from src.constants import CALLBACK_MEME, CALLBACK_CONFIRM_DELETE, CALLBACK_PAGE, CALLBACK_DELETE, CALLBACK_RENAME, CALLBACK_BACK
+from src.constants import CALLBACK_COLLECTIONS, CALLBACK_ADD_TO_COLLECTION
+from src.constants import (CALLBACK_SELECT, CALLBACK_TOGGLE, CALLBACK_SELECT_PAGE, CALLBACK_BULK_DELETE,
+                           CALLBACK_BULK_CONFIRM_DELETE, CALLBACK_BULK_ADD_TAG, CALLBACK_BULK_REMOVE_TAG,
+                           CALLBACK_BULK_PUBLIC, CALLBACK_BULK_PRIVATE)
 
 
-async def generate_inline_list(database_data: list[tuple[str, str, str]]) -> Sequence[InlineQueryResult]:
+# meme id -> (title, prebuilt inline result), least recently used first
+_inline_results_cache: OrderedDict[int, tuple[str, InlineQueryResult]] = OrderedDict()
+
+
+def generate_inline_result_id(meme_id: int) -> str:
+    """Result id is derived from meme id so telegram can recognize same result between answers"""
+    return f"{meme_id}v{INLINE_RESULT_VERSION}"
+
+
+# Builds inline result from result id, title and telegram file id
+INLINE_RESULT_BUILDERS: dict[MediaType, Callable[[str, str, str], InlineQueryResult]] = {
+    MediaType.VIDEO: lambda result_id, title, file_id: InlineQueryResultCachedVideo(
+        id=result_id, video_file_id=file_id, title=title),
+    MediaType.PHOTO: lambda result_id, title, file_id: InlineQueryResultCachedPhoto(
+        id=result_id, photo_file_id=file_id, title=title),
+    MediaType.GIF: lambda result_id, title, file_id: InlineQueryResultCachedGif(
+        id=result_id, gif_file_id=file_id, title=title),
+    MediaType.VOICE: lambda result_id, title, file_id: InlineQueryResultCachedVoice(
+        id=result_id, voice_file_id=file_id, title=title),
+    # Cached audio has no title, telegram shows one from file metadata
+    MediaType.AUDIO: lambda result_id, title, file_id: InlineQueryResultCachedAudio(
+        id=result_id, audio_file_id=file_id),
+}
+
+
+def build_inline_result(meme_id: int, title: str, telegram_media_id: str,
+                        media_type: Union[MediaType, str]) -> Optional[InlineQueryResult]:
+    """
+    Args:
+        media_type: MediaType or its value, raw sql queries return values
+    """
+    try:
+        builder = INLINE_RESULT_BUILDERS[MediaType(getattr(media_type, "value", media_type))]
+    except (ValueError, KeyError):
+        return None
+    return builder(generate_inline_result_id(meme_id), title, telegram_media_id)
+
+
+def get_inline_result(meme_id: int, title: str, telegram_media_id: str, media_type: Union[MediaType, str]) -> Optional[InlineQueryResult]:
+    """Get prebuilt inline result for meme from cache or build it"""
+    cached = _inline_results_cache.get(meme_id)
+    # Meme could be renamed since result was built
+    if cached is not None and cached[0] == title:
+        _inline_results_cache.move_to_end(meme_id)
+        return cached[1]
+
+    result = build_inline_result(meme_id, title, telegram_media_id, media_type)
+    if result is None:
+        return None
+
+    _inline_results_cache[meme_id] = (title, result)
+    _inline_results_cache.move_to_end(meme_id)
+    if len(_inline_results_cache) > INLINE_RESULTS_CACHE_SIZE:
+        _inline_results_cache.popitem(last=False)
+    return result
+
+
+def count_cached_inline_results(meme_ids: Iterable[int]) -> int:
+    """How many of memes already have prebuilt inline results"""
+    return sum(1 for meme_id in meme_ids if meme_id in _inline_results_cache)
+
+
+def forget_inline_results(meme_ids: Iterable[int]) -> None:
+    """Drop prebuilt results of changed or deleted memes"""
+    for meme_id in meme_ids:
+        _inline_results_cache.pop(meme_id, None)
+
+
+def forget_all_inline_results() -> None:
+    """Drop all prebuilt results, e.g. when changes of memes could have been missed"""
+    _inline_results_cache.clear()
+
+
+async def generate_inline_list(database_data: Optional[Sequence[Row]]) -> Sequence[InlineQueryResult]:
     """Generate inline entries from database response
        Args:
-           database_data: data output from database
+           database_data: rows of (id, title, telegram_media_id, media_type, is_public) from database
        Returns:
            Inline query results that can be sent to client
     """
@@ -35,35 +112,9 @@ async def generate_inline_list(database_data: list[tuple[str, str, str]]) -> Seq
         return []
     inline_list = []
     for i_meme in database_data:
-        if i_meme[2] == "video":
-            inline_list.append(InlineQueryResultCachedVideo(
-                id=str(uuid4()),
-                video_file_id=i_meme[1],
-                title=i_meme[0],
-            ))
-        elif i_meme[2] == "photo":
-            inline_list.append(InlineQueryResultCachedPhoto(
-                id=str(uuid4()),
-                photo_file_id=i_meme[1],
-                title=i_meme[0]
-            ))
-        elif i_meme[2] == "gif":
-            inline_list.append(InlineQueryResultCachedGif(
-                id=str(uuid4()),
-                gif_file_id=i_meme[1],
-                title=i_meme[0]
-            ))
-        elif i_meme[2] == "voice":
-            inline_list.append(InlineQueryResultCachedVoice(
-                id=str(uuid4()),
-                voice_file_id=i_meme[1],
-                title=i_meme[0]
-            ))
-        elif i_meme[2] == "audio":
-            inline_list.append(InlineQueryResultCachedAudio(
-                id=str(uuid4()),
-                audio_file_id=i_meme[1],
-            ))
+        result = get_inline_result(i_meme.id, i_meme.title, i_meme.telegram_media_id, i_meme.media_type)
+        if result is not None:
+            inline_list.append(result)
     return inline_list
 
 
@@ -80,63 +131,115 @@ async def generate_text_for_meme_button(in_meme: Meme):
     return f"{emoji}{in_meme.title}{emoji}"
 
 
-async def generate_inline_keyboard_page(in_memes: Sequence[Meme], page_number: int) -> InlineKeyboardMarkup:
+def get_page(in_memes: Sequence[Meme], page_number: int) -> Sequence[Meme]:
+    start = min(page_number*MEMES_PER_PAGE, len(in_memes))
+    end = min(page_number*MEMES_PER_PAGE+MEMES_PER_PAGE, len(in_memes))
+    return in_memes[start:end]
+
+
+async def generate_inline_keyboard_page(in_memes: Sequence[Meme], page_number: int, chat_id: int,
+                                        selected: Optional[set[int]] = None) -> InlineKeyboardMarkup:
+    """
+    Page of user's memes.
+    Args:
+        selected: ids of selected memes in multi-select mode, None for normal mode
+    """
     keyboard = []
+    state = MenuState(page=page_number)
+    select_mode = selected is not None
+    meme_prefix = CALLBACK_TOGGLE if select_mode else CALLBACK_MEME
+    page_prefix = CALLBACK_SELECT if select_mode else CALLBACK_PAGE
 
     in_memes_len = len(in_memes)
-    start = min(page_number*MEMES_PER_PAGE, in_memes_len)
-    end = min(page_number*MEMES_PER_PAGE+MEMES_PER_PAGE, in_memes_len)
 
-    for current_meme in in_memes[start:end]:
+    for current_meme in get_page(in_memes, page_number):
         button_text = await generate_text_for_meme_button(current_meme)
-        new_button = [InlineKeyboardButton(button_text, callback_data=CALLBACK_MEME+str(current_meme.id))]
+        if select_mode:
+            button_text = ("✅" if current_meme.id in selected else "▫️") + button_text
+        callback_data = encode_callback(meme_prefix, state.with_changes(meme_id=current_meme.id), chat_id)
+        new_button = [InlineKeyboardButton(button_text, callback_data=callback_data)]
         keyboard.append(new_button)
 
     left_right = []
 
 
     if page_number > 0:
-        left_right.append(InlineKeyboardButton("⬅️", callback_data=CALLBACK_PAGE+str(max(0, page_number - 1))))
+        previous_page = MenuState(page=max(0, page_number - 1))
+        left_right.append(InlineKeyboardButton("⬅️", callback_data=encode_callback(page_prefix, previous_page, chat_id)))
 
     # Last page is length of memes divided by memes per page and rounded up.
     # I use minus one here because page numbers start from 0
     last_page_number = math.ceil(in_memes_len / MEMES_PER_PAGE)-1
 
     if page_number < last_page_number:
-        left_right.append(InlineKeyboardButton("➡️", callback_data=CALLBACK_PAGE+str(min(last_page_number, page_number + 1))))
+        next_page = MenuState(page=min(last_page_number, page_number + 1))
+        left_right.append(InlineKeyboardButton("➡️", callback_data=encode_callback(page_prefix, next_page, chat_id)))
 
 
     keyboard.append(left_right)
+    if select_mode:
+        keyboard.extend(generate_bulk_actions(state, chat_id))
+    elif in_memes:
+        keyboard.append([InlineKeyboardButton("☑️Select several☑️",
+                                              callback_data=encode_callback(CALLBACK_SELECT, state, chat_id))])
     result = InlineKeyboardMarkup(keyboard)
     return result
 
-async def generate_meme_controls(meme: Meme) -> InlineKeyboardMarkup:
+def generate_bulk_actions(state: MenuState, chat_id: int) -> list[list[InlineKeyboardButton]]:
+    """Buttons of multi-select mode that act on all selected memes"""
+    def button(text: str, prefix: str) -> InlineKeyboardButton:
+        return InlineKeyboardButton(text, callback_data=encode_callback(prefix, state, chat_id))
+
+    return [
+        [button("☑️Whole page☑️", CALLBACK_SELECT_PAGE)],
+        [button("🗑️Delete", CALLBACK_BULK_DELETE), button("🏷️Add tag", CALLBACK_BULK_ADD_TAG),
+         button("🏷️Remove tag", CALLBACK_BULK_REMOVE_TAG)],
+        [button("🌐Make public", CALLBACK_BULK_PUBLIC), button("🔒Make private", CALLBACK_BULK_PRIVATE)],
+        [button("✔️Done", CALLBACK_BACK)],
+    ]
+
+async def generate_yes_no_for_bulk_deletion(state: MenuState, chat_id: int) -> InlineKeyboardMarkup:
+    delete_button = InlineKeyboardButton("delete", callback_data=encode_callback(CALLBACK_BULK_CONFIRM_DELETE, state, chat_id))
+    not_delete_button = InlineKeyboardButton("not delete", callback_data=encode_callback(CALLBACK_SELECT, state, chat_id))
+    return InlineKeyboardMarkup([[delete_button, not_delete_button]])
+
+async def generate_meme_controls(state: MenuState, chat_id: int) -> InlineKeyboardMarkup:
     """Generate controls like delete or rename for chosen meme
        Args:
-           meme: selected meme
+           state: menu state with selected meme and its media message
+           chat_id: chat of the menu
        Returns:
            InlineKeyboardMarkup for selected meme
     """
-    meme_id = meme.id
-    delete_button = InlineKeyboardButton("🗑️Delete meme🗑️", callback_data=CALLBACK_DELETE+str(meme_id))
-    rename_button = InlineKeyboardButton("✏️Rename meme✏️", callback_data=CALLBACK_RENAME+str(meme_id))
-    go_back_button = InlineKeyboardButton("⬅️", callback_data=CALLBACK_BACK)
+    delete_button = InlineKeyboardButton("🗑️Delete meme🗑️", callback_data=encode_callback(CALLBACK_DELETE, state, chat_id))
+    rename_button = InlineKeyboardButton("✏️Rename meme✏️", callback_data=encode_callback(CALLBACK_RENAME, state, chat_id))
+    collection_button = InlineKeyboardButton("📁Add to collection📁",
+                                             callback_data=encode_callback(CALLBACK_COLLECTIONS, state, chat_id))
+    go_back_button = InlineKeyboardButton("⬅️", callback_data=encode_callback(CALLBACK_BACK, state, chat_id))
 
-    keyboard = [[delete_button], [rename_button], [go_back_button]]
+    keyboard = [[delete_button], [rename_button], [collection_button], [go_back_button]]
 
     result = InlineKeyboardMarkup(keyboard)
 
     return result
 
-async def generate_yes_no_for_meme_deletion(meme: Meme):
-    meme_id = meme.id
-
-    delete_button = InlineKeyboardButton("delete", callback_data=CALLBACK_CONFIRM_DELETE+str(meme_id))
-    not_delete_button = InlineKeyboardButton("not delete", callback_data=CALLBACK_MEME+str(meme_id))
+async def generate_yes_no_for_meme_deletion(state: MenuState, chat_id: int):
+    delete_button = InlineKeyboardButton("delete", callback_data=encode_callback(CALLBACK_CONFIRM_DELETE, state, chat_id))
+    not_delete_button = InlineKeyboardButton("not delete", callback_data=encode_callback(CALLBACK_MEME, state, chat_id))
     keyboard = [[delete_button, not_delete_button]]
 
     result = InlineKeyboardMarkup(keyboard)
     return result
 
-async def generate_back_button() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️", callback_data=CALLBACK_BACK)]])
\ No newline at end of file
+async def generate_collections_choice(collections: Sequence[Collection], state: MenuState, chat_id: int) -> InlineKeyboardMarkup:
+    """Buttons that add selected meme to one of user's collections"""
+    keyboard = [[InlineKeyboardButton(collection.title,
+                                      callback_data=encode_callback(CALLBACK_ADD_TO_COLLECTION,
+                                                                    state.with_changes(collection_id=collection.id),
+                                                                    chat_id))]
+                for collection in collections]
+    keyboard.append([InlineKeyboardButton("⬅️", callback_data=encode_callback(CALLBACK_MEME, state, chat_id))])
+    return InlineKeyboardMarkup(keyboard)
+
+async def generate_back_button(state: MenuState, chat_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️", callback_data=encode_callback(CALLBACK_BACK, state, chat_id))]])
@@ -1,36 +1,48 @@
-from typing import Union, Optional
+from typing import Union, Optional, Callable, Awaitable
 from telegram.ext import ContextTypes
-from telegram import Message, InlineKeyboardMarkup
+from telegram import InlineKeyboardMarkup
 
-from src.models import Meme
+from memes_db.models import Meme
 from src.tg_utilities.classes import MemeMenu
-from src.constants import MEMES_CONTROL_MESSAGE
-
-async def create_or_update_menu(context: ContextTypes.DEFAULT_TYPE,
-                                chat_id: Union[int, str],
-                                text: str,
-                                reply_markup: Optional[InlineKeyboardMarkup] = None,
-                                new_meme: Optional[Meme] = None,
-                                destroy_menu: bool = False,
-                                delete_media: bool = False):
-
-    old_menu = context.user_data.get(MEMES_CONTROL_MESSAGE)
-
-    if isinstance(old_menu, MemeMenu):
-        if destroy_menu:
-            await old_menu.destroy()
-
-            # Create message for updater
-            menu_message = await context.bot.sendMessage(text=text, chat_id=chat_id, reply_markup=reply_markup)
-            context.user_data[MEMES_CONTROL_MESSAGE] = MemeMenu(text_message=menu_message)
-        else:
-            await old_menu.switch_state(context=context,
-                                        chat_id=chat_id,
-                                        new_text=text,
-                                        new_meme=new_meme,
-                                        delete_media=delete_media,
-                                        reply_markup=reply_markup)
-    else:
-        # Create message for updater
-        menu_message = await context.bot.sendMessage(text=text, chat_id=chat_id, reply_markup=reply_markup)
-        context.user_data[MEMES_CONTROL_MESSAGE] = MemeMenu(text_message=menu_message)
\ No newline at end of file
+from src.tg_utilities.callback_data import MenuState
+
+# Builds keyboard for menu state after media message of menu is known
+KeyboardFactory = Callable[[MenuState], Awaitable[Optional[InlineKeyboardMarkup]]]
+
+
+async def send_menu(context: ContextTypes.DEFAULT_TYPE,
+                    chat_id: Union[int, str],
+                    text: str,
+                    reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """Create new menu message"""
+    await context.bot.sendMessage(text=text, chat_id=chat_id, reply_markup=reply_markup)
+
+
+async def update_menu(context: ContextTypes.DEFAULT_TYPE,
+                      chat_id: Union[int, str],
+                      text_message_id: int,
+                      state: MenuState,
+                      text: str,
+                      reply_markup: Optional[InlineKeyboardMarkup] = None,
+                      keyboard_factory: Optional[KeyboardFactory] = None,
+                      new_meme: Optional[Meme] = None,
+                      delete_media: bool = False) -> MenuState:
+    """
+    Update menu restored from state of pressed button.
+    Use keyboard_factory instead of reply_markup when buttons depend on media message sent here.
+    Returns:
+        New state of the menu, with id of media message if it was sent
+    """
+    menu = MemeMenu(chat_id=chat_id, text_message_id=text_message_id, media_message_id=state.media_message_id)
+
+    if delete_media:
+        await menu.delete_media(context.bot)
+
+    if new_meme:
+        await menu.send_media(context.bot, new_meme)
+
+    new_state = state.with_changes(media_message_id=menu.media_message_id or 0)
+    if keyboard_factory:
+        reply_markup = await keyboard_factory(new_state)
+    await menu.edit_text(context.bot, text, reply_markup)
+    return new_state
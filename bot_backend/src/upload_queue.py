@@ -0,0 +1,88 @@
+"""
+Workers of durable upload queue. Conversation only puts upload into upload_jobs and answers right away,
+workers add queued memes to database in batches and tell users how it went.
+Workers of all bot processes share the queue, every batch is taken with SKIP LOCKED, so they never wait for each other.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+import database
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+# Workers check queue at least that often, jobs queued by this process wake them right away
+POLL_INTERVAL = 1
+# Pause after batch failed as a whole, e.g. database is unreachable
+ERROR_DELAY = 5
+CLEANUP_INTERVAL = 60 * 60
+
+# Called with chat id, title and AddMemeResult of every finished job
+FinishedCallback = Callable[[int, str, database.AddMemeResult], Awaitable[None]]
+
+_job_queued: Optional[asyncio.Event] = None
+_tasks: list[asyncio.Task] = []
+
+
+def job_added() -> None:
+    """Wake workers after upload was queued"""
+    if _job_queued is not None:
+        _job_queued.set()
+
+
+async def _wait_for_jobs() -> None:
+    try:
+        await asyncio.wait_for(_job_queued.wait(), POLL_INTERVAL)
+    except asyncio.TimeoutError:
+        pass
+    _job_queued.clear()
+
+
+async def _notify(on_finished: FinishedCallback, chat_id: int, title: str, result: database.AddMemeResult) -> None:
+    try:
+        await on_finished(chat_id, title, result)
+    except Exception as e:
+        logger.error(f"Failed to tell chat {chat_id} about uploaded meme: {e}")
+
+
+async def _work(on_finished: FinishedCallback) -> None:
+    while True:
+        try:
+            taken, finished = await database.process_upload_batch(BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Failed to process upload batch: {e}")
+            await asyncio.sleep(ERROR_DELAY)
+            continue
+
+        await asyncio.gather(*(_notify(on_finished, *job) for job in finished))
+        # Full batch means there may be more due jobs
+        if taken < BATCH_SIZE:
+            await _wait_for_jobs()
+
+
+async def _clean_up_periodically() -> None:
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL)
+        try:
+            await database.delete_finished_upload_jobs()
+        except Exception as e:
+            logger.error(f"Failed to delete finished upload jobs: {e}")
+
+
+def start(workers: int, on_finished: FinishedCallback) -> None:
+    """Start workers, throughput grows with their amount until database is the limit"""
+    global _job_queued
+    _job_queued = asyncio.Event()
+    _tasks.extend(asyncio.create_task(_work(on_finished)) for _ in range(workers))
+    _tasks.append(asyncio.create_task(_clean_up_periodically()))
+
+
+async def stop() -> None:
+    """Stop workers. Batch that is being processed is rolled back and taken again after restart"""
+    global _job_queued
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    _job_queued = None
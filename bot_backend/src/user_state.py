@@ -0,0 +1,94 @@
+"""
+Eviction of idle user_data and chat_data. python-telegram-bot keeps them for every user forever,
+so users that didn't send anything for ttl seconds are dropped, and least recently seen ones are dropped
+when there are more than max_users of them.
+Dropped data can be handed to spill before it is forgotten, e.g. to keep it in persistence.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# Called with "user" or "chat", its id and data before data is dropped
+Spill = Callable[[str, int, dict], Awaitable[None]]
+
+
+class IdleStateEvictor:
+    def __init__(self, ttl: float, max_users: int, spill: Optional[Spill] = None):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.spill = spill
+        # id -> last time it was seen, least recently seen first
+        self._last_seen: dict[str, OrderedDict[int, float]] = {"user": OrderedDict(), "chat": OrderedDict()}
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(self, user_id: Optional[int], chat_id: Optional[int]) -> None:
+        now = time.monotonic()
+        for kind, entity_id in (("user", user_id), ("chat", chat_id)):
+            if entity_id is None:
+                continue
+            last_seen = self._last_seen[kind]
+            last_seen[entity_id] = now
+            last_seen.move_to_end(entity_id)
+
+    async def evict(self, application: Application) -> int:
+        """Drop data of idle and least recently seen users and chats. Returns how many were dropped"""
+        dropped = await self._evict("user", application.user_data, application.drop_user_data)
+        dropped += await self._evict("chat", application.chat_data, application.drop_chat_data)
+        if dropped:
+            logger.info(f"Dropped state of {dropped} idle users and chats, "
+                        f"{len(application.user_data)} users left")
+        return dropped
+
+    async def _evict(self, kind: str, store, drop: Callable[[int], None]) -> int:
+        now = time.monotonic()
+        last_seen = self._last_seen[kind]
+        # Data that was created before tracking started, e.g. loaded from persistence, counts as just seen
+        for entity_id in store:
+            last_seen.setdefault(entity_id, now)
+
+        dropped = 0
+        while last_seen:
+            entity_id, seen_at = next(iter(last_seen.items()))
+            if now - seen_at < self.ttl and len(last_seen) <= self.max_users:
+                break
+            del last_seen[entity_id]
+
+            data = store.get(entity_id)
+            if data is None:
+                continue
+            if self.spill is not None and data:
+                try:
+                    await self.spill(kind, entity_id, data)
+                except Exception as e:
+                    logger.error(f"Failed to spill {kind} {entity_id} data: {e}")
+                    continue
+            drop(entity_id)
+            dropped += 1
+        return dropped
+
+    def start(self, application: Application, interval: float) -> None:
+        self._task = asyncio.create_task(self._run(application, interval))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self, application: Application, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict(application)
+            except Exception as e:
+                logger.error(f"Failed to evict idle user state: {e}")
@@ -0,0 +1,9 @@
+import os
+import sys
+from pathlib import Path
+
+# Bot modules import each other by their names and memes_db lives in the root of the repository
+BOT_BACKEND = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(BOT_BACKEND / "src"), str(BOT_BACKEND.parent)]
+# Callback data can't be signed without a key
+os.environ.setdefault("CALLBACK_SECRET", "test-callback-secret")
@@ -0,0 +1,49 @@
+import importlib
+
+import dotenv
+import pytest
+
+from tg_utilities import callback_data
+from tg_utilities.callback_data import MenuState, decode_callback, encode_callback, selection_fingerprint, _sign
+
+CHAT_ID = 1001
+STATE = MenuState(page=2, meme_id=15, media_message_id=7, collection_id=3, selection=12345)
+
+
+def test_round_trip():
+    assert decode_callback(encode_callback("page:", STATE, CHAT_ID), CHAT_ID) == STATE
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda data: data.replace("page:2.", "page:3.", 1),
+    lambda data: data.replace("page:", "dele:", 1),
+    lambda data: data[:-1] + ("A" if data[-1] != "A" else "B"),
+    lambda data: data.rpartition(".")[0],
+])
+def test_tampered_data_is_rejected(tamper):
+    assert decode_callback(tamper(encode_callback("page:", STATE, CHAT_ID)), CHAT_ID) is None
+
+
+def test_other_chat_is_rejected():
+    assert decode_callback(encode_callback("page:", STATE, CHAT_ID), CHAT_ID + 1) is None
+
+
+def test_payload_must_have_every_field():
+    for payload in ("2.15.7.3", "2.15.7.3.1.0"):
+        assert decode_callback(f"page:{payload}.{_sign('page:', payload, CHAT_ID)}", CHAT_ID) is None
+
+
+def test_selection_fingerprint():
+    assert selection_fingerprint({3, 1, 2}) == selection_fingerprint({1, 2, 3})
+    assert selection_fingerprint({1, 2}) != selection_fingerprint({1, 2, 3})
+    assert selection_fingerprint(set()) != 0
+
+
+def test_missing_key_is_refused(monkeypatch):
+    monkeypatch.delenv("CALLBACK_SECRET", raising=False)
+    monkeypatch.delenv("BOT_KEY", raising=False)
+    monkeypatch.setattr(dotenv, "load_dotenv", lambda *args, **kwargs: False)
+    with pytest.raises(RuntimeError):
+        importlib.reload(callback_data)
+    monkeypatch.undo()
+    importlib.reload(callback_data)
@@ -0,0 +1,30 @@
+from inline_query_parser import ParsedQuery, parse_inline_query, resolve_collections
+from memes_db.models import MediaType
+
+
+def test_plain_text():
+    assert parse_inline_query("  funny   dog ") == ParsedQuery(text="funny dog")
+
+
+def test_tags_are_normalized_and_deduplicated():
+    assert parse_inline_query("#Cat dog #cat #funny") == ParsedQuery(text="dog", tags=["cat", "funny"])
+
+
+def test_media_type_prefix():
+    assert parse_inline_query("gif:dog") == ParsedQuery(text="dog", media_type=MediaType.GIF)
+    assert parse_inline_query("GIF: dog") == ParsedQuery(text="dog", media_type=MediaType.GIF)
+    # Only the first media type is a filter
+    assert parse_inline_query("gif:dog video:cat") == ParsedQuery(text="dog video:cat", media_type=MediaType.GIF)
+
+
+def test_collection():
+    assert parse_inline_query("@Funny_Cats dog") == ParsedQuery(text="dog", collection="funny_cats")
+    assert parse_inline_query("@ dog").collection == ""
+    assert parse_inline_query("").is_empty()
+
+
+def test_resolve_collections():
+    saved = [(1, "Funny cats"), (2, "Funny dogs"), (3, "Sad")]
+    assert resolve_collections("funny_", saved) == [1, 2]
+    assert resolve_collections("3", saved) == [3]
+    assert resolve_collections("", saved) == [1, 2, 3]
@@ -0,0 +1,40 @@
+import search_index
+from search_index import SearchIndex, TITLE_PHRASE_WEIGHT
+
+
+def make_index() -> SearchIndex:
+    index = SearchIndex()
+    index.add(1, "funny cat", ["animals"], "media-1", "unique-1", "photo")
+    index.add(2, "cat funny", ["cat"], "media-2", "unique-2", "photo")
+    index.add(3, "dog", ["funny"], "media-3", "unique-3", "gif")
+    index.add(4, "Funny, CAT!", None, "media-4", "unique-4", "video")
+    return index
+
+
+def test_title_phrase_ranks_first():
+    results = make_index().search("funny cat", limit=10)
+    assert [meme.id for meme in results] == [4, 1, 2, 3]
+    assert results[0].score == 2 + TITLE_PHRASE_WEIGHT
+    assert results[2].score == 3
+
+
+def test_newest_wins_ties():
+    assert [meme.id for meme in make_index().search("cat", limit=10)] == [2, 4, 1]
+
+
+def test_misspelled_term_matches():
+    assert [meme.id for meme in make_index().search("fuuny", limit=10, media_type="gif")] == [3]
+
+
+def test_removed_and_updated_memes():
+    index = make_index()
+    index.remove(4)
+    index.add(1, "dog", None, "media-1", "unique-1", "photo")
+    assert [meme.id for meme in index.search("cat", limit=10)] == [2]
+    assert [meme.id for meme in index.compact().search("dog", limit=10)] == [3, 1]
+
+
+def test_only_newest_postings_of_common_token_are_scored(monkeypatch):
+    monkeypatch.setattr(search_index, "MAX_POSTINGS_PER_TOKEN", 2)
+    index = make_index()
+    assert [meme.id for meme in index.search("funny", limit=10)] == [4, 2, 3]
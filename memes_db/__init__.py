@@ -0,0 +1,3 @@
+"""
+Data access shared by bot and mini app: models, one configured connection pool and queries used by both.
+"""
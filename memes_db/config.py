@@ -0,0 +1,27 @@
+from os import getenv
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv(Path(__file__).parent.parent / ".env")
+# Database configuration from environment variables
+HOST = getenv("DB_HOST", "localhost")
+DBNAME = getenv("POSTGRES_DB")
+USER = getenv("POSTGRES_USER")
+PASSWORD = getenv("POSTGRES_PASSWORD")
+PORT = getenv("PORT")
+
+DATABASE_URL = f"postgresql+psycopg://{USER}:{PASSWORD}@{HOST}:{PORT}/{DBNAME}"
+# Connection string for plain psycopg connections, used by change feed
+CONNINFO = f"host={HOST} port={PORT} dbname={DBNAME} user={USER} password={PASSWORD}"
+
+# Pool of every process. Bot and mini app processes share database max_connections,
+# so (POOL_SIZE + POOL_MAX_OVERFLOW) * processes has to fit into it
+POOL_SIZE = int(getenv("DB_POOL_SIZE", "10"))
+POOL_MAX_OVERFLOW = int(getenv("DB_POOL_MAX_OVERFLOW", "10"))
+# Seconds to wait for free connection before failing request
+POOL_TIMEOUT = float(getenv("DB_POOL_TIMEOUT", "10"))
+# Connections older than that are replaced, instead of pinging every connection on checkout
+POOL_RECYCLE = int(getenv("DB_POOL_RECYCLE", "1800"))
+# Query is prepared on server after it was executed that many times on one connection
+PREPARE_THRESHOLD = int(getenv("DB_PREPARE_THRESHOLD", "2"))
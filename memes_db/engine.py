@@ -0,0 +1,37 @@
+import logging
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
+
+from memes_db.config import (DATABASE_URL, POOL_SIZE, POOL_MAX_OVERFLOW, POOL_TIMEOUT, POOL_RECYCLE,
+                             PREPARE_THRESHOLD)
+
+logger = logging.getLogger(__name__)
+
+# One engine and pool per process
+engine: Optional[AsyncEngine] = None
+session_maker: Optional[async_sessionmaker[AsyncSession]] = None
+
+
+def connect() -> async_sessionmaker[AsyncSession]:
+    """Create engine on first call, later calls return same session maker"""
+    global engine, session_maker
+    if engine is None:
+        engine = create_async_engine(
+            DATABASE_URL,
+            pool_size=POOL_SIZE,
+            max_overflow=POOL_MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+            pool_recycle=POOL_RECYCLE,
+            connect_args={"prepare_threshold": PREPARE_THRESHOLD},
+        )
+        session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+    return session_maker
+
+
+async def close() -> None:
+    global engine, session_maker
+    if engine is not None:
+        await engine.dispose()
+    engine = None
+    session_maker = None
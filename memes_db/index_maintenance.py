@@ -0,0 +1,240 @@
+"""
+Online rebuild of indexes, used by migrations/maintain_indexes.py and by migrations that change indexes.
+
+Index is rebuilt without blocking reads or writes:
+ 1. new index is built with CREATE INDEX CONCURRENTLY next to the old one, under name <name>_new.
+    Partitioned index can't be built concurrently, so it's created ON ONLY every partitioned table,
+    leaf partitions are indexed concurrently one by one and attached to it
+ 2. in one transaction old index is renamed to <name>_old and new one gets its name.
+    Renaming takes only SHARE UPDATE EXCLUSIVE lock, search queries that name indexes
+    see either old or new index, never neither
+ 3. old index is dropped, concurrently where postgres allows it
+Statements that need locks give up after LOCK_TIMEOUT and are retried, so they never queue queries behind them.
+Connection has to be in autocommit mode.
+"""
+import json
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from sqlalchemy import text, Connection
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = "2s"
+LOCK_RETRIES = 30
+LOCK_RETRY_DELAY = 1
+# btree pages are 90% full right after build
+BTREE_FILL_FACTOR = 0.9
+
+# Makes statement that creates index under index_name on relation, ON ONLY relation if only is set
+MakeStatement = Callable[[str, str, bool, bool], str]
+
+INDEX_DEFINITION = re.compile(r"^CREATE (UNIQUE )?INDEX \S+ ON (?:ONLY )?\S+ (USING .*)$", re.DOTALL)
+
+
+@dataclass
+class IndexStats:
+    name: str
+    table: str
+    method: str
+    size_bytes: int
+    # Entries of index by statistics of postgres
+    entries: int
+    # Share of index that is wasted space, None if it can't be estimated for this index
+    bloat: Optional[float]
+    # Backs primary key or unique constraint, such index is rebuilt by REINDEX CONCURRENTLY
+    is_constraint: bool
+
+
+def partition_tree(connection: Connection, relation: str) -> list[tuple[str, Optional[str], bool]]:
+    """(relation, parent, is leaf) of relation and its partitions, parents first. Plain table is one leaf"""
+    return connection.execute(text("""
+        SELECT relid::regclass::text, parentrelid::regclass::text, isleaf
+        FROM pg_partition_tree(CAST(:relation AS regclass))
+        ORDER BY level
+    """), {"relation": relation}).fetchall()
+
+
+def index_partitions(connection: Connection, index: str) -> list[tuple[str, str]]:
+    """(index, its table) of every partition of partitioned index"""
+    return connection.execute(text("""
+        SELECT tree.relid::regclass::text, pg_index.indrelid::regclass::text
+        FROM pg_partition_tree(CAST(:index AS regclass)) AS tree
+        JOIN pg_index ON pg_index.indexrelid = tree.relid
+        WHERE tree.parentrelid IS NOT NULL
+    """), {"index": index}).fetchall()
+
+
+def index_exists(connection: Connection, name: str) -> bool:
+    return connection.scalar(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name})
+
+
+def same_definition(connection: Connection, name: str) -> MakeStatement:
+    """Statement maker that recreates index as it is defined now"""
+    definition = connection.scalar(text("SELECT pg_get_indexdef(CAST(:name AS regclass))"), {"name": name})
+    unique, rest = INDEX_DEFINITION.match(definition).groups()
+
+    def make_statement(index_name: str, relation: str, only: bool, concurrently: bool) -> str:
+        return (f"CREATE {unique or ''}INDEX {'CONCURRENTLY ' if concurrently else ''}{index_name} "
+                f"ON {'ONLY ' if only else ''}{relation} {rest}")
+    return make_statement
+
+
+def run_with_lock_retries(connection: Connection, statements: list[str]) -> None:
+    """Run statements in one transaction, retry it when a lock isn't granted within LOCK_TIMEOUT"""
+    for attempt in range(1, LOCK_RETRIES + 1):
+        try:
+            connection.exec_driver_sql("BEGIN")
+            connection.exec_driver_sql(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+            connection.exec_driver_sql("COMMIT")
+            return
+        except OperationalError as e:
+            connection.exec_driver_sql("ROLLBACK")
+            if "lock timeout" not in str(e) or attempt == LOCK_RETRIES:
+                raise
+            logger.info(f"Lock not granted, retrying ({attempt}/{LOCK_RETRIES})")
+            time.sleep(LOCK_RETRY_DELAY * attempt)
+
+
+def _child_name(name: str, relation: str) -> str:
+    return f"{name}_{relation.split('.')[-1]}"
+
+
+def replace_index(connection: Connection, name: str, table: str, make_statement: MakeStatement,
+                  pause: float = 0) -> None:
+    """
+    Build index with make_statement next to index name of table and swap them, see module docstring
+    Args:
+        pause: seconds to wait between partitions, gives the database some rest on big tables
+    """
+    new_name, old_name = f"{name}_new", f"{name}_old"
+    tree = partition_tree(connection, table)
+
+    def index_of(index_name: str, relation: str) -> str:
+        return index_name if relation == table else _child_name(index_name, relation)
+
+    # Leftovers of rebuild that failed halfway
+    for relation, _, _ in reversed(tree):
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index_of(new_name, relation)}")
+    if index_exists(connection, old_name):
+        drop_index(connection, old_name, table)
+
+    leaves = [relation for relation, _, is_leaf in tree if is_leaf]
+    for relation, _, is_leaf in tree:
+        if not is_leaf:
+            connection.exec_driver_sql(make_statement(index_of(new_name, relation), relation, True, False))
+    for number, relation in enumerate(leaves, 1):
+        logger.info(f"Building {index_of(new_name, relation)} ({number}/{len(leaves)})")
+        connection.exec_driver_sql(make_statement(index_of(new_name, relation), relation, False, True))
+        if pause and number < len(leaves):
+            time.sleep(pause)
+    for relation, parent, _ in reversed(tree):
+        if parent is not None:
+            connection.exec_driver_sql(f"ALTER INDEX {index_of(new_name, parent)} "
+                                       f"ATTACH PARTITION {index_of(new_name, relation)}")
+
+    swap = []
+    if index_exists(connection, name):
+        swap.append(f"ALTER INDEX {name} RENAME TO {old_name}")
+        swap += [f"ALTER INDEX {index} RENAME TO {_child_name(old_name, relation)}"
+                 for index, relation in index_partitions(connection, name)]
+    swap.append(f"ALTER INDEX {new_name} RENAME TO {name}")
+    swap += [f"ALTER INDEX {index_of(new_name, relation)} RENAME TO {_child_name(name, relation)}"
+             for relation, _, _ in tree if relation != table]
+    run_with_lock_retries(connection, swap)
+    logger.info(f"{name} swapped")
+
+    if index_exists(connection, old_name):
+        drop_index(connection, old_name, table)
+
+
+def drop_index(connection: Connection, name: str, table: str) -> None:
+    if len(partition_tree(connection, table)) == 1:
+        connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    else:
+        # Partitioned index can't be dropped concurrently, drop only waits for a short lock
+        run_with_lock_retries(connection, [f"DROP INDEX IF EXISTS {name}"])
+
+
+def rebuild_index(connection: Connection, name: str, pause: float = 0) -> None:
+    """Rebuild index with its current definition"""
+    table, is_constraint = connection.execute(text("""
+        SELECT indrelid::regclass::text,
+               EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)
+        FROM pg_index WHERE indexrelid = CAST(:name AS regclass)
+    """), {"name": name}).one()
+    if is_constraint:
+        # Constraint can't be moved to other index, postgres swaps index under it itself
+        logger.info(f"Reindexing {name} concurrently")
+        connection.exec_driver_sql(f"REINDEX INDEX CONCURRENTLY {name}")
+        return
+    replace_index(connection, name, table, same_definition(connection, name), pause)
+
+
+def pgroonga_disk_usage(connection: Connection, index: str) -> tuple[int, int]:
+    """
+    Bytes used by groonga source table and lexicon of pgroonga index, they live outside of postgres relations,
+    and amount of records in source table, records of deleted rows stay there until vacuum
+    """
+    source = connection.scalar(text("SELECT pgroonga_table_name(:index)"), {"index": index})
+    disk_usage = 0
+    records = 0
+    for name in (source, source.replace("Sources", "Lexicon") + "_0"):
+        response = json.loads(connection.scalar(
+            text("SELECT pgroonga_command('object_inspect', ARRAY['name', :name])"), {"name": name}))
+        body = response[1] or {}
+        disk_usage += body.get("disk_usage", 0)
+        if name == source:
+            records = body.get("n_records", 0)
+    return disk_usage, records
+
+
+def index_stats(connection: Connection, tables: tuple[str, ...]) -> list[IndexStats]:
+    """Size and bloat of every index of tables, partitions are summed up into their partitioned index"""
+    has_pgstattuple = connection.scalar(text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pgstattuple')"))
+    indexes = connection.execute(text("""
+        SELECT index.relname, pg_index.indrelid::regclass::text, am.amname,
+               EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = pg_index.indexrelid)
+        FROM pg_index
+        JOIN pg_class AS index ON index.oid = pg_index.indexrelid
+        JOIN pg_am AS am ON am.oid = index.relam
+        WHERE pg_index.indrelid = ANY(CAST(:tables AS regclass[]))
+        ORDER BY 2, 1
+    """), {"tables": list(tables)}).fetchall()
+
+    stats = []
+    for name, table, method, is_constraint in indexes:
+        leaves = [index for index, _ in index_partitions(connection, name)] or [name]
+        leaves = [index for index in leaves
+                  if connection.scalar(text("SELECT relkind = 'i' FROM pg_class WHERE oid = CAST(:index AS regclass)"),
+                                       {"index": index})]
+        size = entries = records = 0
+        densities = []
+        for leaf in leaves:
+            entries += int(connection.scalar(text("SELECT greatest(reltuples, 0) FROM pg_class "
+                                                  "WHERE oid = CAST(:index AS regclass)"), {"index": leaf}))
+            if method == "pgroonga":
+                disk_usage, leaf_records = pgroonga_disk_usage(connection, leaf)
+                size += disk_usage
+                records += leaf_records
+                continue
+            size += connection.scalar(text("SELECT pg_relation_size(CAST(:index AS regclass))"), {"index": leaf})
+            if method == "btree" and has_pgstattuple:
+                density = connection.scalar(text("SELECT avg_leaf_density FROM pgstatindex(:index)"),
+                                            {"index": leaf})
+                if density == density:  # NaN for empty index
+                    densities.append(density / 100)
+
+        bloat = None
+        if method == "pgroonga" and records:
+            bloat = max(0.0, 1 - entries / records)
+        elif densities:
+            bloat = max(0.0, 1 - sum(densities) / len(densities) / BTREE_FILL_FACTOR)
+        stats.append(IndexStats(name, table, method, size, entries, bloat, is_constraint))
+    return stats
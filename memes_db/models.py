@@ -0,0 +1,303 @@
+import enum
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import ForeignKey, Text, BigInteger, DateTime, Enum, Column, func, Integer, Index, text, Float
+from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncAttrs
+
+from memes_db.search_profiles import index_options
+
+
+
+class Base(AsyncAttrs, DeclarativeBase):
+    pass
+
+class MediaType(enum.Enum):
+    AUDIO = "audio"
+    GIF = "gif"
+    PHOTO = "photo"
+    VIDEO = "video"
+    VOICE = "voice"
+
+
+class UserLikedMemes(Base):
+    __tablename__ = "user_liked_memes"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    user_telegram_id: Mapped[int] = mapped_column(ForeignKey("users.telegram_id"))
+    # Only for relationships, database has no foreign key to partitioned memes, rows are deleted by trigger
+    meme_id: Mapped[int] = mapped_column(ForeignKey("memes.id"))
+
+class MemeToCollection(Base):
+    __tablename__ = "meme_to_collection"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    # Only for relationships, database has no foreign key to partitioned memes, rows are deleted by trigger
+    meme_id: Mapped[int] = mapped_column(ForeignKey("memes.id"))
+    collection_id: Mapped[int] = mapped_column(ForeignKey("collections.id"))
+
+    __table_args__ = (
+        # Search inside collection joins memes by this index
+        Index(
+            'meme_to_collection_collection_meme_index',
+            'collection_id',
+            'meme_id',
+            unique=True
+        ),
+    )
+
+
+class User(Base):
+    __tablename__ = "users"
+
+    telegram_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    saved_collections: Mapped[list[int]] = mapped_column(ARRAY(BigInteger), server_default="{}")
+    liked_memes: Mapped[list["Meme"]] = relationship("Meme", secondary="user_liked_memes", back_populates="liked_users")
+    created_memes: Mapped[list["Meme"]] = relationship()
+    created_collections: Mapped[list["Collection"]] = relationship()
+    is_banned: Mapped[bool] = mapped_column(default=False)
+
+    __table_args__ = (
+        # Bots load banned users on startup and search skips their memes
+        Index(
+            'users_banned_index',
+            'telegram_id',
+            postgresql_where=text("is_banned")
+        ),
+    )
+
+    def __repr__(self):
+        return f"User(telegram_id={self.telegram_id}, is_banned={self.is_banned}"
+
+
+class Meme(Base):
+    """
+    Partitioned by is_public, private memes are partitioned by hash of creator, see memes_db/partitioning.py.
+    Primary key in database is (id, is_public), ids are still unique because they come from one sequence
+    """
+    __tablename__ = "memes"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    creator_telegram_id: Mapped[int] = mapped_column(ForeignKey("users.telegram_id"))
+    creator: Mapped["User"] = relationship(back_populates="created_memes")
+    liked_users: Mapped[list["User"]] = relationship("User", secondary="user_liked_memes", back_populates="liked_memes")
+    collections: Mapped[list["Collection"]] = relationship("Collection", secondary="meme_to_collection", back_populates="memes")
+    duration: Mapped[int] = mapped_column(Integer, default=0)
+    telegram_media_id: Mapped[str] = mapped_column(Text)
+    # Same for the same file in every upload, unlike telegram_media_id. Older memes don't have it
+    telegram_file_unique_id: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    title: Mapped[str] = mapped_column(Text)
+    tags: Mapped[list[str]] = mapped_column(ARRAY(Text), server_default="{}")
+    media_type: Mapped[MediaType] = mapped_column(Enum(MediaType, name="media_type", values_callable=lambda obj: [e.value for e in obj]))
+    is_public: Mapped[bool]
+
+    __table_args__ = (
+        # User's memes are listed newest first, mini app pages through them by id
+        Index(
+            'memes_creator_id_index',
+            'creator_telegram_id',
+            'id'
+        ),
+        # One public meme per file, and one private meme per file for every user.
+        # Unique indexes of partitioned table have to include partition key
+        Index(
+            'memes_public_file_unique_id_index',
+            'telegram_file_unique_id',
+            'is_public',
+            unique=True,
+            postgresql_where=text("is_public")
+        ),
+        Index(
+            'memes_private_file_unique_id_index',
+            'creator_telegram_id',
+            'telegram_file_unique_id',
+            'is_public',
+            unique=True,
+            postgresql_where=text("NOT is_public")
+        ),
+        Index(
+            'pgroonga_memes_titles_index',
+            'title',
+            postgresql_using='pgroonga',
+            postgresql_with=index_options('memes_titles')
+        ),
+        Index(
+            'pgroonga_memes_tags_index',
+            'tags',
+            postgresql_using='pgroonga',
+            postgresql_with=index_options('memes_tags')
+        ),
+        # Exact tag filters like #cat
+        Index(
+            'memes_tags_gin_index',
+            'tags',
+            postgresql_using='gin'
+        ),
+        # Partial indexes for searches scoped to one media type like gif:cat
+        *[
+            Index(
+                f'pgroonga_memes_{media_type.value}_{column}_index',
+                column_name,
+                postgresql_using='pgroonga',
+                postgresql_with=index_options(f'memes_{column}'),
+                postgresql_where=text(f"media_type = '{media_type.value}'")
+            )
+            for media_type in MediaType
+            for column, column_name in (('titles', 'title'), ('tags', 'tags'))
+        ],
+        {'postgresql_partition_by': 'LIST (is_public)'}
+    )
+
+    def __repr__(self):
+        return f"Meme(title: {self.title}, creator: {self.creator}), public: {self.is_public}"
+
+
+class Collection(Base):
+    __tablename__ = "collections"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    creator_telegram_id: Mapped[int] = mapped_column(ForeignKey("users.telegram_id"))
+    creator: Mapped["User"] = relationship(back_populates="created_collections")
+    memes: Mapped[list["Meme"]] = relationship("Meme", secondary="meme_to_collection", back_populates="collections")
+    likes: Mapped[int] = mapped_column(BigInteger, default=0)
+    users_amount: Mapped[int] = mapped_column(BigInteger, default=0)
+    title: Mapped[str] = mapped_column(Text)
+    tags: Mapped[list[str]] = mapped_column(ARRAY(Text), server_default="{}")
+    is_public: Mapped[bool]
+
+    __table_args__ = (
+        Index(
+            'pgroonga_collections_titles_index',
+            'title',
+            postgresql_using='pgroonga',
+            postgresql_with=index_options('collections_titles')
+        ),
+        Index(
+            'pgroonga_collections_tags_index',
+            'tags',
+            postgresql_using='pgroonga',
+            postgresql_with=index_options('collections_tags')
+        )
+    )
+
+
+
+class Tag(Base):
+    """Every tag used by memes, usage_count is kept up to date by trigger on memes"""
+    __tablename__ = "tags"
+
+    name: Mapped[str] = mapped_column(Text, primary_key=True)
+    usage_count: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    __table_args__ = (
+        # Prefix search for autocomplete
+        Index(
+            'tags_name_prefix_index',
+            'name',
+            postgresql_ops={'name': 'text_pattern_ops'}
+        ),
+    )
+
+
+class MemesVersion(Base):
+    """
+    Counter of changes in memes of one user, bumped by trigger on memes.
+    Mini app uses it as ETag of user's memes
+    """
+    __tablename__ = "memes_versions"
+
+    creator_telegram_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    version: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+class InlineQueryLog(Base):
+    """Sampled inline queries, written in batches by bot_backend/src/query_log.py"""
+    __tablename__ = "inline_query_log"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    logged_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    # Lowercased query with collapsed spaces, queries with collections aren't logged
+    query: Mapped[str] = mapped_column(Text)
+    result_count: Mapped[int] = mapped_column(Integer)
+    latency_ms: Mapped[float] = mapped_column(Float)
+    # Where results came from: "index" or "database"
+    tier: Mapped[str] = mapped_column(Text)
+    # Results that were already built and cached by the bot
+    cached_results: Mapped[int] = mapped_column(Integer)
+
+    __table_args__ = (
+        Index(
+            'inline_query_log_logged_at_index',
+            'logged_at'
+        ),
+    )
+
+
+class TopInlineQuery(Base):
+    """Most frequent inline queries of last days, rebuilt from inline_query_log by periodic rollup"""
+    __tablename__ = "top_inline_queries"
+
+    query: Mapped[str] = mapped_column(Text, primary_key=True)
+    searches: Mapped[int] = mapped_column(BigInteger)
+    avg_result_count: Mapped[float] = mapped_column(Float)
+    avg_latency_ms: Mapped[float] = mapped_column(Float)
+    cache_hit_ratio: Mapped[float] = mapped_column(Float)
+
+
+class UploadJob(Base):
+    """
+    Meme upload waiting to be written into memes, processed in batches by workers of bot_backend/src/upload_queue.py.
+    Finished jobs are kept for a while, so repeated upload of the same file is recognized by idempotency_key
+    """
+    __tablename__ = "upload_jobs"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    # User, file and visibility, see database.upload_idempotency_key
+    idempotency_key: Mapped[str] = mapped_column(Text, unique=True)
+    user_telegram_id: Mapped[int] = mapped_column(BigInteger)
+    # Chat that gets message when job is finished
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    telegram_media_id: Mapped[str] = mapped_column(Text)
+    telegram_file_unique_id: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    title: Mapped[str] = mapped_column(Text)
+    tags: Mapped[list[str]] = mapped_column(ARRAY(Text), server_default="{}")
+    media_type: Mapped[MediaType] = mapped_column(Enum(MediaType, name="media_type", values_callable=lambda obj: [e.value for e in obj]))
+    duration: Mapped[int] = mapped_column(Integer, default=0)
+    is_public: Mapped[bool]
+    # "pending", "done" or "failed"
+    status: Mapped[str] = mapped_column(Text, server_default="pending")
+    # Value of AddMemeResult for finished jobs
+    result: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, server_default="0")
+    # Failed attempts are retried after backoff
+    run_after: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # Workers take oldest pending jobs that are due
+        Index(
+            'upload_jobs_pending_index',
+            'run_after',
+            'id',
+            postgresql_where=text("status = 'pending'")
+        ),
+        Index(
+            'upload_jobs_finished_at_index',
+            'finished_at',
+            postgresql_where=text("status <> 'pending'")
+        ),
+    )
+
+
+class SelectedMeme(Base):
+    """
+    Memes selected in multi-select mode of memes menu. Kept in database, so every bot process sees
+    the same selection. Bulk actions check creator of memes, selection isn't trusted
+    """
+    __tablename__ = "selected_memes"
+
+    user_telegram_id: Mapped[int] = mapped_column(ForeignKey("users.telegram_id"), primary_key=True)
+    # No foreign key to partitioned memes, selection of deleted meme is harmless
+    meme_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
@@ -0,0 +1,257 @@
+"""
+Partitioned layout of memes table, shared by migration 0004 and migrations/partition_memes.py.
+
+memes is partitioned by visibility: public memes are one partition that inline search of every user reads,
+private memes are split by hash of creator, so search of user's private memes reads one small partition.
+Postgres requires partition key in every unique index, so primary key is (id, is_public) and
+meme_to_collection and user_liked_memes can't have foreign keys to memes, their rows are deleted by trigger.
+
+Migration to partitioned layout:
+ 1. create_shadow_statements() creates memes_partitioned next to memes,
+    trigger copies every change of memes into it from then on
+ 2. rows are copied in batches by backfill_batch_statement(), while bots keep running
+ 3. swap_statements() renames memes_partitioned to memes under a short lock
+unswap_statements() brings old table back while it still exists.
+"""
+from memes_db.models import MediaType
+
+SHADOW_TABLE = "memes_partitioned"
+# Old table is kept under this name until it is dropped by hand, downgrade of partitioning needs it
+OLD_TABLE = "memes_unpartitioned"
+PRIVATE_HASH_PARTITIONS = 8
+# Comment of memes_partitioned after all rows were copied into it
+BACKFILLED = "backfilled"
+
+COLUMNS = ("id, creator_telegram_id, duration, telegram_media_id, telegram_file_unique_id, title, tags, "
+           "media_type, is_public")
+NORMALIZERS = """WITH (normalizers = 'NormalizerNFKC150("remove_symbol", true)')"""
+
+# Index name -> (is unique, definition). Indexes are made on partitioned table
+# and postgres creates them on every partition
+INDEXES = {
+    "memes_creator_id_index": (False, "(creator_telegram_id, id)"),
+    "memes_public_file_unique_id_index": (True, "(telegram_file_unique_id, is_public) WHERE is_public"),
+    "memes_private_file_unique_id_index":
+        (True, "(creator_telegram_id, telegram_file_unique_id, is_public) WHERE NOT is_public"),
+    "pgroonga_memes_titles_index": (False, f"USING pgroonga (title) {NORMALIZERS}"),
+    "pgroonga_memes_tags_index": (False, f"USING pgroonga (tags) {NORMALIZERS}"),
+    "memes_tags_gin_index": (False, "USING gin (tags)"),
+    **{
+        f"pgroonga_memes_{media_type.value}_{column}_index":
+            (False, f"USING pgroonga ({column_name}) {NORMALIZERS} WHERE media_type = '{media_type.value}'")
+        for media_type in MediaType
+        for column, column_name in (("titles", "title"), ("tags", "tags"))
+    },
+}
+
+
+def _shadow_index_name(name: str) -> str:
+    return f"{name}_partitioned"
+
+
+def create_index_statement(name: str, table: str, index_name: str = None) -> str:
+    """Create index from INDEXES on table, under index_name if it is given"""
+    unique, definition = INDEXES[name]
+    return f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index_name or name} ON {table} {definition}"
+
+
+def create_shadow_statements() -> list[str]:
+    """Create memes_partitioned with its partitions and indexes, and trigger that keeps it in sync with memes"""
+    statements = [
+        f"""
+        CREATE TABLE IF NOT EXISTS {SHADOW_TABLE} (
+            id BIGINT NOT NULL DEFAULT nextval('memes_id_seq'),
+            creator_telegram_id BIGINT NOT NULL REFERENCES users (telegram_id),
+            duration INTEGER NOT NULL,
+            telegram_media_id TEXT NOT NULL,
+            telegram_file_unique_id TEXT,
+            title TEXT NOT NULL,
+            tags TEXT[] DEFAULT '{{}}' NOT NULL,
+            media_type media_type NOT NULL,
+            is_public BOOLEAN NOT NULL,
+            PRIMARY KEY (id, is_public)
+        ) PARTITION BY LIST (is_public)
+        """,
+        f"CREATE TABLE IF NOT EXISTS memes_public PARTITION OF {SHADOW_TABLE} FOR VALUES IN (TRUE)",
+        f"""
+        CREATE TABLE IF NOT EXISTS memes_private PARTITION OF {SHADOW_TABLE} FOR VALUES IN (FALSE)
+        PARTITION BY HASH (creator_telegram_id)
+        """,
+        *[
+            f"""
+            CREATE TABLE IF NOT EXISTS memes_private_{remainder} PARTITION OF memes_private
+            FOR VALUES WITH (MODULUS {PRIVATE_HASH_PARTITIONS}, REMAINDER {remainder})
+            """
+            for remainder in range(PRIVATE_HASH_PARTITIONS)
+        ],
+        *[create_index_statement(name, SHADOW_TABLE, _shadow_index_name(name)) for name in INDEXES],
+        f"""
+        CREATE OR REPLACE FUNCTION sync_{SHADOW_TABLE}() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM {SHADOW_TABLE} WHERE id = OLD.id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {SHADOW_TABLE} ({COLUMNS})
+                VALUES (NEW.id, NEW.creator_telegram_id, NEW.duration, NEW.telegram_media_id,
+                        NEW.telegram_file_unique_id, NEW.title, NEW.tags, NEW.media_type, NEW.is_public);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        f"""
+        CREATE OR REPLACE TRIGGER sync_{SHADOW_TABLE}_trigger
+        AFTER INSERT OR UPDATE OR DELETE ON memes
+        FOR EACH ROW EXECUTE FUNCTION sync_{SHADOW_TABLE}()
+        """,
+    ]
+    return statements
+
+
+def backfill_batch_statement() -> str:
+    """
+    Copy memes with ids in [:first_id, :last_id] that aren't copied yet.
+    Rows are locked while they are copied, so concurrent updates are applied by sync trigger after the copy
+    """
+    return f"""
+        INSERT INTO {SHADOW_TABLE} ({COLUMNS})
+        SELECT {COLUMNS} FROM memes
+        WHERE id BETWEEN :first_id AND :last_id
+        FOR SHARE
+        ON CONFLICT DO NOTHING
+    """
+
+
+def mark_backfilled_statement() -> str:
+    return f"COMMENT ON TABLE {SHADOW_TABLE} IS '{BACKFILLED}'"
+
+
+def copy_all_statement() -> str:
+    """Copy all memes at once, for databases that are small enough to be copied under lock"""
+    return f"INSERT INTO {SHADOW_TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM memes ON CONFLICT DO NOTHING"
+
+
+# Change feed sends name of partitioned table, trigger functions on partitions would see partition names
+NOTIFY_CHANGES = """
+    CREATE OR REPLACE FUNCTION notify_changes() RETURNS trigger AS $$
+    DECLARE
+        changed jsonb;
+        previous jsonb;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            changed := to_jsonb(OLD);
+        ELSE
+            changed := to_jsonb(NEW);
+        END IF;
+        IF TG_OP = 'UPDATE' THEN
+            previous := to_jsonb(OLD);
+        END IF;
+        PERFORM pg_notify('changes', jsonb_strip_nulls(jsonb_build_object(
+            't', coalesce(TG_ARGV[0], TG_TABLE_NAME),
+            'op', left(TG_OP, 1),
+            'id', coalesce(changed -> 'id', changed -> 'telegram_id'),
+            'c', changed -> 'creator_telegram_id',
+            'p', changed -> 'is_public',
+            'b', CASE WHEN previous -> 'is_banned' IS DISTINCT FROM changed -> 'is_banned'
+                      THEN changed -> 'is_banned' END
+        ))::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# Replaces foreign keys of meme_to_collection and user_liked_memes.
+# Changing visibility moves row to other partition, its delete must not remove anything
+DELETE_MEME_REFERENCES = """
+    CREATE OR REPLACE FUNCTION delete_meme_references() RETURNS trigger AS $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM memes WHERE id = OLD.id) THEN
+            DELETE FROM meme_to_collection WHERE meme_id = OLD.id;
+            DELETE FROM user_liked_memes WHERE meme_id = OLD.id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+MEMES_TRIGGERS = [
+    """
+    CREATE OR REPLACE TRIGGER memes_changes_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON memes
+    FOR EACH ROW EXECUTE FUNCTION notify_changes('memes')
+    """,
+    """
+    CREATE OR REPLACE TRIGGER memes_tags_usage_trigger
+    AFTER INSERT OR DELETE OR UPDATE OF tags ON memes
+    FOR EACH ROW EXECUTE FUNCTION update_tags_usage()
+    """,
+    """
+    CREATE OR REPLACE TRIGGER memes_version_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON memes
+    FOR EACH ROW EXECUTE FUNCTION bump_memes_version()
+    """,
+]
+
+DELETE_REFERENCES_TRIGGER = """
+    CREATE OR REPLACE TRIGGER memes_delete_references_trigger
+    AFTER DELETE ON memes
+    FOR EACH ROW EXECUTE FUNCTION delete_meme_references()
+"""
+
+# Foreign keys to memes that partitioned table can't have
+REFERENCES = {
+    "meme_to_collection": "meme_to_collection_meme_id_fkey",
+    "user_liked_memes": "user_liked_memes_meme_id_fkey",
+}
+
+
+def swap_statements() -> list[str]:
+    """
+    Replace memes with memes_partitioned. Has to run in one transaction,
+    memes is locked from the first statement, so no change can be missed
+    """
+    return [
+        "LOCK TABLE memes IN ACCESS EXCLUSIVE MODE",
+        f"DROP TRIGGER IF EXISTS sync_{SHADOW_TABLE}_trigger ON memes",
+        f"DROP FUNCTION IF EXISTS sync_{SHADOW_TABLE}()",
+        "DROP TRIGGER IF EXISTS memes_changes_trigger ON memes",
+        "DROP TRIGGER IF EXISTS memes_tags_usage_trigger ON memes",
+        "DROP TRIGGER IF EXISTS memes_version_trigger ON memes",
+        *[f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}" for table, constraint in REFERENCES.items()],
+        # Sequence would be dropped together with old table
+        f"ALTER SEQUENCE memes_id_seq OWNED BY {SHADOW_TABLE}.id",
+        f"ALTER TABLE memes RENAME TO {OLD_TABLE}",
+        f"ALTER TABLE {OLD_TABLE} RENAME CONSTRAINT memes_pkey TO {OLD_TABLE}_pkey",
+        *[f"ALTER INDEX IF EXISTS {name} RENAME TO {name}_unpartitioned" for name in INDEXES],
+        f"ALTER TABLE {SHADOW_TABLE} RENAME TO memes",
+        f"ALTER TABLE memes RENAME CONSTRAINT {SHADOW_TABLE}_pkey TO memes_pkey",
+        *[f"ALTER INDEX {_shadow_index_name(name)} RENAME TO {name}" for name in INDEXES],
+        NOTIFY_CHANGES,
+        DELETE_MEME_REFERENCES,
+        *MEMES_TRIGGERS,
+        DELETE_REFERENCES_TRIGGER,
+    ]
+
+
+def unswap_statements() -> list[str]:
+    """
+    Replace partitioned memes with old table, reverse of swap_statements(). Has to run in one transaction.
+    Memes added or changed since the swap are only in partitioned table, so old table gets all rows again,
+    under lock of memes for the whole copy
+    """
+    return [
+        "LOCK TABLE memes IN ACCESS EXCLUSIVE MODE",
+        "DROP TRIGGER IF EXISTS memes_delete_references_trigger ON memes",
+        "DROP FUNCTION IF EXISTS delete_meme_references()",
+        f"TRUNCATE {OLD_TABLE}",
+        f"INSERT INTO {OLD_TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM memes",
+        f"ALTER SEQUENCE memes_id_seq OWNED BY {OLD_TABLE}.id",
+        "DROP TABLE memes",
+        f"ALTER TABLE {OLD_TABLE} RENAME TO memes",
+        f"ALTER TABLE memes RENAME CONSTRAINT {OLD_TABLE}_pkey TO memes_pkey",
+        *[f"ALTER INDEX IF EXISTS {name}_unpartitioned RENAME TO {name}" for name in INDEXES],
+        *[f"ALTER TABLE {table} ADD CONSTRAINT {constraint} FOREIGN KEY (meme_id) REFERENCES memes (id)"
+          for table, constraint in REFERENCES.items()],
+        *MEMES_TRIGGERS,
+    ]
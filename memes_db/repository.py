@@ -0,0 +1,145 @@
+"""
+Queries used by both bot and mini app.
+Query texts are constant for given set of filters, so psycopg prepares them on server after PREPARE_THRESHOLD runs
+"""
+import asyncio
+from typing import Optional, Iterable, AsyncIterator
+
+from sqlalchemy import text
+
+from memes_db import engine as db_engine
+from memes_db.models import MediaType
+from memes_db.search_query import build_search_query, NOT_BANNED_CONDITION
+from memes_db.unit_of_work import unit_of_work
+
+# Duplicates are collapsed after search, so more rows are fetched than shown
+SEARCH_OVERFETCH = 2
+STREAM_SEARCH_PAGE_SIZE = 20
+MAX_STREAMED_RESULTS = 500
+
+MEMES_VERSION_QUERY = text("SELECT version FROM memes_versions WHERE creator_telegram_id = :user_id")
+MEME_MEDIA_QUERY = text(f"""
+    SELECT telegram_media_id, media_type, is_public
+    FROM memes
+    WHERE id = :meme_id AND (creator_telegram_id = :user_id OR (is_public AND {NOT_BANNED_CONDITION}))
+""")
+
+
+def collapse_duplicates(memes: Iterable, limit: int) -> list:
+    """Keep only best scored meme of every file. Memes must be sorted by score and have telegram_file_unique_id"""
+    seen = set()
+    collapsed = []
+    for meme in memes:
+        key = meme.telegram_file_unique_id or ("id", meme.id)
+        if key in seen:
+            continue
+        seen.add(key)
+        collapsed.append(meme)
+        if len(collapsed) >= limit:
+            break
+    return collapsed
+
+
+async def search_memes(query: str, user_id: int, limit: int, tags: Optional[list[str]] = None,
+                       media_type: Optional[MediaType] = None,
+                       collection_ids: Optional[list[int]] = None,
+                       private_only: bool = False) -> list:
+    """
+    Search memes visible to user, best matches first. Only one meme of every file is returned
+    Args:
+        query: text for full text search, can be empty if tags are given
+        user_id: telegram id of user, their private memes are searched too
+        limit: maximum amount of memes
+        tags: memes must have all of these tags
+        media_type: search only memes of this media type
+        collection_ids: search only memes from these collections
+        private_only: search only user's private memes
+    """
+    search_query = build_search_query(query, user_id, tags=tags, media_type=media_type,
+                                      collection_ids=collection_ids, limit=limit * SEARCH_OVERFETCH,
+                                      private_only=private_only)
+    async with unit_of_work() as session:
+        result = await session.execute(search_query)
+        # User's private copy of public meme would show up twice
+        return collapse_duplicates(result.fetchall(), limit)
+
+
+async def stream_search(query: str, user_id: int, tags: Optional[list[str]] = None,
+                        media_type: Optional[MediaType] = None,
+                        page_size: int = STREAM_SEARCH_PAGE_SIZE) -> AsyncIterator[list]:
+    """
+    Same search as search_memes, but results are read through server side cursor
+    and yielded page by page, best matches first. Duplicates are not collapsed
+    """
+    search_query = build_search_query(query, user_id, tags=tags, media_type=media_type, limit=MAX_STREAMED_RESULTS)
+    async with db_engine.engine.connect() as conn:
+        try:
+            result = await conn.stream(search_query)
+            async for rows in result.partitions(page_size):
+                yield rows
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client is gone, stop query on server instead of letting it run to the end
+            raw_connection = await conn.get_raw_connection()
+            await raw_connection.driver_connection.cancel_safe()
+            raise
+
+
+async def get_memes_version(user_id: int) -> int:
+    """Counter that changes whenever any meme of user changes. Zero if it didn't change since counting started"""
+    async with unit_of_work() as session:
+        version = await session.scalar(MEMES_VERSION_QUERY, {"user_id": user_id})
+        return version or 0
+
+
+async def get_meme_media(meme_id: int, user_id: int) -> Optional[tuple[str, str, bool]]:
+    """(telegram_media_id, media_type, is_public) of meme, None if user can't see it"""
+    async with unit_of_work() as session:
+        row = (await session.execute(MEME_MEDIA_QUERY, {"meme_id": meme_id, "user_id": user_id})).first()
+        return tuple(row) if row is not None else None
+
+
+async def get_user_memes_page(user_id: int,
+                              limit: int,
+                              before_id: Optional[int] = None,
+                              media_type: Optional[str] = None,
+                              tags: Optional[list[str]] = None,
+                              query: Optional[str] = None,
+                              is_public: Optional[bool] = None) -> list:
+    """
+    Page of user's memes, newest first. Pages are keyset paginated by id,
+    so next page starts after the last id of previous one no matter how deep it is
+    Args:
+        before_id: id of last meme of previous page, None for first page
+        media_type: value of media_type enum
+        tags: memes must have all of these tags
+        query: text that title or tags must match
+    Returns:
+        rows of (id, title, tags, media_type, is_public)
+    """
+    conditions = ["creator_telegram_id = :user_id"]
+    params = {"user_id": user_id, "limit": limit}
+    if before_id is not None:
+        conditions.append("id < :before_id")
+        params["before_id"] = before_id
+    if media_type is not None:
+        conditions.append("media_type = CAST(:media_type AS media_type)")
+        params["media_type"] = media_type
+    if tags:
+        conditions.append("tags @> CAST(:tags AS text[])")
+        params["tags"] = tags
+    if query:
+        conditions.append("(title &@ :query OR tags &@ :query)")
+        params["query"] = query
+    if is_public is not None:
+        conditions.append("is_public = :is_public")
+        params["is_public"] = is_public
+
+    async with unit_of_work() as session:
+        result = await session.execute(text(f"""
+            SELECT id, title, tags, media_type, is_public
+            FROM memes
+            WHERE {" AND ".join(conditions)}
+            ORDER BY id DESC
+            LIMIT :limit
+        """), params)
+        return result.fetchall()
@@ -0,0 +1,25 @@
+"""
+Schema is created and changed only by Alembic migrations in migrations/.
+Services don't run DDL on startup, they only check that database is migrated to revision they were written for.
+"""
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+# Has to be updated together with every new migration
+REVISION = "0007"
+
+
+class SchemaMismatchError(RuntimeError):
+    pass
+
+
+async def check_revision(conn: AsyncConnection) -> None:
+    """Raises SchemaMismatchError if database isn't migrated to REVISION"""
+    try:
+        revision = await conn.scalar(text("SELECT version_num FROM alembic_version"))
+    except ProgrammingError:
+        revision = None
+    if revision != REVISION:
+        raise SchemaMismatchError(f"Database schema is at revision {revision}, expected {REVISION}. "
+                                  f"Run alembic upgrade head")
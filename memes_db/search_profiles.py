@@ -0,0 +1,116 @@
+"""
+Tokenizer and normalizer profiles of pgroonga indexes.
+
+Every indexed column belongs to an index group, INDEX_PROFILES sets default profile of every group,
+that is what migrations create. Other profiles are opt-in per database: measure them on its memes with
+benchmarks/search_profiles_benchmark.py, then switch with python migrations/maintain_indexes.py profile <group> <profile>.
+Profiles with plugins need them installed in groonga, e.g. stemming needs token_filters/stem
+(groonga-token-filter-stem package), check that the database image has it before switching.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import text, Connection
+
+from memes_db import index_maintenance
+
+NFKC = 'NormalizerNFKC150("remove_symbol", true)'
+
+
+@dataclass(frozen=True)
+class SearchProfile:
+    normalizers: str = NFKC
+    # None for pgroonga default TokenBigram
+    tokenizer: Optional[str] = None
+    token_filters: Optional[str] = None
+    # Groonga plugins that tokenizer or token filters come from
+    plugins: Optional[str] = None
+
+    def options(self) -> dict[str, str]:
+        """Index options as postgresql_with of sqlalchemy Index"""
+        options = {"normalizers": self.normalizers, "tokenizer": self.tokenizer,
+                   "token_filters": self.token_filters, "plugins": self.plugins}
+        return {name: f"'{value}'" for name, value in options.items() if value is not None}
+
+    def with_clause(self) -> str:
+        return "WITH (" + ", ".join(f"{name} = {value}" for name, value in self.options().items()) + ")"
+
+
+PROFILES = {
+    # Runs of letters and of digits are whole tokens, everything else is split into bigrams
+    "bigram": SearchProfile(),
+    # Letters and digits are split into bigrams too, so part of a word matches
+    "bigram_split": SearchProfile(tokenizer="TokenBigramSplitSymbolAlphaDigit"),
+    # Same as bigram_split, with positions that keep phrase search exact
+    "ngram": SearchProfile(tokenizer='TokenNgram("unify_alphabet", false, "unify_digit", false)'),
+    # Words match regardless of spaces and symbols between them, "when you" finds "whenyou"
+    "ngram_loose": SearchProfile(tokenizer='TokenNgram("loose_symbol", true, "loose_blank", true)'),
+    # Whole words reduced to stems, "коты" finds "кота", english words are left as they are
+    "bigram_stem_ru": SearchProfile(tokenizer="TokenBigram", token_filters='TokenFilterStem("algorithm", "russian")',
+                                    plugins="token_filters/stem"),
+    "bigram_stem_en": SearchProfile(tokenizer="TokenBigram", token_filters='TokenFilterStem("algorithm", "english")',
+                                    plugins="token_filters/stem"),
+}
+
+# Index group -> (table, column)
+INDEX_GROUPS = {
+    "memes_titles": ("memes", "title"),
+    "memes_tags": ("memes", "tags"),
+    "collections_titles": ("collections", "title"),
+    "collections_tags": ("collections", "tags"),
+}
+
+# Profiles created by migrations
+INDEX_PROFILES = {
+    "memes_titles": "bigram",
+    "memes_tags": "bigram",
+    "collections_titles": "bigram",
+    "collections_tags": "bigram",
+}
+
+
+def index_options(group: str) -> dict[str, str]:
+    return PROFILES[INDEX_PROFILES[group]].options()
+
+
+def group_indexes(group: str) -> list[tuple[str, Optional[str]]]:
+    """(index name, partial index condition) of every index of group"""
+    from memes_db.models import MediaType
+
+    table, column = INDEX_GROUPS[group]
+    suffix = "titles" if column == "title" else "tags"
+    indexes = [(f"pgroonga_{table}_{suffix}_index", None)]
+    if table == "memes":
+        indexes += [(f"pgroonga_memes_{media_type.value}_{suffix}_index", f"media_type = '{media_type.value}'")
+                    for media_type in MediaType]
+    return indexes
+
+
+def create_index_statement(name: str, table: str, column: str, profile: SearchProfile,
+                           where: Optional[str] = None, only: bool = False, concurrently: bool = False) -> str:
+    return (f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}{name} ON {'ONLY ' if only else ''}{table} "
+            f"USING pgroonga ({column}) {profile.with_clause()}{f' WHERE {where}' if where else ''}")
+
+
+def has_profile(connection: Connection, name: str, profile: SearchProfile) -> bool:
+    reloptions = connection.scalar(text("SELECT reloptions FROM pg_class WHERE oid = CAST(:name AS regclass)"),
+                                   {"name": name}) or []
+    options = dict(option.split("=", 1) for option in reloptions)
+    return options == {option: value.strip("'") for option, value in profile.options().items()}
+
+
+def switch_profile(connection: Connection, group: str, profile_name: str) -> None:
+    """
+    Rebuild indexes of group with profile while table keeps being written, see memes_db/index_maintenance.py.
+    Indexes that already have the profile are left as they are.
+    Connection has to be in autocommit mode, e.g. inside op.get_context().autocommit_block()
+    """
+    table, column = INDEX_GROUPS[group]
+    profile = PROFILES[profile_name]
+    for name, where in group_indexes(group):
+        if index_maintenance.index_exists(connection, name) and has_profile(connection, name, profile):
+            continue
+        index_maintenance.replace_index(
+            connection, name, table,
+            lambda index_name, relation, only, concurrently, where=where: create_index_statement(
+                index_name, relation, column, profile, where, only, concurrently))
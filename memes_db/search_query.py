@@ -0,0 +1,125 @@
+"""
+Inline search query of the bot. Mini app runs the same query, so results are ranked the same way everywhere.
+"""
+from typing import Optional
+
+from sqlalchemy import text, TextClause
+
+from memes_db.models import MediaType
+
+
+# Search condition shared by all inline search queries.
+# memes is partitioned, indexes named in the query would be partitioned parents that hold nothing,
+# so index_name isn't given and every partition is searched with its own index, normalizers come from it
+SEARCH_CONDITION = """
+    (
+        title &@ pgroonga_condition(
+            :query,
+            ARRAY[5],
+            fuzzy_max_distance_ratio => 0.34
+        )
+        OR tags &@ pgroonga_condition(
+            :query,
+            fuzzy_max_distance_ratio => 0.34
+        )
+        OR title &@~ pgroonga_condition(
+            :OR_query,
+            ARRAY[1],
+            fuzzy_max_distance_ratio => 0.34
+        )
+        OR tags &@~ pgroonga_condition(
+            :OR_query,
+            fuzzy_max_distance_ratio => 0.34
+        )
+    )
+"""
+
+
+# Memes of banned users aren't shown to anyone
+NOT_BANNED_CONDITION = "creator_telegram_id NOT IN (SELECT telegram_id FROM users WHERE is_banned)"
+
+
+def get_search_condition(media_type: Optional[MediaType] = None) -> str:
+    """
+    Search condition for all memes or memes of one media type.
+    Media type is put into query as literal so planner can use partial indexes of that type
+    """
+    if media_type is None:
+        return SEARCH_CONDITION
+
+    # Goes through MediaType so only known values get into query text
+    media_type = MediaType(media_type.value)
+    return f"media_type = '{media_type.value}' AND {SEARCH_CONDITION}"
+
+
+def generate_OR_query(query: str) -> str:
+    return " OR ".join(query.split())
+
+
+def build_search_query(query: str, user_id: int, tags: Optional[list[str]] = None,
+                       media_type: Optional[MediaType] = None,
+                       collection_ids: Optional[list[int]] = None,
+                       limit: Optional[int] = None,
+                       private_only: bool = False) -> TextClause:
+    """
+    Query of memes visible to user, best matches first.
+    Public memes and user's private memes are searched by separate branches of UNION ALL,
+    so each of them reads only its partition: public one, or user's hash partition of private memes.
+    Rows are (id, title, telegram_media_id, telegram_file_unique_id, media_type, is_public, score)
+    Args:
+        query: text for full text search, can be empty if tags are given
+        user_id: telegram id of user, their private memes are searched too
+        tags: memes must have all of these tags
+        media_type: search only memes of this media type
+        collection_ids: search only memes from these collections
+        limit: maximum amount of rows, None for all of them
+        private_only: search only user's private memes
+    """
+    branches = ["is_public = FALSE AND creator_telegram_id = :user_id"]
+    if not private_only:
+        branches.insert(0, "is_public = TRUE")
+    conditions = [NOT_BANNED_CONDITION]
+    params = {'user_id': user_id}
+
+    if query:
+        conditions.append(get_search_condition(media_type))
+        params['query'] = query
+        params['OR_query'] = generate_OR_query(query)
+        order_by = "score DESC, id DESC"
+    else:
+        order_by = "id DESC"
+        if media_type is not None:
+            conditions.append("media_type = CAST(:media_type AS media_type)")
+            params['media_type'] = media_type.value
+
+    if collection_ids is not None:
+        conditions.append("""id IN (
+            SELECT meme_id FROM meme_to_collection WHERE collection_id = ANY(CAST(:collection_ids AS bigint[]))
+        )""")
+        params['collection_ids'] = collection_ids
+
+    if tags:
+        # Uses GIN index, no fuzzy matching for exact tags
+        conditions.append("tags @> CAST(:tags AS text[])")
+        params['tags'] = tags
+
+    limit_clause = ""
+    if limit is not None:
+        limit_clause = "LIMIT :limit"
+        params['limit'] = limit
+
+    # Each branch is limited too, so only the best rows of every partition are merged
+    selects = " UNION ALL ".join(f"""(
+            SELECT id, title, telegram_media_id, telegram_file_unique_id, media_type, is_public,
+                   pgroonga_score(tableoid, ctid) AS score
+            FROM memes
+            WHERE {branch} AND {" AND ".join(conditions)}
+            ORDER BY {order_by}
+            {limit_clause}
+        )""" for branch in branches)
+    return text(f"""
+        SELECT id, title, telegram_media_id, telegram_file_unique_id, media_type, is_public, score
+        FROM ({selects}) AS found
+        ORDER BY {order_by}
+        {limit_clause}
+    """).bindparams(**params)
@@ -0,0 +1,152 @@
+"""
+Unit of work: one transaction for a block of database work, e.g. one function of database module.
+Outermost unit_of_work() or transaction() block commits when it ends and rolls back if it raises,
+so connection is checked out only while the block runs and never while update waits for telegram.
+Units of work inside shared_session() use one session, so objects loaded once come from its identity map.
+"""
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from memes_db import engine as db_engine
+
+logger = logging.getLogger(__name__)
+
+# Log averages after that many units of work
+STATS_LOG_INTERVAL = 1000
+
+_current_session: ContextVar[Optional[AsyncSession]] = ContextVar("unit_of_work_session", default=None)
+
+
+@dataclass
+class UnitOfWorkStats:
+    units: int = 0
+    checkouts: int = 0
+    queries: int = 0
+    max_checkouts: int = 0
+    max_queries: int = 0
+
+    def record(self, checkouts: int, queries: int) -> None:
+        self.units += 1
+        self.checkouts += checkouts
+        self.queries += queries
+        self.max_checkouts = max(self.max_checkouts, checkouts)
+        self.max_queries = max(self.max_queries, queries)
+
+    def __str__(self):
+        units = max(self.units, 1)
+        return (f"{self.units} units of work, per unit: {self.checkouts / units:.2f} connection checkouts "
+                f"(max {self.max_checkouts}), {self.queries / units:.2f} queries (max {self.max_queries})")
+
+
+stats = UnitOfWorkStats()
+
+
+@event.listens_for(Session, "after_begin")
+def _count_checkout(session, transaction, connection):
+    if "checkouts" in session.info:
+        session.info["checkouts"] += 1
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _count_query(orm_execute_state):
+    info = orm_execute_state.session.info
+    if "queries" in info:
+        info["queries"] += 1
+
+
+def after_commit(session: AsyncSession, callback: Callable[[], None]) -> None:
+    """Call callback after unit of work of session is committed, e.g. to update caches"""
+    session.info.setdefault("after_commit", []).append(callback)
+
+
+def _new_session() -> AsyncSession:
+    session = db_engine.session_maker()
+    session.info.update(checkouts=0, queries=0, in_unit=False)
+    return session
+
+
+async def _close(session: AsyncSession) -> None:
+    await session.close()
+    _record(session.info)
+
+
+@asynccontextmanager
+async def shared_session() -> AsyncIterator[None]:
+    """Units of work inside the block, e.g. all of one update, share one session"""
+    if _current_session.get() is not None:
+        yield
+        return
+    session = _new_session()
+    token = _current_session.set(session)
+    try:
+        yield
+    finally:
+        _current_session.reset(token)
+        await _close(session)
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[AsyncSession]:
+    """
+    Session whose transaction is committed when block ends and rolled back if it raises.
+    Nested unit_of_work() inside it is part of the same transaction
+    """
+    session = _current_session.get()
+    if session is not None and session.info["in_unit"]:
+        yield session
+        return
+
+    shared = session is not None
+    if not shared:
+        session = _new_session()
+    session.info["in_unit"] = True
+    try:
+        yield session
+        await session.commit()
+    except BaseException:
+        session.info.pop("after_commit", None)
+        await session.rollback()
+        raise
+    finally:
+        session.info["in_unit"] = False
+        if not shared:
+            await _close(session)
+
+    for callback in session.info.pop("after_commit", []):
+        callback()
+
+
+@asynccontextmanager
+async def transaction() -> AsyncIterator[AsyncSession]:
+    """
+    Session for writes that have to succeed or fail together.
+    Inside another unit of work it's a savepoint: if block raises, only its writes are rolled back
+    """
+    session = _current_session.get()
+    if session is None or not session.info["in_unit"]:
+        async with unit_of_work() as session:
+            yield session
+        return
+
+    callbacks = session.info.setdefault("after_commit", [])
+    queued = len(callbacks)
+    try:
+        async with session.begin_nested():
+            yield session
+    except Exception:
+        del callbacks[queued:]
+        raise
+
+
+def _record(info: dict) -> None:
+    stats.record(info["checkouts"], info["queries"])
+    logger.debug(f"Unit of work: {info['checkouts']} connection checkouts, {info['queries']} queries")
+    if stats.units % STATS_LOG_INTERVAL == 0:
+        logger.info(str(stats))
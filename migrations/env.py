@@ -4,7 +4,7 @@ from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 
 from alembic import context
-from bot_backend.src.models import Base
+from memes_db.models import Base
 from os import getenv
 
 # this is the Alembic Config object, which provides
@@ -0,0 +1,161 @@
+"""
+Index maintenance while bots keep running, see memes_db/index_maintenance.py for how indexes are rebuilt.
+
+Usage:
+    python migrations/maintain_indexes.py stats
+        size, entries and bloat of every index
+    python migrations/maintain_indexes.py rebuild <index> [<index> ...]
+        rebuild indexes now, progress of builds is printed
+    python migrations/maintain_indexes.py profile <group> <profile>
+        rebuild pgroonga indexes of group with other search profile, see memes_db/search_profiles.py
+    python migrations/maintain_indexes.py maintain [once]
+        rebuild indexes whose bloat is above MAINTENANCE_BLOAT_THRESHOLD, only during MAINTENANCE_WINDOW.
+        Keeps checking every MAINTENANCE_CHECK_MINUTES, or checks once, e.g. when started by cron
+Bloat of btree indexes is known only with pgstattuple extension installed (CREATE EXTENSION pgstattuple).
+"""
+import logging
+import sys
+import threading
+import time
+from datetime import datetime, time as day_time
+from os import getenv
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import create_engine, text, Connection, Engine
+
+from memes_db import index_maintenance, search_profiles
+from memes_db.config import DATABASE_URL
+from memes_db.models import Base
+
+# Local time when maintain rebuilds indexes, e.g. 03:00-06:00, may pass midnight
+MAINTENANCE_WINDOW = getenv("MAINTENANCE_WINDOW", "03:00-06:00")
+MAINTENANCE_BLOAT_THRESHOLD = float(getenv("MAINTENANCE_BLOAT_THRESHOLD", "0.3"))
+MAINTENANCE_CHECK_MINUTES = float(getenv("MAINTENANCE_CHECK_MINUTES", "30"))
+MAINTENANCE_WORK_MEM = getenv("MAINTENANCE_WORK_MEM", "256MB")
+# Pause between partitions of partitioned index
+PAUSE = 5
+PROGRESS_INTERVAL = 5
+
+PROGRESS_QUERY = """
+    SELECT relid::regclass::text, phase, blocks_done, blocks_total, tuples_done, tuples_total
+    FROM pg_stat_progress_create_index WHERE pid = :pid
+"""
+
+
+def builder_connection(engine: Engine) -> Connection:
+    conn = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    # Builds use one core and limited memory, queries of bots get the rest
+    conn.exec_driver_sql("SET max_parallel_maintenance_workers = 0")
+    conn.exec_driver_sql(f"SET maintenance_work_mem = '{MAINTENANCE_WORK_MEM}'")
+    conn.exec_driver_sql("SET statement_timeout = 0")
+    return conn
+
+
+def report_progress(engine: Engine, pid: int, done: threading.Event) -> None:
+    """Print progress of index builds of builder connection until done is set"""
+    with engine.connect() as conn:
+        while not done.wait(PROGRESS_INTERVAL):
+            row = conn.execute(text(PROGRESS_QUERY), {"pid": pid}).first()
+            conn.rollback()
+            if row is None:
+                continue
+            relation, phase, blocks_done, blocks_total, tuples_done, tuples_total = row
+            if blocks_total:
+                progress = f"{blocks_done / blocks_total:7.2%} of blocks"
+            elif tuples_total:
+                progress = f"{tuples_done / tuples_total:7.2%} of tuples"
+            else:
+                progress = ""
+            print(f"  {relation}: {phase} {progress}", flush=True)
+
+
+def with_progress(engine: Engine, build: Callable[[Connection], None]) -> None:
+    """Run build on builder connection, printing progress of index builds"""
+    with builder_connection(engine) as conn:
+        done = threading.Event()
+        reporter = threading.Thread(target=report_progress,
+                                    args=(engine, conn.scalar(text("SELECT pg_backend_pid()")), done), daemon=True)
+        reporter.start()
+        try:
+            build(conn)
+        finally:
+            done.set()
+            reporter.join()
+
+
+def rebuild(engine: Engine, names: list[str]) -> None:
+    def build(conn: Connection) -> None:
+        for name in names:
+            started = time.perf_counter()
+            index_maintenance.rebuild_index(conn, name, PAUSE)
+            print(f"{name} rebuilt in {time.perf_counter() - started:.0f} s", flush=True)
+    with_progress(engine, build)
+
+
+def switch_profile(engine: Engine, group: str, profile_name: str) -> None:
+    if group not in search_profiles.INDEX_GROUPS or profile_name not in search_profiles.PROFILES:
+        sys.exit(f"Groups: {', '.join(search_profiles.INDEX_GROUPS)}\n"
+                 f"Profiles: {', '.join(search_profiles.PROFILES)}")
+    with_progress(engine, lambda conn: search_profiles.switch_profile(conn, group, profile_name))
+    print(f"{group} uses {profile_name}", flush=True)
+
+
+def get_stats(engine: Engine) -> list[index_maintenance.IndexStats]:
+    with engine.connect() as conn:
+        return index_maintenance.index_stats(conn, tuple(Base.metadata.tables))
+
+
+def print_stats(engine: Engine) -> None:
+    print(f"{'index':50} {'method':9} {'size MiB':>10} {'entries':>12} {'bloat':>7}")
+    for stats in get_stats(engine):
+        bloat = "" if stats.bloat is None else f"{stats.bloat:7.1%}"
+        print(f"{stats.name:50} {stats.method:9} {stats.size_bytes / 2 ** 20:10.1f} {stats.entries:12} {bloat:>7}")
+
+
+def in_window(now: datetime) -> bool:
+    start, end = (day_time.fromisoformat(part.strip()) for part in MAINTENANCE_WINDOW.split("-"))
+    if start <= end:
+        return start <= now.time() < end
+    return now.time() >= start or now.time() < end
+
+
+def maintain(engine: Engine, once: bool) -> None:
+    while True:
+        if in_window(datetime.now()):
+            bloated = [stats for stats in get_stats(engine)
+                       if stats.bloat is not None and stats.bloat > MAINTENANCE_BLOAT_THRESHOLD]
+            # Most bloated first, in case window ends before all of them are rebuilt
+            bloated.sort(key=lambda stats: stats.bloat, reverse=True)
+            for stats in bloated:
+                if not in_window(datetime.now()):
+                    break
+                print(f"{stats.name} is {stats.bloat:.1%} bloated, rebuilding", flush=True)
+                rebuild(engine, [stats.name])
+            if not bloated:
+                print("No bloated indexes", flush=True)
+        if once:
+            return
+        time.sleep(MAINTENANCE_CHECK_MINUTES * 60)
+
+
+def main(args: list[str]) -> None:
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+    engine = create_engine(DATABASE_URL)
+    command = args[0] if args else "stats"
+    if command == "stats":
+        print_stats(engine)
+    elif command == "rebuild" and len(args) > 1:
+        rebuild(engine, args[1:])
+    elif command == "profile" and len(args) == 3:
+        switch_profile(engine, args[1], args[2])
+    elif command == "maintain":
+        maintain(engine, args[1:] == ["once"])
+    else:
+        sys.exit(__doc__)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
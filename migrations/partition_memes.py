@@ -0,0 +1,51 @@
+"""
+Online copy of memes into partitioned table, run it before migration 0004 on big databases.
+Bots keep running while rows are copied in small batches, changes made meanwhile are copied by trigger.
+When it's done, run alembic upgrade head, which swaps tables under a short lock.
+
+Usage: python migrations/partition_memes.py [batch_size] [pause_seconds]
+Can be stopped and started again, copied rows are skipped.
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import create_engine, text
+
+from memes_db import partitioning
+from memes_db.config import DATABASE_URL
+
+BATCH_SIZE = 10000
+# Pause between batches, so replication and other queries can keep up
+PAUSE = 0.05
+
+
+def main(batch_size: int, pause: float) -> None:
+    engine = create_engine(DATABASE_URL)
+    with engine.begin() as conn:
+        for statement in partitioning.create_shadow_statements():
+            conn.execute(text(statement))
+        # Rows newer than that are copied by trigger
+        last_id = conn.scalar(text("SELECT max(id) FROM memes")) or 0
+    print(f"Copying memes up to id {last_id}")
+
+    started = time.perf_counter()
+    for batch_first_id in range(0, last_id + 1, batch_size):
+        with engine.begin() as conn:
+            conn.execute(text(partitioning.backfill_batch_statement()),
+                         {"first_id": batch_first_id, "last_id": batch_first_id + batch_size - 1})
+        done = min(batch_first_id + batch_size, last_id) / max(last_id, 1)
+        print(f"\r{done:7.2%} {time.perf_counter() - started:8.0f} s", end="", flush=True)
+        time.sleep(pause)
+
+    with engine.begin() as conn:
+        conn.execute(text(partitioning.mark_backfilled_statement()))
+        conn.execute(text(f"ANALYZE {partitioning.SHADOW_TABLE}"))
+    print("\nDone, run alembic upgrade head to switch to partitioned table")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else BATCH_SIZE,
+         float(sys.argv[2]) if len(sys.argv) > 2 else PAUSE)
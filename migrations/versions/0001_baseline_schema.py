@@ -0,0 +1,233 @@
+"""Baseline schema
+
+Everything that bot used to create on startup. Statements don't fail on existing objects,
+so databases that were created by old bot versions can be upgraded too.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19 12:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+NORMALIZERS = """WITH (normalizers = 'NormalizerNFKC150("remove_symbol", true)')"""
+MEDIA_TYPES = ('audio', 'gif', 'photo', 'video', 'voice')
+
+TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        telegram_id BIGINT NOT NULL,
+        saved_collections BIGINT[] DEFAULT '{}' NOT NULL,
+        is_banned BOOLEAN NOT NULL,
+        PRIMARY KEY (telegram_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS memes (
+        id BIGSERIAL NOT NULL,
+        creator_telegram_id BIGINT NOT NULL,
+        duration INTEGER NOT NULL,
+        telegram_media_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        tags TEXT[] DEFAULT '{}' NOT NULL,
+        media_type media_type NOT NULL,
+        is_public BOOLEAN NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(creator_telegram_id) REFERENCES users (telegram_id)
+    )
+    """,
+    # Added after first release, old tables don't have it
+    "ALTER TABLE memes ADD COLUMN IF NOT EXISTS telegram_file_unique_id TEXT",
+    """
+    CREATE TABLE IF NOT EXISTS collections (
+        id BIGSERIAL NOT NULL,
+        creator_telegram_id BIGINT NOT NULL,
+        likes BIGINT NOT NULL,
+        users_amount BIGINT NOT NULL,
+        title TEXT NOT NULL,
+        tags TEXT[] DEFAULT '{}' NOT NULL,
+        is_public BOOLEAN NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(creator_telegram_id) REFERENCES users (telegram_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS meme_to_collection (
+        id BIGSERIAL NOT NULL,
+        meme_id BIGINT NOT NULL,
+        collection_id BIGINT NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(meme_id) REFERENCES memes (id),
+        FOREIGN KEY(collection_id) REFERENCES collections (id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_liked_memes (
+        id BIGSERIAL NOT NULL,
+        user_telegram_id BIGINT NOT NULL,
+        meme_id BIGINT NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_telegram_id) REFERENCES users (telegram_id),
+        FOREIGN KEY(meme_id) REFERENCES memes (id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tags (
+        name TEXT NOT NULL,
+        usage_count BIGINT NOT NULL,
+        PRIMARY KEY (name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS memes_versions (
+        creator_telegram_id BIGINT NOT NULL,
+        version BIGINT NOT NULL,
+        PRIMARY KEY (creator_telegram_id)
+    )
+    """,
+]
+
+INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS pgroonga_memes_titles_index ON memes USING pgroonga (title) {NORMALIZERS}",
+    f"CREATE INDEX IF NOT EXISTS pgroonga_memes_tags_index ON memes USING pgroonga (tags) {NORMALIZERS}",
+    "CREATE INDEX IF NOT EXISTS memes_tags_gin_index ON memes USING gin (tags)",
+    "CREATE INDEX IF NOT EXISTS memes_creator_id_index ON memes (creator_telegram_id, id)",
+    """CREATE UNIQUE INDEX IF NOT EXISTS memes_public_file_unique_id_index
+       ON memes (telegram_file_unique_id) WHERE is_public""",
+    """CREATE UNIQUE INDEX IF NOT EXISTS memes_private_file_unique_id_index
+       ON memes (creator_telegram_id, telegram_file_unique_id) WHERE NOT is_public""",
+    *[
+        f"""CREATE INDEX IF NOT EXISTS pgroonga_memes_{media_type}_{column}_index
+            ON memes USING pgroonga ({column_name}) {NORMALIZERS} WHERE media_type = '{media_type}'"""
+        for media_type in MEDIA_TYPES
+        for column, column_name in (('titles', 'title'), ('tags', 'tags'))
+    ],
+    f"CREATE INDEX IF NOT EXISTS pgroonga_collections_titles_index ON collections USING pgroonga (title) {NORMALIZERS}",
+    f"CREATE INDEX IF NOT EXISTS pgroonga_collections_tags_index ON collections USING pgroonga (tags) {NORMALIZERS}",
+    """CREATE UNIQUE INDEX IF NOT EXISTS meme_to_collection_collection_meme_index
+       ON meme_to_collection (collection_id, meme_id)""",
+    "CREATE INDEX IF NOT EXISTS tags_name_prefix_index ON tags (name text_pattern_ops)",
+]
+
+TRIGGERS = [
+    # Change feed, see bot_backend/src/change_feed.py
+    "DROP TRIGGER IF EXISTS memes_changes_trigger ON memes",
+    "DROP FUNCTION IF EXISTS notify_memes_changes()",
+    """
+    CREATE OR REPLACE FUNCTION notify_changes() RETURNS trigger AS $$
+    DECLARE
+        changed jsonb;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            changed := to_jsonb(OLD);
+        ELSE
+            changed := to_jsonb(NEW);
+        END IF;
+        PERFORM pg_notify('changes', jsonb_strip_nulls(jsonb_build_object(
+            't', TG_TABLE_NAME,
+            'op', left(TG_OP, 1),
+            'id', coalesce(changed -> 'id', changed -> 'telegram_id'),
+            'c', changed -> 'creator_telegram_id',
+            'p', changed -> 'is_public'
+        ))::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    *[
+        f"""
+        CREATE OR REPLACE TRIGGER {table}_changes_trigger
+        AFTER INSERT OR UPDATE OR DELETE ON {table}
+        FOR EACH ROW EXECUTE FUNCTION notify_changes()
+        """
+        for table in ('memes', 'users', 'collections')
+    ],
+    # Tags dictionary for autocomplete
+    """
+    CREATE OR REPLACE FUNCTION update_tags_usage() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE tags SET usage_count = usage_count - 1
+            WHERE name IN (SELECT unnest(OLD.tags));
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO tags (name, usage_count)
+            SELECT DISTINCT unnest(NEW.tags), 1
+            ON CONFLICT (name) DO UPDATE SET usage_count = tags.usage_count + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER memes_tags_usage_trigger
+    AFTER INSERT OR DELETE OR UPDATE OF tags ON memes
+    FOR EACH ROW EXECUTE FUNCTION update_tags_usage()
+    """,
+    """
+    INSERT INTO tags (name, usage_count)
+    SELECT tag, count(DISTINCT id)
+    FROM memes, unnest(tags) AS tag
+    WHERE NOT EXISTS (SELECT 1 FROM tags)
+    GROUP BY tag
+    ON CONFLICT (name) DO NOTHING
+    """,
+    # Per user memes version, ETag of mini app
+    """
+    CREATE OR REPLACE FUNCTION bump_memes_version() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO memes_versions (creator_telegram_id, version)
+        SELECT DISTINCT creator_telegram_id, 1
+        FROM (SELECT OLD.creator_telegram_id WHERE TG_OP <> 'INSERT'
+              UNION ALL
+              SELECT NEW.creator_telegram_id WHERE TG_OP <> 'DELETE') AS changed(creator_telegram_id)
+        ON CONFLICT (creator_telegram_id) DO UPDATE SET version = memes_versions.version + 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER memes_version_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON memes
+    FOR EACH ROW EXECUTE FUNCTION bump_memes_version()
+    """,
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("CREATE EXTENSION IF NOT EXISTS pgroonga")
+    op.execute(f"""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'media_type') THEN
+                CREATE TYPE media_type AS ENUM ({", ".join(f"'{media_type}'" for media_type in MEDIA_TYPES)});
+            END IF;
+        END;
+        $$
+    """)
+    for statement in TABLES + INDEXES + TRIGGERS:
+        op.execute(sa.text(statement))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in ('memes', 'users', 'collections'):
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_changes_trigger ON {table}")
+    op.execute("DROP TRIGGER IF EXISTS memes_tags_usage_trigger ON memes")
+    op.execute("DROP TRIGGER IF EXISTS memes_version_trigger ON memes")
+    for function in ('notify_changes', 'update_tags_usage', 'bump_memes_version'):
+        op.execute(f"DROP FUNCTION IF EXISTS {function}()")
+    for table in ('memes_versions', 'tags', 'user_liked_memes', 'meme_to_collection', 'collections', 'memes', 'users'):
+        op.execute(f"DROP TABLE IF EXISTS {table}")
+    op.execute("DROP TYPE IF EXISTS media_type")
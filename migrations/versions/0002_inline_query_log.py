@@ -0,0 +1,50 @@
+"""Inline query log
+
+Sampled inline queries and most frequent of them, bot warms its cache with them on startup.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19 19:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'inline_query_log',
+        sa.Column('id', sa.BigInteger(), primary_key=True),
+        sa.Column('logged_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+        sa.Column('query', sa.Text(), nullable=False),
+        sa.Column('result_count', sa.Integer(), nullable=False),
+        sa.Column('latency_ms', sa.Float(), nullable=False),
+        sa.Column('tier', sa.Text(), nullable=False),
+        sa.Column('cached_results', sa.Integer(), nullable=False),
+    )
+    op.create_index('inline_query_log_logged_at_index', 'inline_query_log', ['logged_at'])
+    op.create_table(
+        'top_inline_queries',
+        sa.Column('query', sa.Text(), primary_key=True),
+        sa.Column('searches', sa.BigInteger(), nullable=False),
+        sa.Column('avg_result_count', sa.Float(), nullable=False),
+        sa.Column('avg_latency_ms', sa.Float(), nullable=False),
+        sa.Column('cache_hit_ratio', sa.Float(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('top_inline_queries')
+    op.drop_index('inline_query_log_logged_at_index', table_name='inline_query_log')
+    op.drop_table('inline_query_log')
@@ -0,0 +1,82 @@
+"""Ban notifications
+
+Change feed notifications of users carry new is_banned when it changes, so bots keep their ban sets
+up to date. Partial index keeps loading banned users and filtering out their memes cheap.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 20:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+NOTIFY_CHANGES = """
+    CREATE OR REPLACE FUNCTION notify_changes() RETURNS trigger AS $$
+    DECLARE
+        changed jsonb;
+        previous jsonb;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            changed := to_jsonb(OLD);
+        ELSE
+            changed := to_jsonb(NEW);
+        END IF;
+        IF TG_OP = 'UPDATE' THEN
+            previous := to_jsonb(OLD);
+        END IF;
+        PERFORM pg_notify('changes', jsonb_strip_nulls(jsonb_build_object(
+            't', TG_TABLE_NAME,
+            'op', left(TG_OP, 1),
+            'id', coalesce(changed -> 'id', changed -> 'telegram_id'),
+            'c', changed -> 'creator_telegram_id',
+            'p', changed -> 'is_public',
+            'b', CASE WHEN previous -> 'is_banned' IS DISTINCT FROM changed -> 'is_banned'
+                      THEN changed -> 'is_banned' END
+        ))::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+PREVIOUS_NOTIFY_CHANGES = """
+    CREATE OR REPLACE FUNCTION notify_changes() RETURNS trigger AS $$
+    DECLARE
+        changed jsonb;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            changed := to_jsonb(OLD);
+        ELSE
+            changed := to_jsonb(NEW);
+        END IF;
+        PERFORM pg_notify('changes', jsonb_strip_nulls(jsonb_build_object(
+            't', TG_TABLE_NAME,
+            'op', left(TG_OP, 1),
+            'id', coalesce(changed -> 'id', changed -> 'telegram_id'),
+            'c', changed -> 'creator_telegram_id',
+            'p', changed -> 'is_public'
+        ))::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute(NOTIFY_CHANGES)
+    op.execute("CREATE INDEX IF NOT EXISTS users_banned_index ON users (telegram_id) WHERE is_banned")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP INDEX IF EXISTS users_banned_index")
+    op.execute(PREVIOUS_NOTIFY_CHANGES)
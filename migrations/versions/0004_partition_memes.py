@@ -0,0 +1,56 @@
+"""Partition memes
+
+memes becomes partitioned by visibility, private memes are partitioned by hash of creator,
+see memes_db/partitioning.py.
+Small databases are copied right here under lock. Big ones have to be copied online first with
+python migrations/partition_memes.py, then this migration only swaps tables.
+Downgrade swaps old table back and copies all memes into it under lock, possible until old table is dropped.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19 21:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from memes_db import partitioning
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    conn = op.get_bind()
+    shadow_exists = conn.scalar(sa.text(f"SELECT to_regclass('{partitioning.SHADOW_TABLE}') IS NOT NULL"))
+    if shadow_exists:
+        comment = conn.scalar(sa.text(f"SELECT obj_description('{partitioning.SHADOW_TABLE}'::regclass, 'pg_class')"))
+        if comment != partitioning.BACKFILLED:
+            raise RuntimeError(f"{partitioning.SHADOW_TABLE} isn't fully copied yet, "
+                               f"finish python migrations/partition_memes.py first")
+    else:
+        op.execute("LOCK TABLE memes IN ACCESS EXCLUSIVE MODE")
+        for statement in partitioning.create_shadow_statements():
+            op.execute(sa.text(statement))
+        op.execute(sa.text(partitioning.copy_all_statement()))
+
+    for statement in partitioning.swap_statements():
+        op.execute(sa.text(statement))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    conn = op.get_bind()
+    old_exists = conn.scalar(sa.text(f"SELECT to_regclass('{partitioning.OLD_TABLE}') IS NOT NULL"))
+    if not old_exists:
+        raise RuntimeError(f"{partitioning.OLD_TABLE} was dropped, partitioned memes can't be downgraded")
+
+    for statement in partitioning.unswap_statements():
+        op.execute(sa.text(statement))
@@ -0,0 +1,56 @@
+"""Upload jobs
+
+Durable queue of meme uploads, bot workers take batches of it with SKIP LOCKED.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19 22:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'upload_jobs',
+        sa.Column('id', sa.BigInteger(), primary_key=True),
+        sa.Column('idempotency_key', sa.Text(), nullable=False, unique=True),
+        sa.Column('user_telegram_id', sa.BigInteger(), nullable=False),
+        sa.Column('chat_id', sa.BigInteger(), nullable=False),
+        sa.Column('telegram_media_id', sa.Text(), nullable=False),
+        sa.Column('telegram_file_unique_id', sa.Text(), nullable=True),
+        sa.Column('title', sa.Text(), nullable=False),
+        sa.Column('tags', postgresql.ARRAY(sa.Text()), server_default='{}', nullable=False),
+        sa.Column('media_type', postgresql.ENUM(name='media_type', create_type=False), nullable=False),
+        sa.Column('duration', sa.Integer(), nullable=False),
+        sa.Column('is_public', sa.Boolean(), nullable=False),
+        sa.Column('status', sa.Text(), server_default='pending', nullable=False),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('run_after', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+        sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+    )
+    op.create_index('upload_jobs_pending_index', 'upload_jobs', ['run_after', 'id'],
+                    postgresql_where=sa.text("status = 'pending'"))
+    op.create_index('upload_jobs_finished_at_index', 'upload_jobs', ['finished_at'],
+                    postgresql_where=sa.text("status <> 'pending'"))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('upload_jobs_finished_at_index', table_name='upload_jobs')
+    op.drop_index('upload_jobs_pending_index', table_name='upload_jobs')
+    op.drop_table('upload_jobs')
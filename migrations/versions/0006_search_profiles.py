@@ -0,0 +1,39 @@
+"""Search profiles
+
+Pgroonga indexes get default profiles of memes_db/search_profiles.py. They are the same as indexes
+had before, so usually nothing is rebuilt, other profiles are switched to by maintenance script.
+Indexes that have other profile are rebuilt concurrently, bots keep running.
+Downgrade rebuilds indexes that were switched to other profiles with bigram, the profile they had before.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-19 23:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+from memes_db import search_profiles
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        for group, profile_name in search_profiles.INDEX_PROFILES.items():
+            search_profiles.switch_profile(op.get_bind(), group, profile_name)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # Indexes had only normalizers of bigram profile before, indexes switched to other profiles are rebuilt
+    with op.get_context().autocommit_block():
+        for group in search_profiles.INDEX_PROFILES:
+            search_profiles.switch_profile(op.get_bind(), group, "bigram")
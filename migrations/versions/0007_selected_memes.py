@@ -0,0 +1,34 @@
+"""Selected memes
+
+Selection of multi-select mode of memes menu, moved from memory of bot process into database.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-20 10:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'selected_memes',
+        sa.Column('user_telegram_id', sa.BigInteger(), sa.ForeignKey('users.telegram_id'), primary_key=True),
+        sa.Column('meme_id', sa.BigInteger(), primary_key=True),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('selected_memes')
@@ -0,0 +1,52 @@
+"""
+Authentication of mini app users by Telegram WebApp initData.
+
+Client sends Telegram.WebApp.initData in "Authorization: tma <initData>" header. Telegram signs it
+with a key derived from the bot token, so a valid signature proves the user id in it.
+Media elements can't set headers, so media endpoints also take initData from "auth" query parameter.
+"""
+import hashlib
+import hmac
+import time
+from typing import Optional
+from urllib.parse import parse_qsl
+
+import orjson
+
+
+class InvalidInitData(Exception):
+    pass
+
+
+def secret_key(bot_token: str) -> bytes:
+    return hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+
+
+def sign(fields: dict[str, str], key: bytes) -> str:
+    data_check_string = "\n".join(f"{name}={value}" for name, value in sorted(fields.items()))
+    return hmac.new(key, data_check_string.encode(), hashlib.sha256).hexdigest()
+
+
+def verify_init_data(init_data: str, key: bytes, max_age: int, now: Optional[float] = None) -> int:
+    """
+    Telegram id of user of signed initData
+    Args:
+        key: secret_key() of bot token
+        max_age: seconds since initData was issued after which it isn't accepted
+    """
+    try:
+        fields = dict(parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+    except ValueError:
+        raise InvalidInitData("malformed")
+    received_hash = fields.pop("hash", "")
+    if not hmac.compare_digest(sign(fields, key), received_hash):
+        raise InvalidInitData("bad signature")
+
+    try:
+        auth_date = int(fields["auth_date"])
+        user_id = int(orjson.loads(fields["user"])["id"])
+    except (KeyError, ValueError, TypeError, orjson.JSONDecodeError):
+        raise InvalidInitData("no user")
+    if (now if now is not None else time.time()) - auth_date > max_age:
+        raise InvalidInitData("expired")
+    return user_id
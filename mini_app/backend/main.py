@@ -1,32 +1,215 @@
+import asyncio
 import database
 from contextlib import asynccontextmanager
+from os import getenv
+from pathlib import Path
+from typing import Optional, AsyncIterator
 
 from dotenv import load_dotenv
-from fastapi import FastAPI
+import orjson
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, FileResponse
+
+from auth import InvalidInitData, secret_key, verify_init_data
+from media import (MediaCache, DiskCache, TelegramFetcher, DirectoryFetcher, MediaNotFound, ORIGINAL, THUMBNAIL)
+from memes_db import repository
+from memes_db.models import MediaType
+from responses import make_etag, etag_matches, not_modified, json_response
 
 
 load_dotenv()
 
+MEDIA_TYPES = tuple(media_type.value for media_type in MediaType)
+
+BOT_KEY = getenv("BOT_KEY")
+# Origins the mini app is served from, separated by commas
+MINI_APP_ORIGINS = [origin.strip() for origin in getenv("MINI_APP_ORIGINS", "").split(",") if origin.strip()]
+# initData older than that is rejected, Telegram issues new one every time mini app is opened
+INIT_DATA_MAX_AGE = int(getenv("INIT_DATA_MAX_AGE", str(24 * 60 * 60)))
+
+MEDIA_CACHE_DIR = Path(getenv("MEDIA_CACHE_DIR", "media_cache"))
+MEDIA_CACHE_MAX_BYTES = int(getenv("MEDIA_CACHE_MAX_MB", "1024")) * 2 ** 20
+# Directory with files named by telegram_media_id, used instead of telegram in development and tests
+MEDIA_DIR = getenv("MEDIA_DIR")
+# When set, files are sent by reverse proxy: nginx location with this prefix has to be an internal alias
+# of MEDIA_CACHE_DIR, e.g. location /cached-media/ { internal; alias /app/media_cache/; }
+MEDIA_ACCEL_REDIRECT = getenv("MEDIA_ACCEL_REDIRECT")
+# File sent by proxy isn't evicted for that long after response
+ACCEL_REDIRECT_PIN_SECONDS = 10
+# File of meme never changes, but meme can become private or be deleted. Browser reuses media
+# for that long and then revalidates it with ETag, which checks access again
+MEDIA_MAX_AGE = 5 * 60
+CONTENT_TYPES = {
+    "photo": "image/jpeg",
+    # Telegram converts gifs to mp4 animations
+    "gif": "video/mp4",
+    "video": "video/mp4",
+    "audio": "audio/mpeg",
+    "voice": "audio/ogg",
+}
+
+media_cache: Optional[MediaCache] = None
+
+
 @asynccontextmanager
 async def lifespan(instance: FastAPI):
+    global media_cache
     await database.init_database()
+    fetcher = DirectoryFetcher(Path(MEDIA_DIR)) if MEDIA_DIR else TelegramFetcher(BOT_KEY)
+    media_cache = MediaCache(fetcher, DiskCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES))
     yield
+    await media_cache.close()
     await database.close_all_connections()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=MINI_APP_ORIGINS,
+    allow_methods=["GET"],
+    allow_headers=["Authorization", "If-None-Match"],
+    expose_headers=["ETag"],
 )
 
+init_data_key = secret_key(BOT_KEY or "")
+
+
+def authenticate(init_data: Optional[str]) -> int:
+    if not init_data:
+        raise HTTPException(status_code=401)
+    try:
+        return verify_init_data(init_data, init_data_key, INIT_DATA_MAX_AGE)
+    except InvalidInitData:
+        raise HTTPException(status_code=401)
+
+
+def current_user(request: Request) -> int:
+    """Telegram id of user from signed initData of Authorization header"""
+    scheme, _, init_data = request.headers.get("authorization", "").partition(" ")
+    return authenticate(init_data if scheme.lower() == "tma" else None)
+
+
+def current_media_user(request: Request, auth: Optional[str] = None) -> int:
+    """Same as current_user, <img> and <video> can't set headers, so initData may come in auth parameter"""
+    return authenticate(auth) if auth else current_user(request)
+
+
+@app.get("/api/memes")
+async def user_memes(request: Request,
+                     tg_id: int = Depends(current_user),
+                     cursor: Optional[int] = None,
+                     limit: int = Query(database.MEMES_PAGE_SIZE, ge=1, le=database.MAX_MEMES_PAGE_SIZE),
+                     media_type: Optional[str] = Query(None, alias="type", pattern="^(" + "|".join(MEDIA_TYPES) + ")$"),
+                     tag: Optional[list[str]] = Query(None),
+                     q: Optional[str] = None,
+                     public: Optional[bool] = None) -> Response:
+    """
+    Page of user's memes, newest first
+    Args:
+        cursor: "next" from previous page
+        media_type: only memes of this type
+        tag: memes must have all of given tags
+        q: search in titles and tags
+        public: only public or only private memes
+    Returns:
+        {"memes": [{"id", "title", "tags", "type", "public"}], "next": cursor of next page or null}
+    """
+    # Version is read before the page, so page can't be older than its ETag
+    etag = make_etag(tg_id, await repository.get_memes_version(tg_id))
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    # One extra row tells if there is next page
+    rows = await repository.get_user_memes_page(tg_id, limit + 1, before_id=cursor, media_type=media_type,
+                                                tags=tag, query=q, is_public=public)
+    page = rows[:limit]
+    content = {
+        "memes": [{"id": meme_id, "title": title, "tags": tags, "type": meme_type, "public": is_public}
+                  for meme_id, title, tags, meme_type, is_public in page],
+        "next": page[-1][0] if len(rows) > limit else None,
+    }
+    return json_response(request, content, etag)
+
+
+async def search_lines(results) -> AsyncIterator[bytes]:
+    """One JSON line per meme, sent as soon as page with it comes from database"""
+    # User's private copy of public meme would show up twice
+    seen = set()
+    async for rows in results:
+        lines = []
+        for meme_id, title, _, file_unique_id, meme_type, is_public, score in rows:
+            key = file_unique_id or meme_id
+            if key in seen:
+                continue
+            seen.add(key)
+            lines.append(orjson.dumps({"id": meme_id, "title": title, "type": meme_type,
+                                       "public": is_public, "score": score}))
+        if lines:
+            yield b"\n".join(lines) + b"\n"
+
+
+@app.get("/api/search")
+async def search(tg_id: int = Depends(current_user),
+                 q: str = "",
+                 media_type: Optional[str] = Query(None, alias="type", pattern="^(" + "|".join(MEDIA_TYPES) + ")$"),
+                 tag: Optional[list[str]] = Query(None)) -> StreamingResponse:
+    """
+    Search memes visible to user the same way as inline search of bot.
+    Results are streamed as NDJSON, best matches first, so client can show first hits before the rest is found.
+    When client disconnects stream is cancelled together with database query
+    """
+    results = repository.stream_search(q, tg_id, tags=tag, media_type=MediaType(media_type) if media_type else None)
+    return StreamingResponse(search_lines(results), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-store"})
+
+
+class CachedFileResponse(FileResponse):
+    """Releases pinned file of media cache when response is done, even if client went away"""
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            media_cache.release(Path(self.path))
+
+
+async def media_response(request: Request, tg_id: int, meme_id: int, variant: str) -> Response:
+    meme = await repository.get_meme_media(meme_id, tg_id)
+    if meme is None:
+        raise HTTPException(status_code=404)
+    telegram_media_id, meme_type, _ = meme
+    # URL carries initData of user, so media is never stored by shared caches
+    headers = {"ETag": make_etag(meme_id, variant), "Cache-Control": f"private, max-age={MEDIA_MAX_AGE}"}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    try:
+        file = await media_cache.get(telegram_media_id, meme_type, variant)
+    except MediaNotFound:
+        raise HTTPException(status_code=404)
+
+    content_type = "image/jpeg" if variant == THUMBNAIL else CONTENT_TYPES[meme_type]
+    if isinstance(file, bytes):
+        # Just fetched, next requests get it from cache with range support
+        return Response(file, media_type=content_type, headers=headers)
+    if MEDIA_ACCEL_REDIRECT:
+        headers["X-Accel-Redirect"] = MEDIA_ACCEL_REDIRECT.rstrip("/") + "/" + file.name
+        # Proxy opens the file after response is sent
+        asyncio.get_running_loop().call_later(ACCEL_REDIRECT_PIN_SECONDS, media_cache.release, file)
+        return Response(media_type=content_type, headers=headers)
+    # Range requests are answered by FileResponse, whole files are sent with sendfile
+    # by servers that support pathsend extension
+    return CachedFileResponse(file, media_type=content_type, headers=headers)
+
+
+@app.get("/api/memes/{meme_id}/thumbnail")
+async def meme_thumbnail(request: Request, meme_id: int, tg_id: int = Depends(current_media_user)) -> Response:
+    """Small JPEG preview of photo meme, 404 for other media types"""
+    return await media_response(request, tg_id, meme_id, THUMBNAIL)
 
 
-@app.get("/api/tasks/{tg_id}")
-async def test(tg_id: int):
-    pass
+@app.get("/api/memes/{meme_id}/media")
+async def meme_media(request: Request, meme_id: int, tg_id: int = Depends(current_media_user)) -> Response:
+    """Original file of meme, supports range requests, so players can seek in videos and audio"""
+    return await media_response(request, tg_id, meme_id, ORIGINAL)
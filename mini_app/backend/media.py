@@ -0,0 +1,237 @@
+"""
+Media files and thumbnails of memes for the mini app.
+
+Files are fetched by telegram_media_id through a fetcher, telegram by default or a local directory
+in development and tests, and kept in a size bounded on disk cache, least recently used files are removed first.
+Concurrent requests for a file that isn't cached yet wait for one fetch and get its bytes.
+Cached files are sent by path, so the server can use sendfile for them. Path is pinned until response
+has opened the file, pinned files aren't evicted.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Protocol, Union
+
+import httpx
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Longest side of thumbnail in pixels
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 80
+# Media types that thumbnails can be made of, other types only have originals
+THUMBNAIL_MEDIA_TYPES = ("photo",)
+# Media ids whose thumbnail can't be made are remembered, so original isn't fetched again for it
+MAX_FAILED_THUMBNAILS = 10000
+ORIGINAL = "original"
+THUMBNAIL = "thumbnail"
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+FETCH_TIMEOUT = 30
+
+
+class MediaNotFound(Exception):
+    pass
+
+
+class MediaFetcher(Protocol):
+    async def fetch(self, telegram_media_id: str) -> bytes:
+        """Bytes of file, raises MediaNotFound if there is no such file"""
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+class TelegramFetcher:
+    """Downloads files through bot API, which serves files up to 20 MB"""
+
+    def __init__(self, bot_token: str):
+        self.bot_token = bot_token
+        self.client = httpx.AsyncClient(base_url=TELEGRAM_API_URL, timeout=FETCH_TIMEOUT)
+
+    async def fetch(self, telegram_media_id: str) -> bytes:
+        response = await self.client.get(f"/bot{self.bot_token}/getFile", params={"file_id": telegram_media_id})
+        if response.status_code == 400:
+            raise MediaNotFound(telegram_media_id)
+        response.raise_for_status()
+        file_path = response.json()["result"]["file_path"]
+
+        response = await self.client.get(f"/file/bot{self.bot_token}/{file_path}")
+        response.raise_for_status()
+        return response.content
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class DirectoryFetcher:
+    """Local stand-in for telegram, file of every media id is a file with that name in directory"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    async def fetch(self, telegram_media_id: str) -> bytes:
+        path = self.directory / telegram_media_id
+        if path.parent != self.directory or not path.is_file():
+            raise MediaNotFound(telegram_media_id)
+        return await asyncio.to_thread(path.read_bytes)
+
+    async def close(self) -> None:
+        pass
+
+
+class DiskCache:
+    """
+    Files limited by total size. Order of use is kept in memory and rebuilt from modification times on start.
+    Only event loop thread changes it, file writes run in threads
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # file name -> size, least recently used first
+        self.files: OrderedDict[str, int] = OrderedDict()
+        self.total_bytes = 0
+        # file name -> amount of responses that are about to open it
+        self.pins: dict[str, int] = {}
+
+        directory.mkdir(parents=True, exist_ok=True)
+        existing = []
+        for path in directory.iterdir():
+            if path.name.startswith("."):
+                # Temporary file of write that didn't finish
+                path.unlink(missing_ok=True)
+                continue
+            stat = path.stat()
+            existing.append((stat.st_mtime, path.name, stat.st_size))
+        for _, name, size in sorted(existing):
+            self.files[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def get(self, name: str) -> Optional[Path]:
+        """Path of cached file, pinned until unpin(name)"""
+        if name not in self.files:
+            return None
+        self.files.move_to_end(name)
+        self.pins[name] = self.pins.get(name, 0) + 1
+        return self.directory / name
+
+    def unpin(self, name: str) -> None:
+        self.pins[name] -= 1
+        if not self.pins[name]:
+            del self.pins[name]
+            self._evict()
+
+    async def put(self, name: str, data: bytes) -> Path:
+        path = self.directory / name
+        await asyncio.to_thread(self._write, path, data)
+        self.total_bytes += len(data) - self.files.pop(name, 0)
+        self.files[name] = len(data)
+        self._evict()
+        return path
+
+    def _write(self, path: Path, data: bytes) -> None:
+        # Readers never see half written file
+        fd, temporary = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+
+    def _evict(self) -> None:
+        # Pinned files are kept even if cache stays over the limit, they are evicted after they are unpinned
+        for name in list(self.files):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if name in self.pins:
+                continue
+            self.total_bytes -= self.files.pop(name)
+            # Response that already opened the file still reads it to the end
+            (self.directory / name).unlink(missing_ok=True)
+
+
+def make_thumbnail(data: bytes) -> bytes:
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+        return output.getvalue()
+
+
+class MediaCache:
+    def __init__(self, fetcher: MediaFetcher, cache: DiskCache):
+        self.fetcher = fetcher
+        self.cache = cache
+        # telegram_media_id -> fetch that is in progress
+        self.fetches: dict[str, asyncio.Task] = {}
+        self.failed_thumbnails: set[str] = set()
+
+    @staticmethod
+    def file_name(telegram_media_id: str, variant: str) -> str:
+        # Media ids are long and may contain characters that don't fit into file names
+        return hashlib.sha256(f"{variant}:{telegram_media_id}".encode()).hexdigest()
+
+    async def get(self, telegram_media_id: str, media_type: str, variant: str) -> Union[Path, bytes]:
+        """
+        Original or thumbnail: path of cached file, which has to be release()d after response opened it,
+        or bytes if file was just fetched.
+        Raises MediaNotFound if file can't be fetched or there is no thumbnail for it
+        """
+        if variant == THUMBNAIL and (media_type not in THUMBNAIL_MEDIA_TYPES or Image is None
+                                     or telegram_media_id in self.failed_thumbnails):
+            raise MediaNotFound(telegram_media_id)
+        path = self.cache.get(self.file_name(telegram_media_id, variant))
+        if path is not None:
+            return path
+
+        fetch = self.fetches.get(telegram_media_id)
+        if fetch is None:
+            fetch = asyncio.create_task(self._fetch(telegram_media_id, media_type))
+            self.fetches[telegram_media_id] = fetch
+            fetch.add_done_callback(lambda _: self._forget(telegram_media_id))
+        # Request that is cancelled doesn't cancel fetch other requests wait for
+        files = await asyncio.shield(fetch)
+        if variant not in files:
+            raise MediaNotFound(telegram_media_id)
+        return files[variant]
+
+    def release(self, path: Path) -> None:
+        self.cache.unpin(path.name)
+
+    def _forget(self, telegram_media_id: str) -> None:
+        fetch = self.fetches.pop(telegram_media_id)
+        # Error of fetch whose requests all went away would be logged as never retrieved
+        if not fetch.cancelled():
+            fetch.exception()
+
+    async def _fetch(self, telegram_media_id: str, media_type: str) -> dict[str, bytes]:
+        """Fetch file once and cache it together with its thumbnail"""
+        data = await self.fetcher.fetch(telegram_media_id)
+        files = {ORIGINAL: data}
+        if media_type in THUMBNAIL_MEDIA_TYPES and Image is not None:
+            try:
+                files[THUMBNAIL] = await asyncio.to_thread(make_thumbnail, data)
+            except Exception as e:
+                logger.warning(f"Can't make thumbnail of {telegram_media_id}: {e}")
+                if len(self.failed_thumbnails) >= MAX_FAILED_THUMBNAILS:
+                    self.failed_thumbnails.clear()
+                self.failed_thumbnails.add(telegram_media_id)
+        for variant, content in files.items():
+            await self.cache.put(self.file_name(telegram_media_id, variant), content)
+        return files
+
+    async def close(self) -> None:
+        for fetch in list(self.fetches.values()):
+            fetch.cancel()
+        await self.fetcher.close()
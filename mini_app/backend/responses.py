@@ -0,0 +1,56 @@
+import gzip
+from typing import Any, Optional
+
+import orjson
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compressing small bodies costs more than sending them
+MIN_COMPRESS_SIZE = 512
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def make_etag(*parts: Any) -> str:
+    """Weak ETag, so compressed and uncompressed bodies of same data share it"""
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    # Weak comparison, W/ prefix is ignored
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def _compress(request: Request, body: bytes) -> tuple[bytes, Optional[str]]:
+    if len(body) < MIN_COMPRESS_SIZE:
+        return body, None
+    accepted = {encoding.split(";")[0].strip() for encoding in request.headers.get("accept-encoding", "").split(",")}
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+
+def json_response(request: Request, content: Any, etag: str) -> Response:
+    """
+    Serialize content with orjson and compress it with brotli or gzip if client accepts them.
+    Client has to revalidate every time, unchanged data costs only 304 response
+    """
+    body, encoding = _compress(request, orjson.dumps(content))
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Modules of mini app backend are imported by their names, as uvicorn runs it from that directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,45 @@
+from urllib.parse import urlencode
+
+import pytest
+
+from auth import InvalidInitData, secret_key, sign, verify_init_data
+
+KEY = secret_key("123:bot-token")
+NOW = 1_700_000_000
+
+
+def make_init_data(key: bytes = KEY, **overrides: str) -> str:
+    fields = {"auth_date": str(NOW), "query_id": "AAH", "user": '{"id": 42, "first_name": "Meme"}', **overrides}
+    return urlencode({**fields, "hash": sign(fields, key)})
+
+
+def test_valid_init_data_gives_user_id():
+    assert verify_init_data(make_init_data(), KEY, max_age=60, now=NOW + 10) == 42
+
+
+def test_tampered_user_is_rejected():
+    init_data = make_init_data().replace("%22id%22%3A+42", "%22id%22%3A+43")
+    with pytest.raises(InvalidInitData):
+        verify_init_data(init_data, KEY, max_age=60, now=NOW)
+
+
+def test_other_bot_signature_is_rejected():
+    with pytest.raises(InvalidInitData):
+        verify_init_data(make_init_data(secret_key("456:other")), KEY, max_age=60, now=NOW)
+
+
+def test_expired_init_data_is_rejected():
+    with pytest.raises(InvalidInitData):
+        verify_init_data(make_init_data(), KEY, max_age=60, now=NOW + 61)
+
+
+@pytest.mark.parametrize("init_data", ["", "garbage", "user=1&hash=00"])
+def test_malformed_init_data_is_rejected(init_data):
+    with pytest.raises(InvalidInitData):
+        verify_init_data(init_data, KEY, max_age=60, now=NOW)
+
+
+def test_signed_init_data_without_user_is_rejected():
+    fields = {"auth_date": str(NOW)}
+    with pytest.raises(InvalidInitData):
+        verify_init_data(urlencode({**fields, "hash": sign(fields, KEY)}), KEY, max_age=60, now=NOW)
@@ -0,0 +1,117 @@
+const API_URL = import.meta.env.VITE_API_URL ?? ''
+
+// Signed by Telegram, server takes user from it
+function initData(): string {
+    return (window as any).Telegram?.WebApp?.initData ?? ''
+}
+
+function authHeaders(): HeadersInit {
+    return { Authorization: `tma ${initData()}` }
+}
+
+// URL of meme file for <img> and <video>, they can't send headers, so initData goes in query
+export function mediaUrl(memeId: number, variant: 'media' | 'thumbnail'): string {
+    return `${API_URL}/api/memes/${memeId}/${variant}?${new URLSearchParams({ auth: initData() })}`
+}
+
+export interface Meme {
+    id: number
+    title: string
+    tags: string[]
+    type: string
+    public: boolean
+}
+
+export interface MemesPage {
+    memes: Meme[]
+    // Cursor of next page, null on the last one
+    next: number | null
+}
+
+export interface MemesFilter {
+    type?: string
+    tags?: string[]
+    q?: string
+    public?: boolean
+}
+
+// URL -> ETag and page it came with, unchanged page is answered with 304 and taken from here
+const pageCache = new Map<string, { etag: string, page: MemesPage }>()
+
+// Page of user's memes, newest first. Cursor is "next" of previous page
+export async function fetchMemesPage(cursor: number | null = null, filter: MemesFilter = {},
+                                     signal?: AbortSignal): Promise<MemesPage> {
+    const params = new URLSearchParams()
+    if (cursor !== null) {
+        params.set('cursor', String(cursor))
+    }
+    if (filter.type) {
+        params.set('type', filter.type)
+    }
+    for (const tag of filter.tags ?? []) {
+        params.append('tag', tag)
+    }
+    if (filter.q) {
+        params.set('q', filter.q)
+    }
+    if (filter.public !== undefined) {
+        params.set('public', String(filter.public))
+    }
+    const url = `${API_URL}/api/memes?${params}`
+
+    const cached = pageCache.get(url)
+    const headers = new Headers(authHeaders())
+    if (cached) {
+        headers.set('If-None-Match', cached.etag)
+    }
+    // Browser cache would hide 304 behind a 200, pages are cached here instead
+    const response = await fetch(url, { signal, headers, cache: 'no-store' })
+    if (response.status === 304 && cached) {
+        return cached.page
+    }
+    if (!response.ok) {
+        throw new Error(`Loading memes failed: ${response.status}`)
+    }
+    const page = await response.json() as MemesPage
+    const etag = response.headers.get('ETag')
+    if (etag) {
+        pageCache.set(url, { etag, page })
+    }
+    return page
+}
+
+export interface SearchHit {
+    id: number
+    title: string
+    type: string
+    public: boolean
+    score: number
+}
+
+// Calls onHits with every batch of results as soon as it arrives, best matches first.
+// Aborting signal closes the connection and stops the search on the server.
+export async function streamSearch(query: string, onHits: (hits: SearchHit[]) => void,
+                                   signal?: AbortSignal): Promise<void> {
+    const params = new URLSearchParams({ q: query })
+    const response = await fetch(`${API_URL}/api/search?${params}`, { signal, headers: authHeaders() })
+    if (!response.ok || !response.body) {
+        throw new Error(`Search failed: ${response.status}`)
+    }
+
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+    let buffer = ''
+    while (true) {
+        const { done, value } = await reader.read()
+        if (done) {
+            break
+        }
+        buffer += value
+        const lines = buffer.split('\n')
+        // Last line can be incomplete, it's finished by next chunk
+        buffer = lines.pop() ?? ''
+        const hits = lines.filter(line => line).map(line => JSON.parse(line) as SearchHit)
+        if (hits.length) {
+            onHits(hits)
+        }
+    }
+}